@@ -0,0 +1,262 @@
+#!/usr/bin/env python3
+"""Benchmarks for the staging, hydro fetch and sync paths of ssm_hyak.py
+
+Synthetic run trees are generated in a temporary directory and the
+"remote" host is the local machine, reached through an ssh shim, so
+nothing leaves this machine. sbatch and squeue are faked the same way
+the tests do it. rsync must be installed. Each phase is timed at each
+scale and the results written as JSON, which --compare can check
+against an earlier run.
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import tempfile
+import platform
+import statistics
+import subprocess
+import logging
+from pathlib import Path
+from argparse import ArgumentParser
+
+import ssm_hyak
+
+MiB = 1024 * 1024
+
+# Sizes of the synthetic trees: input files staged into each instance,
+# hydro result files fetched from the "remote", and registered jobs with
+# NetCDF station output files and a growing history file for sync
+SCALES = {
+    'small': {'input_files': 20, 'input_size': 1 * MiB, 'hydro_files': 10, 'hydro_size': 4 * MiB,
+              'jobs': 2, 'output_files': 5, 'output_size': 1 * MiB},
+    'medium': {'input_files': 200, 'input_size': 1 * MiB, 'hydro_files': 40, 'hydro_size': 16 * MiB,
+               'jobs': 8, 'output_files': 20, 'output_size': 4 * MiB},
+    'large': {'input_files': 1000, 'input_size': 2 * MiB, 'hydro_files': 120, 'hydro_size': 32 * MiB,
+              'jobs': 32, 'output_files': 50, 'output_size': 8 * MiB},
+}
+
+_block = os.urandom(MiB)
+
+def write_file(path, size, tag):
+    """Write size bytes of incompressible data that differs for each tag"""
+    os.makedirs(path.parent, exist_ok=True)
+    with open(path, 'wb') as f:
+        f.write(f'{tag}\n'.encode())
+        remaining = size
+        while remaining > 0:
+            n = min(remaining, len(_block))
+            f.write(_block[:n])
+            remaining -= n
+
+class Bench:
+    """One synthetic environment for a scale"""
+    def __init__(self, root, scale):
+        self.root = root
+        self.scale = scale
+        self.run_root = root / 'run_root'
+        self.remote = root / 'remote'
+        self.scrub = root / 'scrub' / os.environ['USER']
+        self.statedir = root / 'state'
+        for d in (self.run_root, self.remote, self.scrub, self.statedir):
+            os.makedirs(d)
+        ssm_hyak.REGISTER_STATEDIR = self.statedir
+        self._fake_bins()
+        self.config = {
+            'run_root': os.fspath(self.run_root),
+            'save_root': f'localhost:{self.remote / "save"}',
+            'scrub_dir': os.fspath(self.scrub),
+            'scrub_dir_out': os.fspath(self.scrub),
+            'ssh_multiplex': 'no',
+        }
+
+    def _fake_bins(self):
+        """ssh that runs commands locally, and sbatch/squeue that report every job running"""
+        bindir = self.root / 'bin'
+        os.makedirs(bindir)
+        scripts = {
+            'ssh': 'while [ $# -gt 0 ]; do case "$1" in -o|-p|-l) shift 2;; -*) shift;; *) break;; esac; done\n'
+                   'shift\nexec sh -c "$*"\n',
+            'sbatch': f'n=$(cat {self.root}/jobid 2>/dev/null || echo 1000)\n'
+                      f'n=$((n+1)); echo $n > {self.root}/jobid; echo "$n"\n',
+            'squeue': 'for a; do case "$a" in --jobs=*) echo "${a#*=}" | tr , "\\n" | '
+                      'while read j; do echo "$j $j RUNNING"; done;; esac; done\n',
+        }
+        for name, script in scripts.items():
+            with open(bindir / name, 'w') as f:
+                f.write('#!/bin/sh\n' + script)
+            os.chmod(bindir / name, 0o755)
+        os.environ['PATH'] = os.fspath(bindir) + ':' + os.environ['PATH']
+
+    def make_instance(self, name='instance'):
+        """A WQM instance whose hydro results are on the "remote" """
+        s = self.scale
+        home = self.run_root / name
+        for i in range(s['input_files']):
+            write_file(home / 'inputs' / f'input_{i:05d}.dat', s['input_size'], f'{name} input {i}')
+        hydro = self.remote / 'hydro' / 'netcdf'
+        if not hydro.is_dir():
+            for i in range(1, s['hydro_files'] + 1):
+                write_file(hydro / f'ssm_{i:05d}.nc', s['hydro_size'], f'hydro {i}')
+        with open(home / 'wqm_con.npt', 'w') as f:
+            f.write('Synthetic control file\nMAP FILE\ninputs/input_00000.dat\n\n')
+        with open(home / 'wqm_linkage.in', 'w') as f:
+            f.write(f"&hydro_netcdf\n    hydro_dir = 'localhost:{hydro}/'\n/\n")
+        with open(home / 'run_icm.stub', 'w') as f:
+            f.write('SBATCH --job-name=bench\n')
+        return home
+
+    def helper(self, home, **config):
+        h = ssm_hyak.HyakSetupHelper('wqm', 'bench', 'true', home=home, **self.config, **config)
+        h.test = True
+        h.ssh = ssm_hyak.SshMultiplexer(False)
+        return h
+
+    def make_jobs(self):
+        """Registered running jobs with output directories"""
+        s = self.scale
+        for j in range(s['jobs']):
+            jobid = str(2000 + j)
+            home = self.run_root / f'job{jobid}'
+            os.makedirs(home / 'outputs')
+            with open(home / 'wqm_con.npt', 'w') as f:
+                f.write('\n')
+            with open(home / 'ssm_hyak.ini', 'w') as f:
+                f.write('[wqm]\n')
+            for i in range(s['output_files']):
+                write_file(home / 'outputs' / f'ssm_station_{i:03d}.nc', s['output_size'], f'{jobid} out {i}')
+            write_file(home / 'outputs' / 'ssm_history_00001.nc', s['output_size'], f'{jobid} history')
+            with open(self.statedir / f'{jobid}.job', 'w') as f:
+                f.write(f'{home}\n')
+
+    def grow_outputs(self):
+        """Append to every job's history file, as a running model would"""
+        for jf in self.statedir.glob('*.job'):
+            home = Path(jf.read_text().splitlines()[0])
+            with open(home / 'outputs' / 'ssm_history_00001.nc', 'ab') as f:
+                f.write(_block[:self.scale['output_size'] // 10])
+
+def timed(results, phase, func):
+    start = time.perf_counter()
+    ret = func()
+    results.setdefault(phase, []).append(time.perf_counter() - start)
+    return ret
+
+def run_scale(scale, repeat, keep=False):
+    """Time every phase at one scale. Returns phase -> list of seconds"""
+    results = {}
+    path = os.environ['PATH']
+    for _ in range(repeat):
+        root = Path(tempfile.mkdtemp(prefix='ssm-bench-'))
+        try:
+            bench = Bench(root, scale)
+            home = bench.make_instance()
+            h = bench.helper(home)
+            src = h._wqm_hydro_source()
+            nc, _ = timed(results, 'fetch_cold', lambda: h._fetch_hydro(src))
+            timed(results, 'fetch_warm', lambda: h._fetch_hydro(src))
+            inst = timed(results, 'stage', lambda: h._stage_wqm(src, nc))
+            h._register_instance(inst, None)
+            h = bench.helper(home, stage_reuse='yes')
+            timed(results, 'stage_reuse', lambda: h._stage_wqm(src, nc))
+
+            bench.make_jobs()
+            sync = ssm_hyak.SyncHelper('DEFAULT', **bench.config)
+            timed(results, 'sync_initial', sync.run)
+            timed(results, 'sync_unchanged', sync.run)
+            bench.grow_outputs()
+            timed(results, 'sync_grown', sync.run)
+            bench.grow_outputs()
+            sync = ssm_hyak.SyncHelper('DEFAULT', sync_append='tail', **bench.config)
+            timed(results, 'sync_grown_tail', sync.run)
+        finally:
+            os.environ['PATH'] = path
+            if keep:
+                print(f'Kept {root}', file=sys.stderr)
+            else:
+                shutil.rmtree(root, ignore_errors=True)
+    return results
+
+def summarize(name, scale, times):
+    return [{'scale': name, 'phase': phase, 'median': statistics.median(t), 'min': min(t),
+             'runs': t, 'params': scale} for phase, t in times.items()]
+
+def compare(results, baseline, threshold):
+    """Print phases that got slower than baseline by more than threshold. Returns whether any did"""
+    old = {(r['scale'], r['phase']): r['median'] for r in baseline['results']}
+    slower = False
+    for r in results:
+        key = (r['scale'], r['phase'])
+        if key not in old or old[key] <= 0:
+            continue
+        ratio = r['median'] / old[key]
+        flag = ''
+        if ratio > 1 + threshold:
+            flag = '  SLOWER'
+            slower = True
+        print(f'{r["scale"]:<8} {r["phase"]:<16} {old[key]:8.3f} s -> {r["median"]:8.3f} s ({ratio:5.2f}x){flag}')
+    return slower
+
+def main():
+    parser = ArgumentParser(description='Benchmark ssm_hyak.py staging, fetch and sync')
+    parser.add_argument('-s', '--scale', action='append', choices=list(SCALES),
+                        help='Scale to run (repeatable, default small and medium)')
+    parser.add_argument('-n', '--repeat', type=int, default=3, help='Runs of each scale (default 3)')
+    parser.add_argument('-o', '--output', default='bench_results.json', help='Where to write results')
+    parser.add_argument('-c', '--compare', metavar='BASELINE',
+                        help='Earlier results to compare with; exits 1 if anything got slower')
+    parser.add_argument('-t', '--threshold', type=float, default=0.2,
+                        help='Slowdown that counts as a regression (default 0.2, i.e. 20%%)')
+    parser.add_argument('-k', '--keep', action='store_true', help="Don't delete the synthetic trees")
+    parser.add_argument('-v', '--verbose', action='store_true', help='Show ssm_hyak logging')
+    for param in SCALES['small']:
+        if param.endswith('_size'):
+            parser.add_argument(f'--{param.replace("_", "-")}', type=ssm_hyak.parse_size, metavar='BYTES',
+                                help=f'Override {param} of every scale (K/M/G suffixes allowed)')
+        else:
+            parser.add_argument(f'--{param.replace("_", "-")}', type=int, metavar='N',
+                                help=f'Override {param} of every scale')
+    parser.add_argument('--params', metavar='JSON',
+                        help='File of scale parameters to override, e.g. {"jobs": 4}')
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.WARNING)
+
+    if shutil.which('rsync') is None:
+        parser.error('rsync is required')
+    os.environ.setdefault('USER', 'bench')
+
+    overrides = {}
+    if args.params:
+        with open(args.params) as f:
+            overrides.update({param: ssm_hyak.parse_size(v) if param.endswith('_size') else int(v)
+                              for param, v in json.load(f).items()})
+        unknown = set(overrides) - set(SCALES['small'])
+        if unknown:
+            parser.error(f'Unknown scale parameters in {args.params}: {" ".join(sorted(unknown))}')
+    overrides.update({param: getattr(args, param) for param in SCALES['small'] if getattr(args, param) is not None})
+
+    results = []
+    for name in args.scale or ['small', 'medium']:
+        scale = dict(SCALES[name], **overrides)
+        print(f'Running {name} scale...', file=sys.stderr)
+        results += summarize(name, scale, run_scale(scale, args.repeat, args.keep))
+    try:
+        commit = subprocess.run(['git', 'rev-parse', 'HEAD'], capture_output=True, text=True,
+                                cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except OSError:
+        commit = ''
+    with open(args.output, 'w') as f:
+        json.dump({'meta': {'date': time.strftime('%Y-%m-%dT%H:%M:%S'), 'commit': commit,
+                            'python': platform.python_version(), 'host': platform.node()},
+                   'results': results}, f, indent=1)
+    for r in results:
+        print(f'{r["scale"]:<8} {r["phase"]:<16} {r["median"]:8.3f} s')
+    if args.compare:
+        with open(args.compare) as f:
+            if compare(results, json.load(f), args.threshold):
+                sys.exit(1)
+
+if __name__ == '__main__':
+    main()
@@ -7,12 +7,32 @@ import stat
 import hashlib
 import logging
 import glob
+import fnmatch
+import heapq
 from pathlib import Path, PurePosixPath
 from argparse import ArgumentParser, FileType
 from configparser import ConfigParser
 import tempfile
+import io
 import shutil
+import shlex
 import subprocess
+import threading
+import json
+import fcntl
+import contextlib
+import time
+import datetime
+import sqlite3
+import ctypes
+import ctypes.util
+import select
+import signal
+import struct
+import math
+import socket
+import statistics
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 
 import psutil
@@ -26,41 +46,800 @@ def hashit(string):
     logger.debug(f'hash({string}) -> {res}')
     return res
 
+def fortran_value(text):
+    """Convert a run control value to Python: T/F to bool, numbers to int or
+    float, and whitespace-separated vectors to lists"""
+    def convert(tok):
+        if tok.upper() in ('T', '.TRUE.'):
+            return True
+        if tok.upper() in ('F', '.FALSE.'):
+            return False
+        for t in (int, float):
+            try:
+                return t(tok)
+            except ValueError:
+                pass
+        return tok
+    tokens = text.split()
+    if len(tokens) == 1:
+        return convert(tokens[0])
+    return [convert(tok) for tok in tokens]
+
+_control_cache = {}
+_control_cache_lock = threading.Lock()
+
+def _read_cached(path, parse):
+    """Parse a file with parse(path), reusing the result until the file changes"""
+    path = Path(path).absolute()
+    st = os.stat(path)
+    key = (os.fspath(path), parse)
+    stamp = (st.st_mtime_ns, st.st_size)
+    with _control_cache_lock:
+        cached = _control_cache.get(key)
+        if cached is not None and cached[0] == stamp:
+            return cached[1]
+    result = parse(path)
+    with _control_cache_lock:
+        _control_cache[key] = (stamp, result)
+    return result
+
+class RunControl:
+    """A parsed FVCOM-style run control file (NAME = value lines)
+
+    Use RunControl.read(), which only parses a file again when it changes.
+    """
+    def __init__(self, params):
+        # Raw value strings, by name. The first definition of a name wins.
+        self.params = params
+
+    @classmethod
+    def parse(cls, path):
+        params = {}
+        nvre = re.compile(r'\s*=\s*')
+        with open(path) as f:
+            for line in f:
+                # Ignore everything after an exclamation point (comment)
+                # and strip whitespace
+                line = line[:line.find('!')].strip()
+                # Skip empty lines
+                if len(line) == 0:
+                    continue
+                # combine multiline entries continued with two backslashes
+                while line[-2:] == r'\\':
+                    l2 = next(f)
+                    l2 = l2[:l2.find('!')].strip()
+                    l1 = line[:-2].strip()
+                    line = l1 + ' ' + l2
+                pname, pval = nvre.split(line, 2)
+                params.setdefault(pname, pval)
+        return cls(params)
+
+    @classmethod
+    def read(cls, path):
+        return _read_cached(path, cls.parse)
+
+    def get(self, name, dtype=str):
+        """A parameter value converted with dtype, or None if it isn't set"""
+        return dtype(self.params[name]) if name in self.params else None
+
+    def value(self, name):
+        """A parameter value converted by fortran_value, or None if it isn't set"""
+        return self.get(name, fortran_value)
+
+class WqmControl:
+    """A parsed fixed-format WQM control file (wqm_con.npt)
+
+    Values are on the line after a heading line naming them, roughly aligned
+    under the name. Use WqmControl.read(), which only parses a file again
+    when it changes.
+    """
+    def __init__(self, lines):
+        self.lines = lines
+        # Heading name -> [(heading match, value tokens)], in file order
+        self.headings = {}
+        for line, nextline in zip(lines[:-1], lines[1:]):
+            tokens = list(re.finditer(r'\S+', nextline))
+            if len(tokens) == 0:
+                continue
+            for m in re.finditer(r'\S+', line):
+                self.headings.setdefault(m.group(), []).append((m, tokens))
+        self.files = self._find_files()
+
+    @classmethod
+    def parse(cls, path):
+        with open(path) as f:
+            return cls(f.readlines())
+
+    @classmethod
+    def read(cls, path):
+        return _read_cached(path, cls.parse)
+
+    def get(self, name, dtype=float):
+        """A parameter value converted with dtype, or None if it isn't found"""
+        if name not in self.headings:
+            return None
+        h, tokens = self.headings[name][0]
+        # Numbers are right-justified in their fields, so pick the one
+        # ending closest to where the heading ends
+        tok = min(tokens, key=lambda t: abs(t.end() - h.end()))
+        return dtype(tok.group())
+
+    def _find_files(self):
+        """The file names listed under each "... FILE" subheading"""
+        files = []
+        subhead_pattern = re.compile('^[A-Z ]+ FILE[^A-Z]')
+        lines = iter(self.lines)
+        try:
+            for line in lines:
+                if subhead_pattern.match(line):
+                    filecand = next(lines).strip()
+                    while filecand != '':
+                        files.append(filecand)
+                        filecand = next(lines).strip()
+        except StopIteration:
+            pass
+        return files
+
+    def extra_files(self):
+        """Files named in the control file that are not in inputs/ or outputs/"""
+        return [f for f in self.files if f[:7] != 'inputs/' and f[:8] != 'outputs/']
+
+def _parse_linkage(path):
+    return f90nml.read(os.fspath(path))
+
+def read_linkage(path):
+    """The parsed wqm_linkage.in namelist. Shared between callers, so don't modify it"""
+    return _read_cached(path, _parse_linkage)
+
 def get_run_param(runfile, names, dtype=str):
     """Get a parameter value from the run control file"""
-    ret_scalar = not isinstance(names, list)
-    if ret_scalar:
-        names = [names]
-    values = [None] * len(names)
-    found = 0
-    nvre = re.compile(r'\s*=\s*')
+    control = RunControl.read(runfile)
+    if not isinstance(names, list):
+        return control.get(names, dtype)
+    return [control.get(name, dtype) for name in names]
+
+def patch_run_param(runfile, values, dest=None):
+    """Set parameters (name -> value) in a run control file, writing it to dest
+
+    The first definition of each name is changed in place, keeping any
+    comment; names that aren't there are added at the end. dest defaults
+    to runfile itself.
+    """
+    values = dict(values)
+    lines = []
     with open(runfile) as f:
         for line in f:
-            # Ignore everything after an exclamation point (comment)
-            # and strip whitespace
-            line = line[:line.find('!')].strip()
-            # Skip empty lines
-            if len(line) == 0:
+            m = re.match(r'(\s*)([^!=\s]+)(\s*=\s*)([^!\n]*?)(\s*(?:!.*)?\n?)$', line)
+            if m is not None and m.group(2) in values:
+                line = f'{m.group(1)}{m.group(2)}{m.group(3)}{values.pop(m.group(2))}{m.group(5)}'
+            lines.append(line)
+    if len(lines) and not lines[-1].endswith('\n'):
+        lines[-1] += '\n'
+    lines += [f'{name} = {value}\n' for name, value in values.items()]
+    dest = runfile if dest is None else dest
+    with tempfile.NamedTemporaryFile('w', dir=os.path.dirname(os.path.abspath(dest)), delete=False) as f:
+        f.write(''.join(lines))
+    os.replace(f.name, dest)
+
+def get_wqm_param(confile, names, dtype=float):
+    """Get a parameter value from the fixed-format WQM control file (wqm_con.npt)
+
+    Parameters that aren't found are None.
+    """
+    control = WqmControl.read(confile)
+    if not isinstance(names, list):
+        return control.get(names, dtype)
+    return [control.get(name, dtype) for name in names]
+
+def call_process_with_logging(args, cwd=None, tag=None, on_line=None):
+    """Run a process, logging its output. Returns the output lines
+
+    If on_line is given, each output line is passed to it instead of being
+    logged.
+    """
+    pipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=sys.stderr,
+                            cwd=cwd, text=True)
+    lines = []
+    while True:
+        line = pipe.stdout.readline()
+        if not line:
+            pipe.wait()
+            break
+        line = line.strip()
+        lines.append(line)
+        if on_line is not None:
+            on_line(line)
+        else:
+            logger.info(f'{tag}: {line}' if tag is not None else line)
+    if pipe.returncode:
+        raise subprocess.CalledProcessError(pipe.returncode, args)
+    return lines
+
+def scan_files(root, exclude=()):
+    """Map the path (relative to root) of every file under root to its (size, mtime_ns)
+
+    Symbolic links are listed rather than followed. Top-level names in
+    exclude are skipped.
+    """
+    files = {}
+    for dirpath, dirnames, filenames in os.walk(root):
+        if dirpath == os.fspath(root):
+            dirnames[:] = [d for d in dirnames if d not in exclude]
+            filenames = [f for f in filenames if f not in exclude]
+        # os.walk doesn't descend into linked directories, rsync -a copies the link
+        for name in filenames + [d for d in dirnames if os.path.islink(os.path.join(dirpath, d))]:
+            path = os.path.join(dirpath, name)
+            try:
+                st = os.lstat(path)
+            except FileNotFoundError:
                 continue
-            # combine multiline entries continued with two backslashes
-            while line[-2:] == r'\\':
-                l2 = next(f)
-                l2 = l2[:l2.find('!')].strip()
-                l1 = line[:-2].strip()
-                line = l1 + ' ' + l2
-            pname, pval = nvre.split(line, 2)
-            if pname in names:
-                i = names.index(pname)
-                values[i] = dtype(pval)
-                found += 1
-            if found == len(names):
+            files[os.path.relpath(path, root)] = (st.st_size, st.st_mtime_ns)
+    return files
+
+def balance_files(files, n):
+    """Split files (name -> size) into at most n lists with about the same total size"""
+    bins = [(0, i, []) for i in range(max(1, min(n, len(files))))]
+    heapq.heapify(bins)
+    # Largest first onto the emptiest list
+    for name, size in sorted(files.items(), key=lambda f: f[1], reverse=True):
+        total, i, names = heapq.heappop(bins)
+        names.append(name)
+        heapq.heappush(bins, (total + size, i, names))
+    return [sorted(names) for _, _, names in sorted(bins, key=lambda b: b[1]) if len(names)]
+
+def rsync_compress_args(config):
+    """rsync compression options from the rsync_compress and rsync_skip_compress settings
+
+    Files with the suffixes in rsync_skip_compress (NetCDF-4 is already
+    compressed) are sent as is.
+    """
+    if not config_bool(config.get('rsync_compress', True)):
+        return []
+    return ['-z', f"--skip-compress={config.get('rsync_skip_compress', DEFAULT_SKIP_COMPRESS)}"]
+
+# Marks the per-file lines in rsync output that striped_rsync counts for progress
+RSYNC_PROGRESS_PREFIX = '>>> '
+
+def striped_rsync(rsync_args, files, src, dest, streams=1, cwd=None, tag=None, phase='rsync'):
+    """Transfer files with several rsync processes running at the same time
+
+    files maps paths relative to src to their sizes. They are split between
+    up to streams rsync processes of about equal total size, each given its
+    share with --files-from. Progress across all the streams is logged as
+    files complete, and the transfer is recorded as a metrics phase. Returns
+    the number of bytes moved.
+    """
+    if len(files) == 0:
+        return 0
+    total = sum(files.values())
+    done = {'files': 0, 'bytes': 0}
+    lock = threading.Lock()
+    prefix = f'{tag}: ' if tag is not None else ''
+
+    def on_line(line):
+        if not line.startswith(RSYNC_PROGRESS_PREFIX):
+            logger.debug(prefix + line)
+            return
+        name = line[len(RSYNC_PROGRESS_PREFIX):]
+        if name not in files:
+            # A directory
+            return
+        with lock:
+            done['files'] += 1
+            done['bytes'] += files[name]
+            logger.info(f'{prefix}{name} ({done["files"]} files, {format_bytes(done["bytes"])} '
+                        f'transferred of {len(files)}, {format_bytes(total)})')
+
+    def run_stream(names):
+        with tempfile.NamedTemporaryFile('w', prefix='ssm-files-', suffix='.txt') as filelist:
+            filelist.write(''.join(f'{name}\n' for name in names))
+            filelist.flush()
+            args = list(rsync_args) + ['--stats', f'--out-format={RSYNC_PROGRESS_PREFIX}%n',
+                                       f'--files-from={filelist.name}', str(src), str(dest)]
+            return rsync_stats(call_process_with_logging(args, cwd=cwd, on_line=on_line))
+
+    chunks = balance_files(files, streams)
+    with metrics.phase(phase, tag=tag, streams=len(chunks)) as m:
+        if len(chunks) == 1:
+            results = [run_stream(chunks[0])]
+        else:
+            logger.debug(f'{prefix}Transferring {len(files)} files in {len(chunks)} streams')
+            with ThreadPoolExecutor(max_workers=len(chunks)) as pool:
+                results = list(pool.map(run_stream, chunks))
+        m['bytes'] = sum(moved for moved, _ in results)
+        m['files'] = sum(n for _, n in results)
+    return sum(moved for moved, _ in results)
+
+STAGE_MODES = ('copy', 'hardlink', 'reflink', 'symlink-readonly')
+
+# ioctl to share a file's data blocks with another file (Linux, btrfs/XFS)
+FICLONE = 0x40049409
+
+def reflink(src, dst):
+    """Make dst a copy-on-write clone of src, raising OSError if the filesystem can't"""
+    try:
+        with open(src, 'rb') as s, open(dst, 'wb') as d:
+            fcntl.ioctl(d.fileno(), FICLONE, s.fileno())
+    except OSError:
+        with contextlib.suppress(FileNotFoundError):
+            os.unlink(dst)
+        raise
+    shutil.copymode(src, dst)
+
+def stage_file(src, dst, mode='copy'):
+    """Put src at dst for a model run according to a staging mode
+
+    copy: an ordinary copy.
+    hardlink: a hard link to src.
+    reflink: a copy-on-write clone of src.
+    symlink-readonly: a symbolic link to src.
+    Linking is only safe for files the model never modifies. A hardlink or
+    reflink that isn't possible (e.g. src is on another filesystem) falls
+    back to a copy.
+    """
+    if mode == 'hardlink':
+        try:
+            os.link(src, dst)
+            return
+        except OSError as e:
+            logger.debug(f'Could not hardlink {src} ({e}), copying')
+    elif mode == 'reflink':
+        try:
+            reflink(src, dst)
+            return
+        except OSError as e:
+            logger.debug(f'Could not reflink {src} ({e}), copying')
+    elif mode == 'symlink-readonly':
+        os.symlink(os.path.abspath(src), dst)
+        return
+    elif mode != 'copy':
+        raise ValueError(f'Unknown stage_mode {mode}')
+    shutil.copy(src, dst)
+
+def stage_tree(src, dst, mode='copy', workers=None, stage_func=None):
+    """Stage a directory tree like shutil.copytree, with stage_file for each file
+
+    Files are staged in parallel, which mostly helps when they end up being
+    copied. stage_func(src, dst) can be given to stage each file instead.
+    """
+    if stage_func is None:
+        stage_func = lambda s, d: stage_file(s, d, mode)
+    pairs = []
+    for dirpath, _, filenames in os.walk(src, followlinks=True):
+        target = os.path.join(dst, os.path.relpath(dirpath, src))
+        os.makedirs(target, exist_ok=True)
+        pairs += [(os.path.join(dirpath, name), os.path.join(target, name)) for name in filenames]
+    if workers is None:
+        workers = DEFAULT_STAGE_WORKERS
+    with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        list(pool.map(lambda p: stage_func(*p), pairs))
+    return dst
+
+def config_bool(value):
+    """Interpret a configuration value (yes/no, true/false, on/off, 1/0) as a bool"""
+    if isinstance(value, bool):
+        return value
+    return ConfigParser.BOOLEAN_STATES[str(value).lower()]
+
+def rsync_stats(lines):
+    """Total bytes sent and received, and files transferred, according to rsync --stats output"""
+    total = 0
+    files = 0
+    for line in lines:
+        m = re.match(r'Total bytes (sent|received):\s*([\d,]+)', line)
+        if m:
+            total += int(m.group(2).replace(',', ''))
+        m = re.match(r'Number of (?:regular )?files transferred:\s*([\d,]+)', line)
+        if m:
+            files += int(m.group(1).replace(',', ''))
+    return total, files
+
+def parse_size(s):
+    """Parse a byte count with an optional K/M/G/T suffix (powers of 1024)"""
+    s = str(s).strip().upper().rstrip('B').rstrip('I')
+    units = {'K': 1, 'M': 2, 'G': 3, 'T': 4}
+    if len(s) and s[-1] in units:
+        return int(float(s[:-1]) * 1024 ** units[s[-1]])
+    return int(s)
+
+def file_checksum(path, blocksize=8 * 1024 * 1024):
+    """MD5 checksum of a file's contents"""
+    h = hashlib.md5()
+    with open(path, 'rb') as f:
+        while True:
+            block = f.read(blocksize)
+            if not block:
                 break
-    return values[0] if ret_scalar else values
+            h.update(block)
+    return h.hexdigest()
+
+def format_bytes(n):
+    """Human-readable byte count"""
+    for unit in ('B', 'KiB', 'MiB', 'GiB'):
+        if abs(n) < 1024:
+            return f'{n:.1f} {unit}' if unit != 'B' else f'{n} B'
+        n /= 1024
+    return f'{n:.1f} TiB'
+
+class Metrics:
+    """Timing and transfer metrics for each phase of a command
+
+    Off, and close to free, unless configured with the metrics option:
+    "json" appends one JSON object per phase to metrics.jsonl, and
+    "prometheus" writes this run's totals for each phase to a file for the
+    node_exporter textfile collector when flush() is called. Both go in
+    metrics_dir (default REGISTER_STATEDIR/metrics).
+    """
+    FORMATS = ('json', 'prometheus')
+
+    def __init__(self):
+        self.formats = set()
+        self.directory = None
+        self.command = None
+        self._totals = {}
+        self._lock = threading.Lock()
+
+    def configure(self, config, command):
+        self.formats = set(re.split(r'[\s,]+', config.get('metrics', '').strip())) - {''}
+        unknown = self.formats - set(self.FORMATS)
+        if len(unknown):
+            raise ValueError(f'Unknown metrics format(s): {" ".join(sorted(unknown))}')
+        self.directory = Path(config.get('metrics_dir', REGISTER_STATEDIR / 'metrics')).expanduser()
+        self.command = command
+        self._totals = {}
+
+    @property
+    def enabled(self):
+        return len(self.formats) > 0
+
+    @contextlib.contextmanager
+    def phase(self, name, **labels):
+        """Time the enclosed block as phase name
+
+        Yields a dict where the block can put bytes and files counts (or
+        anything else worth recording).
+        """
+        fields = {}
+        if not self.enabled:
+            yield fields
+            return
+        start = time.monotonic()
+        ok = False
+        try:
+            yield fields
+            ok = True
+        finally:
+            self._record(name, time.monotonic() - start, ok, labels, fields)
+
+    def _record(self, name, seconds, ok, labels, fields):
+        entry = {'time': round(time.time(), 3), 'command': self.command, 'phase': name,
+                 'seconds': round(seconds, 6), 'ok': ok, **labels, **fields}
+        with self._lock:
+            totals = self._totals.setdefault(name, {'count': 0, 'failed': 0, 'seconds': 0.0,
+                                                    'bytes': 0, 'files': 0})
+            totals['count'] += 1
+            totals['failed'] += not ok
+            totals['seconds'] += seconds
+            totals['bytes'] += fields.get('bytes', 0)
+            totals['files'] += fields.get('files', 0)
+            if 'json' in self.formats:
+                os.makedirs(self.directory, exist_ok=True)
+                with open(self.directory / 'metrics.jsonl', 'a') as fp:
+                    fp.write(json.dumps(entry, default=str) + '\n')
+
+    def flush(self):
+        """Write the Prometheus textfile with the totals so far"""
+        if 'prometheus' not in self.formats:
+            return
+        series = [('ssm_phase_runs', 'count', 'Times each phase ran'),
+                  ('ssm_phase_failures', 'failed', 'Times each phase failed'),
+                  ('ssm_phase_seconds', 'seconds', 'Time spent in each phase'),
+                  ('ssm_phase_bytes', 'bytes', 'Bytes transferred in each phase'),
+                  ('ssm_phase_files', 'files', 'Files transferred or staged in each phase')]
+        lines = []
+        with self._lock:
+            for metric, key, description in series:
+                lines += [f'# HELP {metric} {description}', f'# TYPE {metric} gauge']
+                for name, totals in sorted(self._totals.items()):
+                    lines.append(f'{metric}{{command="{self.command}",phase="{name}"}} {totals[key]:g}')
+        lines += ['# HELP ssm_last_run_timestamp_seconds When these metrics were written',
+                  '# TYPE ssm_last_run_timestamp_seconds gauge',
+                  f'ssm_last_run_timestamp_seconds{{command="{self.command}"}} {time.time():.0f}']
+        os.makedirs(self.directory, exist_ok=True)
+        path = self.directory / f'ssm_hyak_{self.command}.prom'
+        # The collector must never see a partly written file
+        tmp = path.with_suffix('.tmp')
+        with open(tmp, 'w') as fp:
+            fp.write('\n'.join(lines) + '\n')
+        os.replace(tmp, path)
+
+metrics = Metrics()
 
 DEFAULT_SCRUBDIR = '/gscratch/scrubbed'
 DEFAULT_SCRATCHDIR = '/gscratch/scrubbed'
+DEFAULT_SYNC_WORKERS = 4
+DEFAULT_SYNC_POLL_INTERVAL = 60
+DEFAULT_SYNC_DEBOUNCE = 5
+DEFAULT_SYNC_STATE_KEEP_DAYS = 7
+# Seconds without a heartbeat before a sync process's job leases are stale
+DEFAULT_SYNC_LEASE_TTL = 300
+DEFAULT_JOB_SYNC_INTERVAL = 900
+# With sync_append = tail, bytes at the start of a growing file to send
+# again with each new tail (NetCDF rewrites its record count there)
+DEFAULT_SYNC_APPEND_HEAD = 65536
+DEFAULT_FETCH_TIME = '04:00:00'
+DEFAULT_TRANSFER_STREAMS = 4
+DEFAULT_SKIP_COMPRESS = 'nc/nc4/gz/bz2/xz/zst/zip'
+DEFAULT_STAGE_WORKERS = 8
+# Record of the inputs staged into an instance, for reusing it
+STAGE_MANIFEST = '.ssm_stage.json'
+# Progress of a chained hydro run, in its instance
+CHAIN_STATE = '.ssm_chain.json'
+# Run control parameters and files for chained hydro runs (FVCOM 2.7
+# names); each can be changed with the chain_* option of the same name
+DEFAULT_CHAIN = {'end_param': 'IEND', 'restart_param': 'RESTART', 'restart_value': 'hot_start',
+                 'restart_files': 're_*', 'restart_file': '{inpdir}/{casename}_restart'}
+# Hydro cache entries used more recently than this are never evicted, since
+# a queued or running WQM job may be reading them
+DEFAULT_HYDRO_CACHE_PROTECT_HOURS = 48
+# With hydro_local, where WQM jobs copy the hydro inputs on their node
+DEFAULT_HYDRO_LOCAL_DIR = '/tmp'
+DEFAULT_HYDRO_LOCAL_WORKERS = 4
+# Post-run reduction of NetCDF outputs (the reduce option). Restart files
+# are left alone by default, since the model has to be able to read them.
+REDUCE_MODES = ('no', 'job', 'sync')
+DEFAULT_REDUCE_FILES = '*.nc'
+DEFAULT_REDUCE_EXCLUDE = '*restart*'
+DEFAULT_REDUCE_DEFLATE = 4
+DEFAULT_REDUCE_WORKERS = 4
+# What reduce_outputs names its files while they are written, never synced
+REDUCE_TMP = '.{name}.reduced'
+# Sizing jobs from earlier runs (the autosize option). Stub lines marked
+# with PIN_MARKER are never changed.
+AUTOSIZE_MODES = ('no', 'suggest', 'apply')
+DEFAULT_AUTOSIZE_MIN_RUNS = 3
+DEFAULT_AUTOSIZE_MEM_MARGIN = 0.2
+PIN_MARKER = '!pin'
+
+def get_scrub_path(config, name='scrub_dir'):
+    """The per-user scrub directory named by config option name"""
+    scrubdir = Path(config[name] if name in config else DEFAULT_SCRUBDIR)
+    return scrubdir if os.environ['USER'] in scrubdir.parts else scrubdir / os.environ['USER']
+
+def job_config(job_dir, defaults):
+    """The settings for a job directory: its ssm_hyak.ini (wqm or hydro section) over defaults"""
+    config = ConfigParser()
+    config.read_dict({'DEFAULT': defaults})
+    config.read(str(job_dir / 'ssm_hyak.ini'))
+    return config['wqm' if (job_dir / 'wqm_con.npt').is_file() else 'hydro']
+
+def job_outdir(job_dir):
+    """The output directory of a job: OUTDIR from its run control file, or else OUTPUT or outputs"""
+    for runfile in sorted(job_dir.glob('*_run.dat')):
+        outdir = RunControl.read(runfile).get('OUTDIR')
+        if outdir is not None and (job_dir / outdir).is_dir():
+            return os.path.normpath(outdir)
+    for outdir in ('OUTPUT', 'outputs'):
+        if (job_dir / outdir).is_dir():
+            return outdir
+    return None
+
+def run_period_days(job_dir, casename):
+    """Days of simulation a run covers, or None if unknown
+
+    For WQM that is TMEND - TMSTRT from wqm_con.npt. For FVCOM 2.7 it is IEND
+    internal steps of DTE * ISPLIT seconds, from the run control file.
+    """
+    if (job_dir / 'wqm_con.npt').is_file():
+        tmstrt, tmend = get_wqm_param(job_dir / 'wqm_con.npt', ['TMSTRT', 'TMEND'])
+        return tmend - tmstrt if tmstrt is not None and tmend is not None else None
+    runfile = job_dir / f'{casename}_run.dat'
+    if not runfile.is_file():
+        return None
+    iend, dte, isplit = get_run_param(runfile, ['IEND', 'DTE', 'ISPLIT'], dtype=float)
+    if iend is None or dte is None or isplit is None:
+        return None
+    return iend * dte * isplit / 86400
+
+def suggest_resources(runs, mem_margin=DEFAULT_AUTOSIZE_MEM_MARGIN):
+    """The layout among earlier runs that simulated the most days per core-hour
+
+    runs are dicts as kept by SyncState.record_run. Returns a dict of nodes,
+    tasks_per_node and mem (bytes per node: the peak task memory times the
+    tasks per node, plus mem_margin, or None if unknown), or None if no run
+    is usable.
+    """
+    layouts = {}
+    for r in runs:
+        if r['days'] and r['elapsed'] and r['cpus'] and r['nodes']:
+            layouts.setdefault((r['nodes'], r['cpus'] // r['nodes']), []).append(r)
+    if len(layouts) == 0:
+        return None
+
+    def throughput(layout):
+        return statistics.median(r['days'] / (r['cpus'] * r['elapsed'] / 3600) for r in layouts[layout])
+
+    nodes, tasks_per_node = max(layouts, key=throughput)
+    rss = max(r['max_rss'] or 0 for r in layouts[(nodes, tasks_per_node)])
+    return {'nodes': nodes, 'tasks_per_node': tasks_per_node,
+            'mem': int(rss * tasks_per_node * (1 + mem_margin)) if rss else None}
+
+def netcdf_length(path, dim):
+    """Length of dimension dim of a NetCDF file, or None if it has no such dimension
+
+    Raises ValueError if ncdump can't read the file.
+    """
+    result = subprocess.run(['ncdump', '-h', os.fspath(path)], capture_output=True, text=True)
+    if result.returncode:
+        raise ValueError(f'{os.fspath(path)} is not readable NetCDF: {result.stderr.strip()}')
+    m = re.search(rf'^\s*{re.escape(dim)} = (?:UNLIMITED ; // \((\d+) currently\)|(\d+) ;)',
+                  result.stdout, re.MULTILINE)
+    if m is None:
+        return None
+    return int(m.group(1) or m.group(2))
+
+def reduce_netcdf(src, dst, deflate=DEFAULT_REDUCE_DEFLATE, variables=(), time_stride=1, time_dim='time'):
+    """Write a smaller copy of NetCDF file src to dst
+
+    The copy is NetCDF-4 with deflate and shuffle, has only variables (if
+    any are given, plus their coordinates) and every time_stride'th record.
+    nccopy does the compression alone; subsetting and thinning need ncks
+    (NCO). dst is checked to be readable with the expected number of
+    records; raises ValueError if not.
+    """
+    if len(variables) or time_stride > 1:
+        # NCO shuffles whenever it deflates
+        args = ['ncks', '-O', '-4', '-L', str(deflate)]
+        if len(variables):
+            args += ['-v', ','.join(variables)]
+        if time_stride > 1:
+            args += ['-d', f'{time_dim},,,{time_stride}']
+    else:
+        args = ['nccopy', '-k', 'nc4', '-d', str(deflate), '-s']
+    call_process_with_logging(args + [os.fspath(src), os.fspath(dst)])
+    records = netcdf_length(src, time_dim)
+    reduced = netcdf_length(dst, time_dim)
+    if records is not None and reduced != -(-records // time_stride):
+        raise ValueError(f'{os.fspath(dst)} has {reduced} records of {time_dim}, '
+                         f'expected {-(-records // time_stride)}')
+
+def reduce_outputs(outdir, config, tag=None):
+    """Reduce the NetCDF files in outdir in place, as set by the reduce_* options
+
+    Files matching reduce_files but not reduce_exclude are rewritten with
+    reduce_netcdf, reduce_workers at a time, and only replaced once the
+    result checks out. Files that fail are left as they were. Returns the
+    number of bytes saved.
+    """
+    outdir = Path(outdir)
+    patterns = config.get('reduce_files', DEFAULT_REDUCE_FILES).split()
+    exclude = config.get('reduce_exclude', DEFAULT_REDUCE_EXCLUDE).split()
+    names = sorted({p.name for pattern in patterns for p in outdir.glob(pattern)
+                    if p.is_file() and not any(fnmatch.fnmatch(p.name, x) for x in exclude)})
+    deflate = int(config.get('reduce_deflate', DEFAULT_REDUCE_DEFLATE))
+    variables = config.get('reduce_variables', '').replace(',', ' ').split()
+    stride = int(config.get('reduce_time_stride', 1))
+    time_dim = config.get('reduce_time_dim', 'time')
+    prefix = f'{tag}: ' if tag is not None else ''
+
+    def reduce_one(name):
+        path = outdir / name
+        tmp = outdir / REDUCE_TMP.format(name=name)
+        try:
+            before = path.stat().st_size
+            reduce_netcdf(path, tmp, deflate, variables, stride, time_dim)
+            after = tmp.stat().st_size
+            if after >= before and len(variables) == 0 and stride == 1:
+                logger.info(f'{prefix}{name} is no smaller compressed, keeping it')
+                return 0
+            os.replace(tmp, path)
+            logger.info(f'{prefix}Reduced {name} from {format_bytes(before)} to {format_bytes(after)}')
+            return before - after
+        except (OSError, ValueError, subprocess.CalledProcessError) as e:
+            logger.warning(f'{prefix}Leaving {name} as it is, reduction failed: {e}')
+            return None
+        finally:
+            if tmp.exists():
+                tmp.unlink()
+
+    workers = int(config.get('reduce_workers', DEFAULT_REDUCE_WORKERS))
+    with metrics.phase('reduce', tag=tag) as m, ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+        results = list(pool.map(reduce_one, names))
+        m['files'] = sum(r is not None for r in results)
+        m['saved'] = sum(r for r in results if r)
+    logger.info(f'{prefix}Reduced {m["files"]} of {len(names)} output files, saving {format_bytes(m["saved"])}')
+    return m['saved']
+
+# SLURM job states, as reported by squeue/sacct, that determine how a
+# registered job is synced. Anything else (COMPLETED, FAILED, TIMEOUT,
+# CANCELLED...) means the job is over and gets its final sync.
+SLURM_PENDING_STATES = {'PENDING', 'REQUEUED', 'REQUEUE_HOLD', 'REQUEUE_FED',
+                        'RESV_DEL_HOLD', 'SPECIAL_EXIT'}
+SLURM_ACTIVE_STATES = {'RUNNING', 'COMPLETING', 'CONFIGURING', 'RESIZING',
+                       'SIGNALING', 'STAGE_OUT', 'STOPPED', 'SUSPENDED'}
 
 REGISTER_STATEDIR = Path(os.environ['HOME']) / '.local' / 'state' / 'ssm'
+# Settings files, later ones overriding earlier ones
+CONFIG_FILES = [f"{os.environ['HOME']}/.config/ssm_hyak/ssm_hyak.ini", 'ssm_hyak.ini']
+
+def job_accounting(jobid):
+    """Resource use of a finished job from sacct, or None if sacct doesn't know it
+
+    Returns a dict of elapsed (seconds), nodes, cpus and max_rss (the peak
+    memory of any one task, in bytes, or None).
+    """
+    result = subprocess.run(['sacct', '--noheader', '--parsable2', '--format=JobIDRaw,ElapsedRaw,NNodes,AllocCPUS,MaxRSS',
+                             f'--jobs={jobid}'], capture_output=True, text=True)
+    if result.returncode:
+        logger.warning(f'sacct failed for {jobid}: {result.stderr.strip()}')
+        return None
+    acct = None
+    rss = []
+    for line in result.stdout.splitlines():
+        fields = line.split('|')
+        if len(fields) < 5:
+            continue
+        if '.' not in fields[0] and acct is None:
+            # The allocation; steps are e.g. 1234.batch, 1234.0
+            acct = {'elapsed': float(fields[1] or 0), 'nodes': int(fields[2] or 0), 'cpus': int(fields[3] or 0)}
+        if len(fields[4]):
+            rss.append(parse_size(fields[4]))
+    if acct is not None:
+        acct['max_rss'] = max(rss) if len(rss) else None
+    return acct
+
+def query_job_states(jobids):
+    """Look up the states of many jobs with a single squeue (and sacct) call
+
+    Returns a dict of job ID -> state. Jobs SLURM no longer knows about
+    are left out. If squeue itself fails every job is reported as
+    UNKNOWN, so nothing is mistaken for finished.
+    """
+    with metrics.phase('squeue', jobs=len(jobids)):
+        return _query_job_states(jobids)
+
+def _query_job_states(jobids):
+    states = {}
+    if len(jobids) == 0:
+        return states
+    joblist = ','.join(jobids)
+    try:
+        # %A is the unique ID of each job (including array tasks), %i is
+        # how it was submitted (e.g. 1234_5 for array tasks). --array lists
+        # pending array tasks one per line instead of as 1234_[5-9]
+        result = subprocess.run(['squeue','--noheader','--array','--format=%A %i %T',f'--jobs={joblist}'],
+                                capture_output=True, text=True)
+    except OSError as e:
+        result = subprocess.CompletedProcess(e.filename, 1, '', str(e))
+    # squeue exits with an error when none of the jobs are in the queue
+    if result.returncode and 'Invalid job id' not in result.stderr:
+        logger.warning(f'squeue failed, assuming all jobs are still active: {result.stderr.strip()}')
+        return {jobid: 'UNKNOWN' for jobid in jobids}
+    for line in result.stdout.splitlines():
+        fields = line.split()
+        for jobid in fields[:-1]:
+            states[jobid] = fields[-1]
+    # Recently finished jobs are gone from squeue but sacct can say how
+    # they ended
+    missing = [jobid for jobid in jobids if jobid not in states]
+    if len(missing):
+        try:
+            result = subprocess.run(['sacct','--noheader','--parsable2','--allocations',
+                                     '--format=JobIDRaw,JobID,State',f'--jobs={",".join(missing)}'],
+                                    capture_output=True, text=True)
+        except OSError as e:
+            result = subprocess.CompletedProcess(e.filename, 1, '', str(e))
+        if result.returncode:
+            logger.debug(f'sacct failed: {result.stderr.strip()}')
+        else:
+            for line in result.stdout.splitlines():
+                fields = line.split('|')
+                for jobid in fields[:-1]:
+                    if jobid in missing and len(fields[-1]):
+                        # e.g. "CANCELLED by 12345"
+                        states[jobid] = fields[-1].split()[0]
+    logger.debug(f'Job states: {states}')
+    return states
 
 @dataclass(frozen=True)
 class RemotePath():
@@ -111,24 +890,416 @@ class RemotePath():
     def parent(self):
         return RemotePath(self.host, self.path.parent)
 
+class SshMultiplexer:
+    """Shares one SSH ControlMaster connection per remote host
+
+    Use this as a context manager around a whole sync pass or job setup so
+    every ssh and rsync call to a host reuses the same authenticated
+    connection. The master connections are shut down on exit. When disabled,
+    the ssh/rsync arguments are returned unchanged.
+    """
+    def __init__(self, enabled=True):
+        self.enabled = enabled
+        self.sockdir = None
+        self.hosts = set()
+        self._lock = threading.Lock()
+
+    def __enter__(self):
+        if self.enabled:
+            # Keep this short, sockets have a ~100 character path limit
+            self.sockdir = tempfile.mkdtemp(prefix='ssm-ssh-')
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    @property
+    def _control_path(self):
+        return f'ControlPath={self.sockdir}/%C'
+
+    @property
+    def options(self):
+        """ssh options that use the shared connection"""
+        if self.sockdir is None:
+            return []
+        # If the master failed to start ssh just connects normally
+        return ['-o', self._control_path, '-o', 'ControlMaster=no']
+
+    def open(self, host):
+        """Start the master connection to host if it isn't running already"""
+        if self.sockdir is None or host is None:
+            return
+        with self._lock:
+            if host in self.hosts:
+                return
+            logger.debug(f'Opening shared SSH connection to {host}')
+            result = subprocess.run(['ssh', '-o', self._control_path, '-o', 'ControlMaster=yes',
+                                     '-o', 'ControlPersist=yes', '-f', '-N', host],
+                                    stdin=subprocess.DEVNULL, stderr=sys.stderr)
+            if result.returncode:
+                logger.warning(f'Could not open shared SSH connection to {host}')
+            self.hosts.add(host)
+
+    def ssh(self, host, *command):
+        """Arguments to run command on host over the shared connection"""
+        self.open(host)
+        return ['ssh'] + self.options + [host] + list(command)
+
+    def rsync_args(self, *paths):
+        """rsync arguments that make transfers to or from paths use the shared connection"""
+        for p in paths:
+            if isinstance(p, RemotePath) and p.is_remote:
+                self.open(p.host)
+        if self.sockdir is None:
+            return []
+        return ['-e', shlex.join(['ssh'] + self.options)]
+
+    def close(self):
+        if self.sockdir is None:
+            return
+        for host in self.hosts:
+            subprocess.run(['ssh', '-o', self._control_path, '-O', 'exit', host],
+                           capture_output=True)
+        self.hosts.clear()
+        shutil.rmtree(self.sockdir, ignore_errors=True)
+        self.sockdir = None
+
+class HydroCache:
+    """Index of the hydrodynamic results fetched into local scratch
+
+    The index is a JSON file in the cache root mapping each (resolved) remote
+    source to its local directory. For every file it records the size, mtime
+    and, once one has been needed, a checksum. It also keeps the time each
+    entry was last used. Identical files in different entries are hardlinked
+    together, and least recently used entries can be evicted to stay under a
+    byte quota.
+    """
+    def __init__(self, root: Path):
+        self.root = Path(root)
+        self.index_path = self.root / 'index.json'
+        self.entries = {}
+
+    @contextlib.contextmanager
+    def locked(self):
+        """Hold an exclusive lock on the index while loading and saving it"""
+        os.makedirs(self.root, exist_ok=True)
+        with open(self.root / 'index.lock', 'w') as lf:
+            fcntl.flock(lf, fcntl.LOCK_EX)
+            try:
+                self._load()
+                yield self
+                self._save()
+            finally:
+                fcntl.flock(lf, fcntl.LOCK_UN)
+
+    def _load(self):
+        if self.index_path.is_file():
+            with open(self.index_path) as f:
+                self.entries = json.load(f)
+        else:
+            self.entries = {}
+
+    def _save(self):
+        tmp = self.index_path.with_suffix('.tmp')
+        with open(tmp, 'w') as f:
+            json.dump(self.entries, f, indent=1)
+        os.replace(tmp, self.index_path)
+
+    def lookup(self, key):
+        """The local directory for a source, or None if it isn't cached"""
+        entry = self.entries.get(key)
+        return Path(entry['dir']) if entry is not None else None
+
+    def is_current(self, key, manifest):
+        """Whether the cached copy matches a fresh remote listing
+
+        manifest maps file name -> [size, mtime] as returned by
+        HyakSetupHelper._remote_listing, possibly narrowed down to the files a
+        run needs. Every file must be in the manifest saved after the last
+        successful transfer, with the same size and mtime, and still be on
+        disk.
+        """
+        entry = self.entries.get(key)
+        if entry is None or entry.get('manifest') is None:
+            return False
+        saved = entry['manifest']
+        if any(saved.get(name) != value for name, value in manifest.items()):
+            return False
+        d = Path(entry['dir'])
+        for name, (size, mtime) in manifest.items():
+            try:
+                st = (d / name).stat()
+            except FileNotFoundError:
+                return False
+            if st.st_size != size or int(st.st_mtime) != mtime:
+                return False
+        return True
+
+    def seed(self, dest: Path, manifest):
+        """Hardlink files listed in manifest into dest from other entries that already have them
+
+        rsync then sees these files as up to date and skips them. Returns the
+        number of files linked.
+        """
+        linked = 0
+        for name, (size, mtime) in manifest.items():
+            if (dest / name).exists():
+                continue
+            for entry in self.entries.values():
+                info = entry['files'].get(name)
+                if entry['dir'] == os.fspath(dest) or info is None or [info['size'], info['mtime']] != [size, mtime]:
+                    continue
+                src = Path(entry['dir']) / name
+                try:
+                    st = src.stat()
+                    if st.st_size != size or int(st.st_mtime) != mtime:
+                        continue
+                    os.link(src, dest / name)
+                except OSError:
+                    continue
+                logger.debug(f'Reusing {src} for {dest / name}')
+                linked += 1
+                break
+        return linked
+
+    def record(self, key, source, dest: Path, manifest=None):
+        """Add or refresh the entry for source after its files have been fetched to dest
+
+        manifest is the remote listing the transfer was based on, if there is
+        one. Only the files in it that are now on disk unchanged are kept in
+        the saved manifest.
+        """
+        entry = self.entries.get(key, {'files': {}})
+        old_files = entry['files']
+        files = {}
+        for p in sorted(dest.iterdir()):
+            if not p.is_file():
+                continue
+            st = p.stat()
+            info = {'size': st.st_size, 'mtime': int(st.st_mtime)}
+            old = old_files.get(p.name)
+            if old is not None and 'md5' in old and old['size'] == info['size'] and old['mtime'] == info['mtime']:
+                info['md5'] = old['md5']
+            files[p.name] = info
+        if manifest is not None:
+            manifest = {name: value for name, value in manifest.items()
+                        if name in files and [files[name]['size'], files[name]['mtime']] == value}
+        entry.update({'source': str(source), 'dir': os.fspath(dest), 'files': files,
+                      'manifest': manifest, 'last_used': time.time()})
+        self.entries[key] = entry
+        self._dedupe(key)
+
+    def touch(self, key):
+        self.entries[key]['last_used'] = time.time()
+
+    def _checksum(self, entry, name):
+        info = entry['files'][name]
+        if 'md5' not in info:
+            info['md5'] = file_checksum(Path(entry['dir']) / name)
+        return info['md5']
+
+    def _dedupe(self, key):
+        """Replace files in an entry with hardlinks to identical files in other entries"""
+        entry = self.entries[key]
+        for name, info in entry['files'].items():
+            path = Path(entry['dir']) / name
+            st = path.stat()
+            for okey, other in self.entries.items():
+                if okey == key:
+                    continue
+                oinfo = other['files'].get(name)
+                if oinfo is None or oinfo['size'] != info['size'] or oinfo['mtime'] != info['mtime']:
+                    continue
+                opath = Path(other['dir']) / name
+                try:
+                    ost = opath.stat()
+                except FileNotFoundError:
+                    continue
+                if (ost.st_dev, ost.st_ino) == (st.st_dev, st.st_ino):
+                    # Already shared
+                    break
+                if ost.st_dev != st.st_dev or self._checksum(entry, name) != self._checksum(other, name):
+                    continue
+                logger.debug(f'Hardlinking {path} to identical {opath}')
+                tmp = path.with_name(f'.{name}.link')
+                os.link(opath, tmp)
+                os.replace(tmp, path)
+                break
+
+    def _inodes(self, entry):
+        """Map (device, inode) -> size for the files an entry still has"""
+        inodes = {}
+        for name in entry['files']:
+            try:
+                st = (Path(entry['dir']) / name).stat()
+            except FileNotFoundError:
+                continue
+            inodes[(st.st_dev, st.st_ino)] = st.st_size
+        return inodes
+
+    def total_bytes(self):
+        """Disk space used by the cache, counting shared files once"""
+        inodes = {}
+        for entry in self.entries.values():
+            inodes.update(self._inodes(entry))
+        return sum(inodes.values())
+
+    def prune(self):
+        """Drop index entries and files that no longer exist on disk. Returns the removed keys"""
+        removed = []
+        for key, entry in list(self.entries.items()):
+            d = Path(entry['dir'])
+            if not d.is_dir():
+                removed.append(key)
+                del self.entries[key]
+                continue
+            entry['files'] = {name: info for name, info in entry['files'].items()
+                              if (d / name).is_file()}
+        return removed
+
+    def evict(self, quota, protect_hours=DEFAULT_HYDRO_CACHE_PROTECT_HOURS):
+        """Remove least recently used entries until the cache fits in quota bytes
+
+        Returns the evicted keys.
+        """
+        evicted = []
+        cutoff = time.time() - protect_hours * 3600
+        for key, entry in sorted(self.entries.items(), key=lambda e: e[1]['last_used']):
+            if self.total_bytes() <= quota:
+                break
+            if entry['last_used'] > cutoff:
+                logger.warning(f'Not evicting recently used {entry["source"]}')
+                continue
+            logger.info(f'Evicting {entry["source"]} from {entry["dir"]}')
+            shutil.rmtree(entry['dir'], ignore_errors=True)
+            del self.entries[key]
+            evicted.append(key)
+        return evicted
+
+class CacheHelper:
+    """Class to inspect and maintain the local hydro result cache"""
+    def __init__(self, _, **config):
+        self.config = config
+        self.action = 'list'
+        self.quota = None
+        self.cache = HydroCache(get_scrub_path(config) / 'hyd_results')
+
+    def run(self):
+        with self.cache.locked() as cache:
+            if self.action == 'prune':
+                removed = cache.prune()
+                logger.info(f'Pruned {len(removed)} missing entries')
+            elif self.action == 'evict':
+                quota = self.quota if self.quota is not None else self.config.get('hydro_cache_quota')
+                if quota is None:
+                    raise ValueError('No quota given; use --quota or set hydro_cache_quota')
+                cache.prune()
+                protect = float(self.config.get('hydro_cache_protect_hours', DEFAULT_HYDRO_CACHE_PROTECT_HOURS))
+                evicted = cache.evict(parse_size(quota), protect)
+                logger.info(f'Evicted {len(evicted)} entries')
+            elif self.action != 'list':
+                raise ValueError(f'Unknown cache action {self.action}')
+            for entry in sorted(cache.entries.values(), key=lambda e: e['last_used'], reverse=True):
+                used = datetime.datetime.fromtimestamp(entry['last_used']).strftime('%Y-%m-%d %H:%M')
+                size = sum(cache._inodes(entry).values())
+                print(f'{used}  {format_bytes(size):>10}  {entry["source"]} -> {entry["dir"]}')
+            print(f'Total: {format_bytes(cache.total_bytes())}')
+
 class HyakSetupHelper:
-    def __init__(self, method, casename, mpi_bin, save_root=None,
+    def __init__(self, method, casename, mpi_bin, save_root=None, home=None,
                  **config):
         self.method = method
         self.config = config
         self.casename = casename
         self.mpi_bin = mpi_bin
         self.save_root = RemotePath.from_string(save_root) if save_root is not None else None
-        self.home = Path(os.getcwd()).resolve()
+        self.home = Path(home if home is not None else os.getcwd()).resolve()
         self.test = False
+        self.async_fetch = False
+        self.release = None
+        self.after = None
+        self.quick = None
+        self.reuse = config_bool(config.get('stage_reuse', False))
+        self.instance = None
+        self.staged = {}
+        self.old_staged = {}
+        # (shared hydro directory, node-local directory, files to copy or None for all)
+        self.hydro_local = None
+        self.ssh = SshMultiplexer(False)
 
     def _get_scrub_path(self, name='scrub_dir'):
-        scrubdir = Path(self.config[name] if name in self.config else DEFAULT_SCRUBDIR)
-        return scrubdir if os.environ['USER'] in scrubdir.parts else scrubdir / os.environ['USER']
+        return get_scrub_path(self.config, name)
+
+    def _stage_file(self, src, dst):
+        """Stage one input file, unless the same file was staged there before
+
+        Files are compared by size, mtime and source path; checksumming large
+        inputs would cost as much as copying them.
+        """
+        st = os.stat(src)
+        key = os.path.relpath(dst, self.instance)
+        signature = [st.st_size, st.st_mtime_ns, os.path.abspath(src)]
+        self.staged[key] = signature
+        if self.old_staged.get(key) == signature and os.path.lexists(dst):
+            return
+        if os.path.lexists(dst):
+            # Never write through a link to the original
+            os.unlink(dst)
+        stage_file(src, dst, self.config.get('stage_mode', 'copy'))
+
+    def _stage_tree(self, src, dst):
+        return stage_tree(src, dst, workers=int(self.config.get('stage_workers', DEFAULT_STAGE_WORKERS)),
+                          stage_func=self._stage_file)
+
+    def _finish_staging(self, stats=None):
+        """Remove inputs left over from an earlier staging and save the stage manifest
+
+        Counts of the staged files and bytes are put in the stats dict, if given.
+        """
+        stale = [key for key in self.old_staged if key not in self.staged]
+        for key in stale:
+            with contextlib.suppress(FileNotFoundError):
+                os.unlink(self.instance / key)
+        if len(self.old_staged):
+            changed = sum(1 for key, sig in self.staged.items() if self.old_staged.get(key) != sig)
+            logger.info(f'Restaged {changed} changed and removed {len(stale)} old input files')
+        with open(self.instance / STAGE_MANIFEST, 'w') as fp:
+            json.dump(self.staged, fp)
+        if stats is not None:
+            stats['files'] = len(self.staged)
+            stats['bytes'] = sum(sig[0] for sig in self.staged.values())
+
+    def _instance_record(self):
+        """State file that remembers the instance last staged for this run directory"""
+        return REGISTER_STATEDIR / 'instances' / f'{hashit(os.fspath(self.home))}.instance'
+
+    def _register_instance(self, inst_path, jobid):
+        """Record which instance and job belong to this run directory"""
+        rec = self._instance_record()
+        os.makedirs(rec.parent, exist_ok=True)
+        with open(rec, 'w') as fp:
+            fp.write(f'{inst_path}\n{jobid or ""}\n{self.home}\n')
+
+    def _reusable_instance(self, scrub_path):
+        """The instance staged by the last submission from this directory, if it can be reused"""
+        rec = self._instance_record()
+        if not rec.is_file():
+            return None
+        with open(rec) as fp:
+            inst_path, jobid = [next(fp).rstrip('\n') for _ in range(2)]
+        inst_path = Path(inst_path)
+        if inst_path.parent != scrub_path or not (inst_path / STAGE_MANIFEST).is_file():
+            return None
+        if jobid:
+            state = query_job_states([jobid]).get(jobid)
+            if state in SLURM_PENDING_STATES or state in SLURM_ACTIVE_STATES or state == 'UNKNOWN':
+                logger.info(f'Instance {inst_path} is in use by job {jobid} ({state}), not reusing it')
+                return None
+        return inst_path
 
     def _stage(self, outdir, stagename):
         """Set up staging directories so the model can run from a different location"""
-        instance_root = Path.cwd()
+        instance_root = self.home
         run_root = Path(self.config['run_root']) if 'run_root' in self.config else instance_root
         save_root = RemotePath(None, run_root) if self.save_root is None else self.save_root
         scrub_path = self._get_scrub_path('scrub_dir_out')
@@ -140,72 +1311,304 @@ class HyakSetupHelper:
         else:
             out_path = save_root / run_tail
         os.makedirs(out_path, exist_ok=True)
-        outdir_path = Path(outdir).absolute()
+        outdir_path = instance_root / outdir
         if out_path != outdir_path:
             if outdir_path.is_symlink():
                 os.unlink(outdir_path)
             elif outdir_path.is_dir():
                 shutil.rmtree(outdir_path)
-            os.symlink(out_path, outdir)
-        # Don't delete the temporary directory ourselves!
-        inst_dir = tempfile.mkdtemp(dir=scrub_path)
-        inst_path = Path(inst_dir)
+            os.symlink(out_path, outdir_path)
+        inst_path = self._reusable_instance(scrub_path) if self.reuse else None
+        if inst_path is None:
+            # Don't delete the temporary directory ourselves!
+            inst_dir = tempfile.mkdtemp(dir=scrub_path)
+            inst_path = Path(inst_dir)
+            self.old_staged = {}
+        else:
+            logger.info(f'Reusing instance {inst_path}')
+            with open(inst_path / STAGE_MANIFEST) as fp:
+                self.old_staged = json.load(fp)
+            if (inst_path / outdir).is_symlink():
+                os.unlink(inst_path / outdir)
         os.symlink(out_path, inst_path / outdir)
+        self.instance = inst_path
+        self.staged = {}
 
         return inst_path
 
-    def _write_job_file(self, fp, stubfile):
+    def _write_job_header(self, fp, stubfile, sbatch_args=[]):
+        """Write the sbatch options from a stub (plus any sbatch_args) and module setup"""
         fp.write('#!/bin/bash\n')
         fp.write('# Auto-generated sbatch file from a stub\n')
         fp.write('#\n')
         with open(stubfile) as s:
-            for l in s:
-                fp.write(f'#{l}')
+            lines = s.readlines()
+        option = re.compile(r'\s*SBATCH\s+(--[\w-]+|-\w)')
+        pinned = {m.group(1) for l in lines if PIN_MARKER in l and (m := option.match(l))}
+        sized = self._autosize(pinned)
+        for l in lines:
+            m = option.match(l)
+            if m is not None and m.group(1) in sized:
+                # Left in as a comment
+                fp.write(f'##{l}')
+            else:
+                fp.write('#' + re.sub(rf'\s*{re.escape(PIN_MARKER)}', '', l))
+        for arg in sized.values():
+            if arg is not None:
+                fp.write(f'#SBATCH {arg}\n')
+        for arg in sbatch_args:
+            fp.write(f'#SBATCH {arg}\n')
         fp.write('module purge\n')
         if 'modules' in self.config:
             for m in self.config['modules'].split():
                 fp.write(f"module load {m}\n")
+
+    def _autosize(self, pinned=()):
+        """sbatch options to replace stub lines with, sized from earlier runs like this one
+
+        Returns a dict of each stub option replaced -> the new sbatch
+        argument (or None where it is just dropped). With autosize =
+        suggest, the sizes are only logged. Options in pinned (the task
+        layout as a whole, or the memory) are kept.
+        """
+        mode = self.config.get('autosize', 'no')
+        if mode not in AUTOSIZE_MODES:
+            raise ValueError(f'Unknown autosize {mode}')
+        if mode == 'no':
+            return {}
+        os.makedirs(REGISTER_STATEDIR, exist_ok=True)
+        with contextlib.closing(SyncState(REGISTER_STATEDIR / 'sync.db')) as state:
+            runs = state.runs(self.method, self.casename)
+        min_runs = int(self.config.get('autosize_min_runs', DEFAULT_AUTOSIZE_MIN_RUNS))
+        best = suggest_resources(runs, float(self.config.get('autosize_mem_margin', DEFAULT_AUTOSIZE_MEM_MARGIN)))
+        if len(runs) < min_runs or best is None:
+            logger.info(f'Only {len(runs)} earlier {self.method} runs of {self.casename} recorded, not sizing the job')
+            return {}
+        sized = {}
+        layout = ('--nodes', '-N', '--ntasks-per-node', '--ntasks', '-n')
+        if any(o in pinned for o in layout):
+            logger.info('Task layout is pinned in the stub')
+        else:
+            args = [f'--nodes={best["nodes"]}', f'--ntasks-per-node={best["tasks_per_node"]}']
+            sized.update({o: None for o in layout})
+            sized['--nodes'], sized['--ntasks-per-node'] = args
+        if best['mem'] is not None:
+            if any(o in pinned for o in ('--mem', '--mem-per-cpu')):
+                logger.info('Memory is pinned in the stub')
+            else:
+                sized.update({'--mem-per-cpu': None, '--mem': f'--mem={math.ceil(best["mem"] / 1024 ** 3)}G'})
+        logger.info(f'Best throughput of {len(runs)} earlier runs: '
+                    + ' '.join(arg for arg in sized.values() if arg is not None))
+        if mode == 'suggest':
+            return {}
+        return sized
+
+    def _write_job_body(self, fp):
+        """Write the commands that register and run the model"""
         if self.save_root is not None and self.save_root.is_remote:
+            job_sync = config_bool(self.config.get('job_sync', False))
             # Have the sbatch file register the job
-            fp.write(f'echo "{self.home}" > "{REGISTER_STATEDIR}/$SLURM_JOB_ID.job"\n')
+            jobfile = f'{REGISTER_STATEDIR}/$SLURM_JOB_ID.job'
+            fp.write(f'echo "{self.home}" > "{jobfile}"\n')
+            if 'chain_steps' in self.config:
+                # Segments of a chained run carry on from the previous one's sync state
+                fp.write(f'[ -n "$SSM_PREVIOUS_JOB" ] && echo "previous=$SSM_PREVIOUS_JOB" >> "{jobfile}"\n')
+            if job_sync:
+                # Outputs are synced from the compute node while the model
+                # runs; login node syncs leave the job alone until it ends
+                interval = self.config.get('job_sync_interval', DEFAULT_JOB_SYNC_INTERVAL)
+                fp.write(f'echo "job_sync=1" >> "{jobfile}"\n')
+                sync = (f'cd {shlex.quote(os.fspath(self.home))} && '
+                        f'exec {shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} '
+                        f'sync --job "$SLURM_JOB_ID"')
+                fp.write(f'ssm_sync() {{ ({sync} "$@"); }}\n')
+                # Not through the function, which would add a subshell: $!
+                # must be the sync process itself for the trap to stop it
+                fp.write(f'({sync} --loop {interval}) &\n')
+                fp.write('SSM_SYNC_PID=$!\n')
+                # A final flush once the script is done, including anything
+                # run after the model
+                fp.write("trap 'kill $SSM_SYNC_PID 2>/dev/null; wait $SSM_SYNC_PID; ssm_sync --final' EXIT\n")
+        if self.hydro_local is not None:
+            self._write_hydro_stage_in(fp)
         fp.write(f"time mpirun -np $SLURM_NTASKS {self.mpi_bin} {self.casename}\n")
+        if self.hydro_local is not None:
+            # Stop any copies still going and free the node's disk
+            fp.write('[ -n "$SSM_HYDRO_PID" ] && kill -- -$SSM_HYDRO_PID 2>/dev/null\n')
+            fp.write('rm -rf "$SSM_HYDRO"\n')
+        reduce = self.config.get('reduce', 'no')
+        if reduce not in REDUCE_MODES:
+            raise ValueError(f'Unknown reduce {reduce}')
+        if reduce == 'job':
+            fp.write(f'(cd {shlex.quote(os.fspath(self.home))} && '
+                     f'{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} reduce)\n')
 
-    def run(self):
-        if self.method == 'hydro':
-            return self.setup_hydro()
-        elif self.method == 'wqm':
-            return self.setup_wqm()
+    def _write_hydro_stage_in(self, fp):
+        """Write the commands that move the hydro inputs onto node-local storage
+
+        Every shared file is linked there first, so the model can start at
+        once. The links are then replaced by local copies, several at a time
+        in the order the files are read, each renamed into place when
+        complete. If the job has more than one node, whose other nodes
+        couldn't see this one's storage, or the local directory can't be
+        made, the linkage file pointing at the shared copy is used instead.
+        """
+        shared, local, names = self.hydro_local
+        workers = int(self.config.get('hydro_local_workers', DEFAULT_HYDRO_LOCAL_WORKERS))
+        fp.write(f'export SSM_HYDRO={shlex.quote(os.fspath(local))}\n')
+        fp.write(f'export SSM_HYDRO_SRC={shlex.quote(os.fspath(shared))}\n')
+        fp.write('ssm_hydro_copy() { [ -f "$SSM_HYDRO_SRC/$1" ] && cp "$SSM_HYDRO_SRC/$1" "$SSM_HYDRO/.$1.part" && '
+                 'mv -f "$SSM_HYDRO/.$1.part" "$SSM_HYDRO/$1"; }\n')
+        fp.write('export -f ssm_hydro_copy\n')
+        fp.write('if [ "${SLURM_JOB_NUM_NODES:-1}" -gt 1 ]; then\n')
+        fp.write('    echo "Multi-node job, reading the shared hydro results" >&2\n')
+        fp.write('    cp wqm_linkage.shared.in wqm_linkage.in\n')
+        fp.write('elif mkdir -p "$SSM_HYDRO"; then\n')
+        fp.write('    for f in "$SSM_HYDRO_SRC"/*.nc; do ln -sfn "$f" "$SSM_HYDRO/"; done\n')
+        if names is None:
+            fp.write('    (cd "$SSM_HYDRO_SRC" && printf \'%s\\n\' *.nc) | ')
         else:
+            fp.write(f"    printf '%s\\n' {' '.join(shlex.quote(n) for n in names)} | ")
+        # In its own process group, so it can be stopped as a whole
+        fp.write(f'setsid xargs -n 1 -P {workers} bash -c \'ssm_hydro_copy "$0"\' &\n')
+        fp.write('    SSM_HYDRO_PID=$!\n')
+        fp.write('else\n')
+        fp.write('    cp wqm_linkage.shared.in wqm_linkage.in\n')
+        fp.write('fi\n')
+
+    def _write_job_file(self, fp, stubfile):
+        self._write_job_header(fp, stubfile)
+        self._write_job_body(fp)
+
+    def run(self):
+        if self.method not in ('hydro', 'wqm', 'fetch', 'chain'):
             raise ValueError(f'Unknown method {self.method}')
+        with SshMultiplexer(config_bool(self.config.get('ssh_multiplex', True))) as self.ssh:
+            if self.method == 'hydro':
+                return self.setup_hydro()
+            elif self.method == 'wqm':
+                return self.setup_wqm()
+            elif self.method == 'chain':
+                return self.chain_hydro()
+            else:
+                return self.fetch_hydro()
 
-    def _invoke_sbatch(self, pth, scr):
+    def _invoke_sbatch(self, pth, scr, extra_args=[], output=None):
+        """Submit a job script. Returns the job ID, or None in test mode"""
+        if output is None:
+            output = self.home / "slurm-%j.out"
         if self.test:
             logger.info('==== Test mode ====')
             logger.info(f'Temporary instance is at {str(pth)}')
             return
         logger.info('==== Submitting the job ====')
-        subprocess.run(["sbatch","-D",str(pth),"-o",str(self.home / "slurm-%j.out"),scr],
-                       stdout=sys.stdout, stderr=sys.stderr, check=True)
+        with metrics.phase('sbatch'):
+            result = subprocess.run(["sbatch","--parsable","-D",str(pth),"-o",str(output)] + extra_args + [scr],
+                                    stdout=subprocess.PIPE, stderr=sys.stderr, text=True, check=True)
+        # --parsable prints "jobid" or "jobid;cluster"
+        jobid = result.stdout.strip().split(';')[0]
+        logger.info(f'Submitted batch job {jobid}')
+        return jobid
 
     def setup_hydro(self):
-        runfile = f"{self.casename}_run.dat"
+        runfile = self.home / f"{self.casename}_run.dat"
         inpdir, outdir = get_run_param(runfile, ['INPDIR','OUTDIR'], dtype=Path)
 
         logger.info('==== Staging inputs ====')
-        scratch_path = self._stage(outdir, 'hyd_results')
+        with metrics.phase('stage', home=self.home) as m:
+            scratch_path = self._stage(outdir, 'hyd_results')
 
-        shutil.copytree(inpdir, scratch_path / inpdir, copy_function=shutil.copy)
-        shutil.copy(runfile, scratch_path)
-        instance_root = Path(os.getcwd())
-        with open(scratch_path / 'run_fvcom.sh','w') as b:
-            self._write_job_file(b, 'run_fvcom.stub')
+            self._stage_tree(self.home / inpdir, scratch_path / inpdir)
+            self._finish_staging(m)
+        chained = 'chain_steps' in self.config
+        if chained:
+            self._start_chain(runfile, scratch_path)
+        else:
+            shutil.copy(runfile, scratch_path)
+        instance_root = self.home
+        with metrics.phase('job_script'), open(scratch_path / 'run_fvcom.sh','w') as b:
+            self._write_job_file(b, self.home / 'run_fvcom.stub')
+            if chained:
+                # Submit the next segment before the restart files are moved
+                b.write(f'(cd {shlex.quote(os.fspath(self.home))} && '
+                        f'{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} '
+                        f'chain "$PWD" --after "$SLURM_JOB_ID")\n')
             # Preserve restart files after job concludes
             b.write(f"mv re_* {instance_root}\n")
         os.chmod(scratch_path / 'run_fvcom.sh', stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
         logger.debug(f'Run instance is at {str(scratch_path)}')
-        self._invoke_sbatch(scratch_path, 'run_fvcom.sh')
+        jobid = self._invoke_sbatch(scratch_path, 'run_fvcom.sh')
+        self._register_instance(scratch_path, jobid)
         return scratch_path
 
+    def _chain_option(self, name):
+        return self.config.get(f'chain_{name}', DEFAULT_CHAIN[name])
+
+    def _start_chain(self, runfile, scratch_path):
+        """Stage the run control file for the first segment of a chained run
+
+        The run is split into segments of chain_steps iterations, each its
+        own job. Each segment ends by submitting the next (see chain_hydro).
+        """
+        end_param = self._chain_option('end_param')
+        end = RunControl.read(runfile).value(end_param)
+        if not isinstance(end, int):
+            raise ValueError(f'{end_param} in {str(runfile)} is not an iteration count')
+        steps = int(self.config['chain_steps'])
+        if steps <= 0:
+            raise ValueError('chain_steps must be positive')
+        patch_run_param(runfile, {end_param: min(end, steps)}, scratch_path / runfile.name)
+        with open(scratch_path / CHAIN_STATE, 'w') as fp:
+            json.dump({'end': end, 'steps': steps, 'restart': None, 'jobs': []}, fp)
+        logger.info(f'Running {end} iterations in segments of {steps}')
+
+    def chain_hydro(self):
+        """Submit the next segment of the chained hydro run in instance
+
+        The latest restart file becomes the restart input, and the staged run
+        control file is switched to a hot start running chain_steps more
+        iterations. With after set to a job ID, the next segment only starts
+        if that job succeeds. Returns the new job ID, or None if the run is
+        complete.
+        """
+        inst = Path(self.instance).resolve()
+        with open(inst / CHAIN_STATE) as fp:
+            chain = json.load(fp)
+        restarts = {}
+        for p in inst.glob(self._chain_option('restart_files')):
+            m = re.search(r'(\d+)$', p.name)
+            if m is not None and p.is_file():
+                restarts[int(m.group(1))] = p
+        if len(restarts) == 0:
+            raise RuntimeError(f'No restart files in {str(inst)}, ending the chain')
+        latest = max(restarts)
+        if latest >= chain['end']:
+            logger.info(f'Run complete at iteration {latest}')
+            return None
+        if chain['restart'] is not None and latest <= chain['restart']:
+            raise RuntimeError(f'No progress since iteration {latest}, ending the chain')
+
+        runfile = inst / f'{self.casename}_run.dat'
+        inpdir = RunControl.read(runfile).get('INPDIR')
+        restart_file = inst / self._chain_option('restart_file').format(inpdir=inpdir, casename=self.casename)
+        shutil.copy(restarts[latest], restart_file)
+        next_end = min(chain['end'], latest + chain['steps'])
+        patch_run_param(runfile, {self._chain_option('end_param'): next_end,
+                                  self._chain_option('restart_param'): self._chain_option('restart_value')})
+        logger.info(f'Restarting from {restarts[latest].name}, running to iteration {next_end} of {chain["end"]}')
+
+        args = self.config.get('chain_sbatch_args', '').split()
+        if self.after is not None:
+            args += [f'--dependency=afterok:{self.after}', f'--export=ALL,SSM_PREVIOUS_JOB={self.after}']
+        jobid = self._invoke_sbatch(inst, 'run_fvcom.sh', args)
+        chain['restart'] = latest
+        if jobid is not None:
+            chain['jobs'].append(jobid)
+            self._register_instance(inst, jobid)
+        with open(inst / CHAIN_STATE, 'w') as fp:
+            json.dump(chain, fp)
+        return jobid
+
     def _get_hyd_result_dest(self, hyd_result_src):
         scrub_path = self._get_scrub_path()
         if hyd_result_src.path.name == 'netcdf':
@@ -215,109 +1618,872 @@ class HyakSetupHelper:
         else:
             return scrub_path / 'hyd_results' / hashit(str(hyd_result_src))
 
-    def setup_wqm(self):
-        wqmlink = f90nml.read('wqm_linkage.in')
-        hyd_result_src = RemotePath.from_string(wqmlink['hydro_netcdf']['hydro_dir'])
-        if hyd_result_src.is_remote:
-            if self.save_root.is_remote and hyd_result_src.host != self.save_root.host:
-                logger.warning(f'Remote host for save_root ({self.save_root.host}) does not match hydro_dir ({hyd_result_src.host})')
-            hyd_result_nc = self._get_hyd_result_dest(hyd_result_src)
-            logger.info(f'==== Syncing {str(hyd_result_src)} to {os.fspath(hyd_result_nc)} ====')
+    def _hydro_cache_key(self, hyd_result_src):
+        """Resolve a remote hydro path so different spellings of it share a cache entry"""
+        path = os.fspath(hyd_result_src.path)
+        result = subprocess.run(self.ssh.ssh(hyd_result_src.host, 'realpath', '-m', shlex.quote(path)),
+                                capture_output=True, text=True)
+        if result.returncode or len(result.stdout.strip()) == 0:
+            logger.warning(f'Could not resolve {str(hyd_result_src)}: {result.stderr.strip()}')
+            return str(hyd_result_src).rstrip('/')
+        return f'{hyd_result_src.host}:{result.stdout.strip()}'
+
+    def _remote_listing(self, hyd_result_src):
+        """List the NetCDF files in a remote hydro directory with one ssh command
+
+        Returns a dict of file name -> [size, mtime], or None if the listing
+        could not be made.
+        """
+        path = os.fspath(hyd_result_src.path) + '/'
+        result = subprocess.run(self.ssh.ssh(hyd_result_src.host, 'find', shlex.quote(path),
+                                             '-maxdepth', '1', '-type', 'f', '-name', shlex.quote('*.nc'),
+                                             '-printf', shlex.quote(r'%f\t%s\t%T@\n')),
+                                capture_output=True, text=True)
+        if result.returncode:
+            logger.warning(f'Could not list {str(hyd_result_src)}: {result.stderr.strip()}')
+            return None
+        listing = {}
+        for line in result.stdout.splitlines():
+            name, size, mtime = line.split('\t')
+            listing[name] = [int(size), int(float(mtime))]
+        return listing
+
+    def _select_hydro_files(self, manifest):
+        """Narrow a remote listing down to the hydro files this run needs
+
+        With quick set, that is the first quick files. Otherwise the run's
+        TMSTRT/TMEND (days) from wqm_con.npt are compared with the period each
+        numbered hydro file covers, worked out from hydro_nrec and hydro_dlt
+        (seconds) in wqm_linkage.in or hydro_file_days in the config. One
+        extra file is kept on each side for interpolation. If any of this
+        is missing, every file is kept.
+        """
+        numbered = {}
+        for name in manifest:
+            m = re.search(r'(\d+)\.nc$', name)
+            if m:
+                numbered[name] = int(m.group(1))
+        names = sorted(numbered, key=numbered.get)
+        if self.quick is not None:
+            logger.info(f'Quick mode, fetching only the first {self.quick} hydro files')
+            return {name: manifest[name] for name in names[:self.quick]}
+
+        hydro = read_linkage(self.home / 'wqm_linkage.in')['hydro_netcdf']
+        if 'hydro_file_days' in self.config:
+            file_days = float(self.config['hydro_file_days'])
+        elif 'hydro_nrec' in hydro and 'hydro_dlt' in hydro:
+            file_days = hydro['hydro_nrec'] * hydro['hydro_dlt'] / 86400
+        else:
+            logger.debug('Hydro file period unknown, fetching all files')
+            return manifest
+        tmstrt, tmend = get_wqm_param(self.home / 'wqm_con.npt', ['TMSTRT', 'TMEND'])
+        if tmstrt is None or tmend is None or len(names) == 0:
+            logger.debug('Run period unknown, fetching all files')
+            return manifest
+        first = hydro.get('hydro_filenumstart', numbered[names[0]])
+        t_start = hydro.get('t_hydro_start', 0)
+        wanted = {}
+        for name in names:
+            t0 = t_start + (numbered[name] - first) * file_days
+            # Keep a file either side of the window
+            if t0 + file_days > tmstrt - file_days and t0 <= tmend + file_days:
+                wanted[name] = manifest[name]
+        logger.info(f'Run covers days {tmstrt} to {tmend}, fetching {len(wanted)} of {len(manifest)} hydro files')
+        return wanted
+
+    def _fetch_hydro(self, hyd_result_src, check_only=False, also=()):
+        """Bring the local copy of remote hydro results up to date
+
+        Returns the local path and whether it was already up to date. With
+        check_only, nothing is transferred. also lists other helpers using
+        the same results, whose needed files are fetched too.
+        """
+        cache = HydroCache(self._get_scrub_path() / 'hyd_results')
+        cache_key = self._hydro_cache_key(hyd_result_src)
+        manifest = self._remote_listing(hyd_result_src)
+        wanted = None
+        if manifest is not None:
+            wanted = self._select_hydro_files(manifest)
+            for other in also:
+                wanted.update(other._select_hydro_files(manifest))
+        if wanted is None and self.quick is not None:
+            raise RuntimeError('Quick mode needs a listing of the remote hydro files')
+        with cache.locked():
+            hyd_result_nc = cache.lookup(cache_key)
+            if hyd_result_nc is None:
+                hyd_result_nc = self._get_hyd_result_dest(hyd_result_src)
+            if wanted is not None and cache.is_current(cache_key, wanted):
+                logger.info(f'==== {os.fspath(hyd_result_nc)} is up to date with {str(hyd_result_src)} ====')
+                cache.touch(cache_key)
+                return hyd_result_nc, True
+            if check_only:
+                return hyd_result_nc, False
             os.makedirs(hyd_result_nc, exist_ok=True)
-            args = ['rsync','-vrtlz','--filter=+ *.nc','--filter=- *',str(hyd_result_src) + '/',hyd_result_nc]
-            rsync_pipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=sys.stderr)
-            while True:
-                line = rsync_pipe.stdout.readline()
-                if not line:
-                    rsync_pipe.poll()
-                    break
-                logger.info(line.strip())
-            if rsync_pipe.returncode:
-                raise subprocess.CalledProcessError(rsync_pipe.returncode, args)
+            if wanted is not None:
+                linked = cache.seed(hyd_result_nc, wanted)
+                if linked:
+                    logger.info(f'Reusing {linked} files already in the hydro cache')
+        logger.info(f'==== Syncing {str(hyd_result_src)} to {os.fspath(hyd_result_nc)} ====')
+        args = ['rsync','-rtl'] + rsync_compress_args(self.config) + self.ssh.rsync_args(hyd_result_src)
+        if wanted is not None:
+            streams = int(self.config.get('transfer_streams', DEFAULT_TRANSFER_STREAMS))
+            striped_rsync(args, {name: size for name, (size, _) in wanted.items()},
+                          str(hyd_result_src) + '/', hyd_result_nc, streams, phase='fetch')
+        else:
+            args += ['-v','--stats','--filter=+ *.nc','--filter=- *',str(hyd_result_src) + '/',hyd_result_nc]
+            with metrics.phase('fetch') as m:
+                m['bytes'], m['files'] = rsync_stats(call_process_with_logging(args))
+        with cache.locked():
+            cache.record(cache_key, hyd_result_src, hyd_result_nc, manifest)
+            if 'hydro_cache_quota' in self.config and cache.total_bytes() > parse_size(self.config['hydro_cache_quota']):
+                logger.warning('Hydro cache is over its quota, run "ssm_hyak.py cache evict"')
+        return hyd_result_nc, False
 
+    def _write_fetch_job_file(self, fp, stubfile):
+        """Write a short batch job that runs the hydro fetch for this instance"""
+        fp.write('#!/bin/bash\n')
+        fp.write('# Auto-generated sbatch file for an asynchronous hydro fetch\n')
+        fp.write('#\n')
+        # Charge the fetch to the same account and partition as the model
+        with open(stubfile) as s:
+            for l in s:
+                if re.match(r'SBATCH\s+(--account|--partition|-A|-p)\b', l):
+                    fp.write(f'#{l}')
+        fp.write('#SBATCH --job-name=ssm_fetch\n')
+        fp.write('#SBATCH --nodes=1\n')
+        fp.write('#SBATCH --ntasks=1\n')
+        fp.write(f"#SBATCH --time={self.config.get('fetch_time', DEFAULT_FETCH_TIME)}\n")
+        for opt in shlex.split(self.config.get('fetch_sbatch_args', '')):
+            fp.write(f'#SBATCH {opt}\n')
+        fp.write(f'cd {shlex.quote(os.fspath(self.home))}\n')
+        quick = f' --quick {self.quick}' if self.quick is not None else ''
+        fp.write(f'{shlex.quote(sys.executable)} {shlex.quote(os.path.abspath(__file__))} fetch{quick}\n')
+
+    def _submit_with_async_fetch(self, scratch_path, scr):
+        """Submit the model job so it only starts once the hydro fetch has finished
+
+        With fetch_mode = job (the default) the fetch is its own batch job and
+        the model depends on it. With fetch_mode = background, the model is
+        submitted held and a login-node process does the fetch, then releases
+        (or, on failure, cancels) the model job.
+        """
+        mode = self.config.get('fetch_mode', 'job')
+        if mode == 'job':
+            with open(scratch_path / 'fetch_hydro.sh', 'w') as b:
+                self._write_fetch_job_file(b, self.home / 'run_icm.stub')
+            os.chmod(scratch_path / 'fetch_hydro.sh', stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+            fetchid = self._invoke_sbatch(self.home, os.fspath(scratch_path / 'fetch_hydro.sh'))
+            if fetchid is None:
+                return
+            logger.info(f'Hydro fetch is job {fetchid}')
+            # Fail the model job if the fetch fails, as background mode does
+            return self._invoke_sbatch(scratch_path, scr, [f'--dependency=afterok:{fetchid}',
+                                                           '--kill-on-invalid-dep=yes'])
+        elif mode == 'background':
+            jobid = self._invoke_sbatch(scratch_path, scr, ['--hold'])
+            if jobid is None:
+                return
+            os.makedirs(REGISTER_STATEDIR, exist_ok=True)
+            with open(self.home / f'fetch-{jobid}.log', 'w') as log:
+                quick = ['--quick', str(self.quick)] if self.quick is not None else []
+                p = subprocess.Popen([sys.executable, os.path.abspath(__file__), 'fetch', '--release', jobid] + quick,
+                                     cwd=self.home, stdin=subprocess.DEVNULL, stdout=log,
+                                     stderr=subprocess.STDOUT, start_new_session=True)
+            with open(REGISTER_STATEDIR / f'{jobid}.fetch', 'w') as fp:
+                fp.write(f'{p.pid}\n{self.home}\n')
+            logger.info(f'Fetching hydro in the background (pid {p.pid}), job {jobid} is held until it finishes')
+            return jobid
+        else:
+            raise ValueError(f'Unknown fetch_mode {mode}')
+
+    def fetch_hydro(self):
+        """Fetch the hydro results named in wqm_linkage.in, for an asynchronous fetch
+
+        If release is set to a job ID, that job is released when the fetch
+        succeeds and cancelled if it fails.
+        """
+        hyd_result_src = self._wqm_hydro_source()
+        try:
+            if hyd_result_src.is_remote:
+                self._fetch_hydro(hyd_result_src)
+        except Exception:
+            if self.release is not None:
+                logger.error(f'Hydro fetch failed, cancelling job {self.release}')
+                subprocess.run(['scancel', self.release])
+            raise
+        finally:
+            if self.release is not None:
+                (REGISTER_STATEDIR / f'{self.release}.fetch').unlink(missing_ok=True)
+        if self.release is not None:
+            subprocess.run(['scontrol', 'release', self.release], check=True)
+
+    def _wqm_hydro_source(self):
+        """The hydro_dir from wqm_linkage.in"""
+        wqmlink = read_linkage(self.home / 'wqm_linkage.in')
+        return RemotePath.from_string(wqmlink['hydro_netcdf']['hydro_dir'])
+
+    def _stage_wqm(self, hyd_result_src, hyd_result_nc):
+        """Stage a WQM instance reading hydro results from hyd_result_nc. Returns the instance path"""
         logger.info('==== Staging inputs ====')
-        scratch_path = self._stage('outputs', 'wqm_results')
+        with metrics.phase('stage', home=self.home) as m:
+            scratch_path = self._stage('outputs', 'wqm_results')
 
-        shutil.copytree('inputs', scratch_path / 'inputs', copy_function=shutil.copy)
-        runfile = f"{self.casename}_run.dat"
-        if Path(runfile).is_file():
-            shutil.copy(runfile, scratch_path)
-        shutil.copy('wqm_con.npt', scratch_path)
-        # Search through wqm_con.npt for files that are not in inputs/ or outputs/
-        with open('wqm_con.npt') as wc:
-            try:
-                subhead_pattern = re.compile('^[A-Z ]+ FILE[^A-Z]')
-                for line in wc:
-                    if subhead_pattern.match(line):
-                        filecand = next(wc).strip()
-                        while filecand != '':
-                            if filecand[:7] != 'inputs/' and filecand[:8] != 'outputs/':
-                                logger.info(f'Found extra file {filecand} to copy')
-                                shutil.copy(filecand, scratch_path)
-                            filecand = next(wc).strip()
-            except StopIteration:
-                pass
+            self._stage_tree(self.home / 'inputs', scratch_path / 'inputs')
+            runfile = self.home / f"{self.casename}_run.dat"
+            if runfile.is_file():
+                shutil.copy(runfile, scratch_path)
+            shutil.copy(self.home / 'wqm_con.npt', scratch_path)
+            for filecand in WqmControl.read(self.home / 'wqm_con.npt').extra_files():
+                logger.info(f'Found extra file {filecand} to copy')
+                self._stage_file(self.home / filecand, scratch_path / os.path.basename(filecand))
+            self._finish_staging(m)
 
         if hyd_result_src.is_remote:
             wqmlink_patch = {'hydro_netcdf': {'hydro_dir': os.fspath(hyd_result_nc) + '/'}}
-            f90nml.patch('wqm_linkage.in', wqmlink_patch, os.fspath(scratch_path / 'wqm_linkage.in'))
+            f90nml.patch(os.fspath(self.home / 'wqm_linkage.in'), wqmlink_patch,
+                         os.fspath(scratch_path / 'wqm_linkage.in'))
         else:
-            shutil.copy('wqm_linkage.in', scratch_path)
-        instance_root = Path(os.getcwd())
-        with open(scratch_path / 'run_icm.sh','w') as b:
-            self._write_job_file(b, instance_root / 'run_icm.stub')
+            shutil.copy(self.home / 'wqm_linkage.in', scratch_path)
+        if config_bool(self.config.get('hydro_local', False)):
+            shared = hyd_result_nc if hyd_result_src.is_remote else Path(hyd_result_src.path)
+            self._stage_hydro_local(scratch_path, shared)
         logger.debug(f'Run instance is at {str(scratch_path)}')
-        self._invoke_sbatch(scratch_path, 'run_icm.sh')
         return scratch_path
 
+    def _stage_hydro_local(self, scratch_path, shared):
+        """Point an instance's wqm_linkage.in at node-local copies of the hydro inputs in shared
+
+        The job script makes the copies (see _write_hydro_stage_in). The
+        linkage file for the shared copies is kept as wqm_linkage.shared.in.
+        """
+        local = Path(self.config.get('hydro_local_dir', DEFAULT_HYDRO_LOCAL_DIR)) / f'ssm-hydro-{scratch_path.name}'
+        os.replace(scratch_path / 'wqm_linkage.in', scratch_path / 'wqm_linkage.shared.in')
+        f90nml.patch(os.fspath(scratch_path / 'wqm_linkage.shared.in'),
+                     {'hydro_netcdf': {'hydro_dir': os.fspath(local) + '/'}},
+                     os.fspath(scratch_path / 'wqm_linkage.in'))
+        # Only the files the run needs are copied, if they are known yet
+        available = {p.name: None for p in shared.glob('*.nc')}
+        names = sorted(self._select_hydro_files(available)) if len(available) else None
+        self.hydro_local = (shared, local, names)
+
+    def setup_wqm(self):
+        hyd_result_src = self._wqm_hydro_source()
+        hyd_result_nc = None
+        if hyd_result_src.is_remote:
+            if self.save_root.is_remote and hyd_result_src.host != self.save_root.host:
+                logger.warning(f'Remote host for save_root ({self.save_root.host}) does not match hydro_dir ({hyd_result_src.host})')
+            hyd_result_nc, current = self._fetch_hydro(hyd_result_src, check_only=self.async_fetch)
+            async_fetch = self.async_fetch and not current
+        else:
+            async_fetch = False
+
+        scratch_path = self._stage_wqm(hyd_result_src, hyd_result_nc)
+        with metrics.phase('job_script'), open(scratch_path / 'run_icm.sh','w') as b:
+            self._write_job_file(b, self.home / 'run_icm.stub')
+        if async_fetch:
+            jobid = self._submit_with_async_fetch(scratch_path, 'run_icm.sh')
+        else:
+            jobid = self._invoke_sbatch(scratch_path, 'run_icm.sh')
+        self._register_instance(scratch_path, jobid)
+        return scratch_path
+
+class SweepHelper:
+    """Class to stage many WQM instances and submit them as one SLURM job array"""
+    def __init__(self, _, **config):
+        self.config = config
+        self.dirs = []
+        self.test = False
+        self.check = False
+
+    def _helpers(self):
+        """Make a setup helper for each instance directory, applying its own ssm_hyak.ini"""
+        dirs = []
+        for pattern in self.dirs:
+            for d in sorted(glob.glob(pattern)) or [pattern]:
+                d = Path(d).resolve()
+                if not (d / 'wqm_con.npt').is_file():
+                    raise ValueError(f'{str(d)} is not a WQM instance directory')
+                if d not in dirs:
+                    dirs.append(d)
+        helpers = []
+        for d in dirs:
+            # As main() reads them, with the instance's file last. The
+            # settings given go underneath, for when there are no files
+            config = ConfigParser()
+            config.read_dict({'DEFAULT': {k: v.replace('%', '%%') for k, v in self.config.items()}})
+            config.read(CONFIG_FILES + [d / 'ssm_hyak.ini'])
+            if not config.has_section('wqm'):
+                config.add_section('wqm')
+            helper = HyakSetupHelper('wqm', home=d, **config['wqm'])
+            helper.test = self.test
+            helpers.append(helper)
+        return helpers
+
+    def _problems(self, helper):
+        """Reasons an instance directory can't be staged, from its control files"""
+        problems = []
+        home = helper.home
+        for name in ('inputs', 'wqm_linkage.in', 'run_icm.stub'):
+            if not (home / name).exists():
+                problems.append(f'{name} is missing')
+        for filecand in WqmControl.read(home / 'wqm_con.npt').files:
+            if not (home / filecand).exists():
+                problems.append(f'{filecand} named in wqm_con.npt is missing')
+        if (home / 'wqm_linkage.in').is_file():
+            try:
+                helper._wqm_hydro_source()
+            except (KeyError, TypeError) as e:
+                problems.append(f'wqm_linkage.in has no usable hydro_dir ({e})')
+        return problems
+
+    def _validate(self, helpers):
+        """Check every instance before staging any. Returns whether they are all good"""
+        ok = True
+        for h in helpers:
+            for problem in self._problems(h):
+                logger.error(f'{str(h.home)}: {problem}')
+                ok = False
+        return ok
+
+    def _fetch(self, helpers):
+        """Fetch each distinct hydro solution once, with the files all its users need
+
+        Returns a dict of instance directory -> local hydro path.
+        """
+        groups = {}
+        for h in helpers:
+            src = h._wqm_hydro_source()
+            if src.is_remote:
+                groups.setdefault(h._hydro_cache_key(src), []).append(h)
+        hydro_paths = {}
+        for group in groups.values():
+            src = group[0]._wqm_hydro_source()
+            logger.info(f'==== Fetching {str(src)} for {len(group)} instance(s) ====')
+            hyd_result_nc, _ = group[0]._fetch_hydro(src, also=group[1:])
+            for h in group:
+                hydro_paths[h.home] = hyd_result_nc
+        return hydro_paths
+
+    def _write_array_job_file(self, fp, helpers, instances):
+        """Write one sbatch script where array task i runs instance i"""
+        first = helpers[0]
+        if any(h.config.get('modules') != first.config.get('modules') for h in helpers[1:]):
+            logger.warning(f'Instances load different modules, using those from {str(first.home)}')
+        array = f'--array=0-{len(helpers) - 1}'
+        if 'sweep_max_running' in self.config:
+            array += f"%{self.config['sweep_max_running']}"
+        first._write_job_header(fp, first.home / 'run_icm.stub', [array])
+        fp.write('case "$SLURM_ARRAY_TASK_ID" in\n')
+        for i, (h, inst) in enumerate(zip(helpers, instances)):
+            body = io.StringIO()
+            h._write_job_body(body)
+            fp.write(f'{i})\n')
+            fp.write(f'    cd {shlex.quote(os.fspath(inst))}\n')
+            for l in body.getvalue().splitlines():
+                fp.write(f'    {l}\n')
+            fp.write('    ;;\n')
+        fp.write('esac\n')
+
+    def run(self):
+        helpers = self._helpers()
+        if len(helpers) == 0:
+            raise ValueError('No instance directories given')
+        if not self._validate(helpers):
+            raise ValueError('Some instances are not ready, see above')
+        if self.check:
+            logger.info(f'{len(helpers)} instances are ready')
+            return
+        with SshMultiplexer(config_bool(self.config.get('ssh_multiplex', True))) as ssh:
+            for h in helpers:
+                h.ssh = ssh
+            hydro_paths = self._fetch(helpers)
+            workers = int(self.config.get('stage_workers', DEFAULT_STAGE_WORKERS))
+            with ThreadPoolExecutor(max_workers=max(1, workers)) as pool:
+                instances = list(pool.map(lambda h: h._stage_wqm(h._wqm_hydro_source(), hydro_paths.get(h.home)),
+                                          helpers))
+
+        sweep_path = Path(tempfile.mkdtemp(prefix='sweep-', dir=get_scrub_path(self.config, 'scrub_dir_out')))
+        with metrics.phase('job_script', instances=len(helpers)), open(sweep_path / 'run_icm.sh', 'w') as b:
+            self._write_array_job_file(b, helpers, instances)
+        os.chmod(sweep_path / 'run_icm.sh', stat.S_IRUSR | stat.S_IWUSR | stat.S_IXUSR)
+        logger.debug(f'Array job script is at {str(sweep_path)}')
+        jobid = helpers[0]._invoke_sbatch(sweep_path, 'run_icm.sh',
+                                          output=Path.cwd() / 'slurm-%A_%a.out')
+        for i, (h, inst) in enumerate(zip(helpers, instances)):
+            h._register_instance(inst, f'{jobid}_{i}' if jobid is not None else None)
+        return sweep_path
+
+# Recorded as the mtime of files sent as unverified tails, so they never
+# look unchanged and the final sync checks them in full
+UNVERIFIED_MTIME = -1
+
+class SyncState:
+    """sqlite database of what has been synced for each job
+
+    Kept in REGISTER_STATEDIR/sync.db. For each job this records the size
+    and mtime of every file as of its last successful sync, so later passes
+    only send what changed, along with when it was synced and how much was
+    sent. Safe to share between threads.
+    """
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.fspath(path), timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute('CREATE TABLE IF NOT EXISTS jobs (jobid TEXT PRIMARY KEY, jobdir TEXT, '
+                             'dest TEXT, last_sync REAL, last_attempt REAL, '
+                             'bytes_moved INTEGER DEFAULT 0, error TEXT, done INTEGER DEFAULT 0)')
+            self._db.execute('CREATE TABLE IF NOT EXISTS files (jobid TEXT, name TEXT, size INTEGER, '
+                             'mtime_ns INTEGER, PRIMARY KEY (jobid, name))')
+            self._db.execute('CREATE TABLE IF NOT EXISTS runs (jobid TEXT PRIMARY KEY, model TEXT, '
+                             'casename TEXT, days REAL, nodes INTEGER, cpus INTEGER, elapsed REAL, '
+                             'max_rss INTEGER, recorded REAL)')
+
+    def close(self):
+        self._db.close()
+
+    def files(self, jobid):
+        """The (size, mtime_ns) of each file of a job when it was last synced"""
+        with self._lock:
+            rows = self._db.execute('SELECT name, size, mtime_ns FROM files WHERE jobid = ?', (jobid,))
+            return {name: (size, mtime) for name, size, mtime in rows}
+
+    def jobs(self):
+        """Every job's record, as dicts"""
+        with self._lock:
+            cur = self._db.execute('SELECT jobid, jobdir, dest, last_sync, last_attempt, '
+                                   'bytes_moved, error, done FROM jobs ORDER BY jobid')
+            names = [c[0] for c in cur.description]
+            return [dict(zip(names, row)) for row in cur]
+
+    def record(self, jobid, jobdir, dest, files, moved, replace=True):
+        """Record a successful sync of files (name -> (size, mtime_ns))
+
+        With replace, files are the complete list for the job; otherwise
+        they are added to what was there.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            if replace:
+                self._db.execute('DELETE FROM files WHERE jobid = ?', (jobid,))
+            self._db.executemany('INSERT OR REPLACE INTO files VALUES (?, ?, ?, ?)',
+                                 [(jobid, name, size, mtime) for name, (size, mtime) in files.items()])
+            self._db.execute('INSERT INTO jobs (jobid, jobdir, dest, last_sync, last_attempt, bytes_moved) '
+                             'VALUES (?, ?, ?, ?, ?, ?) ON CONFLICT (jobid) DO UPDATE SET '
+                             'jobdir = excluded.jobdir, dest = excluded.dest, '
+                             'last_sync = excluded.last_sync, last_attempt = excluded.last_attempt, '
+                             'bytes_moved = bytes_moved + excluded.bytes_moved, error = NULL',
+                             (jobid, os.fspath(jobdir), str(dest), now, now, moved))
+
+    def record_failure(self, jobid, error):
+        with self._lock, self._db:
+            self._db.execute('INSERT INTO jobs (jobid, last_attempt, error) VALUES (?, ?, ?) '
+                             'ON CONFLICT (jobid) DO UPDATE SET last_attempt = excluded.last_attempt, '
+                             'error = excluded.error', (jobid, time.time(), str(error)))
+
+    def finish(self, jobid, keep_files=False):
+        """Mark a job as done after its final sync, dropping its file list
+
+        With keep_files, the file list is kept for a later job to carry on
+        from (see forget_files).
+        """
+        with self._lock, self._db:
+            if not keep_files:
+                self._db.execute('DELETE FROM files WHERE jobid = ?', (jobid,))
+            self._db.execute('UPDATE jobs SET done = 1 WHERE jobid = ?', (jobid,))
+
+    def forget_files(self, jobid):
+        """Drop the file list kept by finish, if the job is done"""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM files WHERE jobid = ? AND jobid IN '
+                             '(SELECT jobid FROM jobs WHERE done)', (jobid,))
+
+    def record_run(self, jobid, model, casename, days, elapsed, nodes, cpus, max_rss):
+        """Record the resources a completed run used, for sizing later ones"""
+        with self._lock, self._db:
+            self._db.execute('INSERT OR REPLACE INTO runs VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)',
+                             (jobid, model, casename, days, nodes, cpus, elapsed, max_rss, time.time()))
+
+    def runs(self, model, casename):
+        """The recorded runs of a model and case, as dicts"""
+        with self._lock:
+            cur = self._db.execute('SELECT jobid, days, nodes, cpus, elapsed, max_rss FROM runs '
+                                   'WHERE model = ? AND casename IS ?', (model, casename))
+            cols = [c[0] for c in cur.description]
+            return [dict(zip(cols, row)) for row in cur]
+
+    def prune(self, max_age):
+        """Forget jobs that finished syncing more than max_age seconds ago"""
+        with self._lock, self._db:
+            self._db.execute('DELETE FROM jobs WHERE done AND last_sync < ?', (time.time() - max_age,))
+            # Including file lists kept for chains that ended
+            self._db.execute('DELETE FROM files WHERE jobid NOT IN (SELECT jobid FROM jobs)')
+
+class SyncLeases:
+    """Claims on registered jobs, so sync processes on several hosts can share them
+
+    Kept as files in a directory all the hosts share. A process claims a job
+    by creating JOBID.lease exclusively, and keeps it by touching the file
+    (a heartbeat, from a background thread). A lease not touched for ttl
+    seconds is stale and can be taken over. Each process also touches an
+    OWNER.worker file, and jobs are shared out between the live workers by
+    rendezvous hashing, so each has a disjoint share.
+    """
+    def __init__(self, directory, ttl=DEFAULT_SYNC_LEASE_TTL, owner=None):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.owner = owner if owner is not None else f'{socket.gethostname()}:{os.getpid()}'
+        self.held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        os.makedirs(self.directory, exist_ok=True)
+
+    def _path(self, jobid):
+        return self.directory / f'{jobid}.lease'
+
+    def _stale(self, path):
+        return time.time() - path.stat().st_mtime > self.ttl
+
+    def owner_of(self, jobid):
+        """Who holds the lease on a job, or None"""
+        try:
+            with open(self._path(jobid)) as fp:
+                return fp.readline().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def workers(self):
+        """The owners of the live sync processes, including this one"""
+        live = {self.owner}
+        for p in self.directory.glob('*.worker'):
+            try:
+                if not self._stale(p):
+                    live.add(p.name[:-len('.worker')])
+                elif time.time() - p.stat().st_mtime > 10 * self.ttl:
+                    # Long dead
+                    p.unlink()
+            except FileNotFoundError:
+                pass
+        return live
+
+    @staticmethod
+    def preferred(jobid, workers):
+        """Which of workers has jobid in its share"""
+        return max(sorted(workers), key=lambda w: hashlib.md5(f'{w}/{jobid}'.encode()).hexdigest())
+
+    def claim(self, jobid):
+        """Try to take the lease on a job. Returns whether this process holds it"""
+        if jobid in self.held:
+            return True
+        path = self._path(jobid)
+        for _ in range(2):
+            try:
+                fd = os.open(path, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o644)
+            except FileExistsError:
+                if not self._take_stale(jobid):
+                    return False
+                continue
+            with os.fdopen(fd, 'w') as fp:
+                fp.write(f'{self.owner}\n')
+            with self._lock:
+                self.held.add(jobid)
+            return True
+        return False
+
+    def _take_stale(self, jobid):
+        """Remove the lease on a job if it is stale. Returns whether the job can be claimed"""
+        path = self._path(jobid)
+        try:
+            if not self._stale(path):
+                return False
+            # Of all the processes that saw it was stale, only one can move it
+            tomb = path.with_name(f'{path.name}.{self.owner}')
+            os.rename(path, tomb)
+        except FileNotFoundError:
+            return True
+        if not self._stale(tomb):
+            # Renewed or claimed again since we looked; put it back
+            try:
+                os.link(tomb, path)
+            except FileExistsError:
+                pass
+            tomb.unlink()
+            return False
+        with open(tomb) as fp:
+            logger.warning(f'Taking over the stale lease on {jobid} from {fp.readline().strip()}')
+        tomb.unlink()
+        return True
+
+    def release(self, jobid):
+        """Give up the lease on a job"""
+        with self._lock:
+            self.held.discard(jobid)
+        if self.owner_of(jobid) == self.owner:
+            self._path(jobid).unlink(missing_ok=True)
+
+    def heartbeat(self):
+        """Renew this process's worker file and leases. Returns the jobs whose leases were lost"""
+        (self.directory / f'{self.owner}.worker').touch()
+        lost = []
+        with self._lock:
+            held = list(self.held)
+        for jobid in held:
+            try:
+                if self.owner_of(jobid) == self.owner:
+                    os.utime(self._path(jobid))
+                    continue
+            except FileNotFoundError:
+                pass
+            logger.warning(f'Lost the lease on {jobid}')
+            lost.append(jobid)
+            with self._lock:
+                self.held.discard(jobid)
+        return lost
+
+    def start(self):
+        """Start heartbeats in the background"""
+        self.heartbeat()
+
+        def beat():
+            while not self._stop.wait(self.ttl / 3):
+                try:
+                    self.heartbeat()
+                except OSError as e:
+                    logger.warning(f'Lease heartbeat failed: {e}')
+
+        self._thread = threading.Thread(target=beat, daemon=True)
+        self._thread.start()
+
+    def close(self):
+        """Stop the heartbeats and give up every lease"""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for jobid in list(self.held):
+            self.release(jobid)
+        (self.directory / f'{self.owner}.worker').unlink(missing_ok=True)
+
+class Inotify:
+    """Minimal ctypes wrapper around the Linux inotify API
+
+    Only changes made by this machine generate events. Writes from other
+    nodes of a cluster filesystem like GPFS are never seen, so anything
+    watching files written by jobs still needs to poll.
+    """
+    IN_CLOSE_WRITE = 0x00000008
+    IN_MOVED_TO = 0x00000080
+    IN_CREATE = 0x00000100
+    IN_IGNORED = 0x00008000
+    IN_ISDIR = 0x40000000
+    _event = struct.Struct('iIII')
+
+    def __init__(self):
+        self._libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+        self.fd = self._libc.inotify_init1(os.O_NONBLOCK | os.O_CLOEXEC)
+        if self.fd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err))
+        # Watch descriptor -> directory
+        self.watches = {}
+
+    def add(self, path, mask):
+        wd = self._libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd < 0:
+            err = ctypes.get_errno()
+            raise OSError(err, os.strerror(err), os.fspath(path))
+        self.watches[wd] = os.fspath(path)
+
+    def remove(self, path):
+        for wd, p in list(self.watches.items()):
+            if p == os.fspath(path):
+                self._libc.inotify_rm_watch(self.fd, wd)
+                del self.watches[wd]
+
+    def read(self, timeout=None):
+        """Wait up to timeout seconds for events. Returns (directory, name, mask) tuples"""
+        ready, _, _ = select.select([self.fd], [], [], timeout)
+        if len(ready) == 0:
+            return []
+        try:
+            data = os.read(self.fd, 65536)
+        except BlockingIOError:
+            return []
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, _, length = self._event.unpack_from(data, pos)
+            pos += self._event.size
+            name = os.fsdecode(data[pos:pos + length].rstrip(b'\0'))
+            pos += length
+            if mask & self.IN_IGNORED:
+                self.watches.pop(wd, None)
+            elif wd in self.watches:
+                events.append((self.watches[wd], name, mask))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
 class SyncHelper:
     """Class to handle syncing model files from registered jobs"""
     def __init__(self, _, **config):
         self.config = config
         self.sync_count = 0
+        self.workers = int(config.get('sync_workers', DEFAULT_SYNC_WORKERS))
+        self.job_states = {}
+        self.ssh = SshMultiplexer(False)
+        self.failed_hosts = set()
+        self.daemon = False
+        self.state = None
+        self.job = None
+        self.final = False
+        self.loop = None
+        self.job_options = {}
+        self.job_configs = {}
+        self.leases = None
 
-    def _job_running(self, jobid):
-        """Is this job running?"""
-        result = subprocess.run(['squeue','--job',jobid], capture_output=True)
-        return result.returncode == 0
+    def _do_sync(self, job_dir: Path, copy_dest: RemotePath, final: bool=False, tag=None, files=None,
+                 offsets=None, tailed=None):
+        """Sync a job directory to its remote copy. Returns the number of bytes moved
 
-    def _call_process_with_logging(self, args):
-        rsync_pipe = subprocess.Popen(args, stdout=subprocess.PIPE, stderr=sys.stderr)
-        while True:
-            line = rsync_pipe.stdout.readline()
-            if not line:
-                rsync_pipe.poll()
-                break
-            logger.info(line.strip())
-        if rsync_pipe.returncode:
-            raise subprocess.CalledProcessError(rsync_pipe.returncode, args)
-
-    def _do_sync(self, job_dir: Path, copy_dest: RemotePath, final: bool=False):
-        # FIXME this does not reference OUTDIR in ssm_run.dat like setup_hydro
-        # does
-        os.chdir(job_dir)
-        # Copy everything except outputs first
-        self._call_process_with_logging(['rsync','-az','--exclude=OUTPUT','--exclude=outputs','./', str(copy_dest)])
-        if os.path.isdir('OUTPUT'):
-            args = ['rsync','-az']
-            if not final:
-                args.append('--append-verify')
-            args += ['OUTPUT/',str(copy_dest / 'OUTPUT')]
-            self._call_process_with_logging(args)
-        elif os.path.isdir('outputs'):
-            args = ['rsync','-az','--exclude=ssm_history_*']
-            if not final:
-                args.append('--append-verify')
-            args += ['outputs/',str(copy_dest / 'outputs')]
-            self._call_process_with_logging(args)
-            histfiles = glob.glob('outputs/ssm_history_*')
-            if len(histfiles):
-                self._call_process_with_logging(['rsync','-az','--append-verify'] + histfiles + [str(copy_dest / 'outputs')])
-        self.sync_count += 1
+        files (path relative to job_dir -> size) limits the sync to those
+        files; by default everything is sent. offsets (same keys) gives the
+        size of each file at its last sync, and the paths of files sent as
+        tails only are added to tailed (see _sync_outputs).
+        """
+        rsync = ['rsync','-a'] + rsync_compress_args(self.config) + self.ssh.rsync_args(copy_dest)
+        outdir = job_outdir(job_dir)
+        if files is None:
+            files = {name: sig[0] for name, sig in self._scan_job(job_dir).items()}
+        prefix = os.path.join(outdir, '') if outdir is not None else None
+        outputs = {name[len(prefix):]: size for name, size in files.items()
+                   if prefix is not None and name.startswith(prefix)}
+        others = {name: size for name, size in files.items()
+                  if prefix is None or not name.startswith(prefix)}
+        # Everything except outputs first
+        moved = striped_rsync(rsync, others, './', copy_dest, cwd=job_dir, tag=tag, phase='sync_inputs')
+        if len(outputs):
+            out_offsets = {name[len(prefix):]: offset for name, offset in (offsets or {}).items()
+                           if name.startswith(prefix)}
+            out_tailed = []
+            moved += self._sync_outputs(job_dir, copy_dest, outdir, outputs, final=final, tag=tag,
+                                        offsets=out_offsets, tailed=out_tailed)
+            if tailed is not None:
+                tailed.extend(os.path.join(outdir, name) for name in out_tailed)
+        return moved
+
+    def _scan_job(self, job_dir):
+        """Size and mtime of every file a sync sends, by path relative to job_dir"""
+        outdir = job_outdir(job_dir)
+        files = scan_files(job_dir, exclude={'OUTPUT', 'outputs', outdir})
+        if outdir is not None:
+            # Files part way through reduction are left out
+            partial = REDUCE_TMP.format(name='*')
+            for name, sig in scan_files(job_dir / outdir).items():
+                if not fnmatch.fnmatch(os.path.basename(name), partial):
+                    files[os.path.join(outdir, name)] = sig
+        return files
+
+    def _send_tail(self, job_dir, copy_dest, outdir, name, offset):
+        """Write what was added to a growing output file since offset into its remote copy
+
+        The first sync_append_head bytes are sent again as well, for headers
+        that are rewritten as records are added. Returns the number of bytes
+        sent, or None if the remote copy is shorter than offset (so the
+        whole file has to be sent).
+        """
+        path = job_dir / outdir / name
+        remote = copy_dest / outdir / name
+        size = os.path.getsize(path)
+        head = min(int(self.config.get('sync_append_head', DEFAULT_SYNC_APPEND_HEAD)), offset)
+        target = shlex.quote(os.fspath(remote.path))
+        sent = 0
+        # The new records before the header that counts them
+        for start, end in ((offset, size), (0, head)):
+            if end <= start:
+                continue
+            cmd = (f'test "$(stat -c %s {target} 2>/dev/null || echo -1)" -ge {offset} || exit 3; '
+                   f'exec dd of={target} bs=1M seek={start} oflag=seek_bytes conv=notrunc status=none')
+            args = self.ssh.ssh(remote.host, cmd) if remote.is_remote else ['sh', '-c', cmd]
+            proc = subprocess.Popen(args, stdin=subprocess.PIPE)
+            try:
+                with open(path, 'rb') as f:
+                    f.seek(start)
+                    remaining = end - start
+                    while remaining > 0:
+                        chunk = f.read(min(remaining, 1 << 20))
+                        if not chunk:
+                            break
+                        proc.stdin.write(chunk)
+                        remaining -= len(chunk)
+                proc.stdin.close()
+            except BrokenPipeError:
+                pass
+            rc = proc.wait()
+            if rc == 3:
+                return None
+            if rc != 0:
+                raise subprocess.CalledProcessError(rc, args)
+            sent += end - start
+        return sent
+
+    def _sync_outputs(self, job_dir, copy_dest, outdir, files, final=False, tag=None, offsets=None, tailed=None):
+        """Sync output files (path relative to outdir -> size). Returns the number of bytes moved
+
+        With sync_append = tail, files that grew since they were last synced
+        (offsets gives their size then) have only their new bytes sent, and
+        their names are added to tailed; the final sync checksums everything.
+        """
+        moved = 0
+        rsync = ['rsync','-a'] + rsync_compress_args(self.config) + self.ssh.rsync_args(copy_dest)
+        streams = int(self.config.get('transfer_streams', DEFAULT_TRANSFER_STREAMS))
+        mode = self.config.get('sync_append', 'verify')
+        if mode not in ('verify', 'tail'):
+            raise ValueError(f'Unknown sync_append {mode}')
+        if mode == 'tail' and not final and offsets:
+            growing = {name: offsets[name] for name in files if 0 < offsets.get(name, 0) <= files[name]}
+            if len(growing):
+                prefix = f'{tag}: ' if tag is not None else ''
+                with metrics.phase('sync_tail', tag=tag) as m, \
+                     ThreadPoolExecutor(max_workers=max(1, streams)) as pool:
+                    results = dict(zip(growing, pool.map(
+                        lambda name: self._send_tail(job_dir, copy_dest, outdir, name, growing[name]),
+                        growing)))
+                    sent = {name: n for name, n in results.items() if n is not None}
+                    m['bytes'] = sum(sent.values())
+                    m['files'] = len(sent)
+                for name in results:
+                    if name in sent:
+                        logger.debug(f'{prefix}{name}: sent {format_bytes(sent[name])} after {growing[name]}')
+                    else:
+                        logger.warning(f'{prefix}Remote copy of {name} is short, sending it all')
+                moved += sum(sent.values())
+                files = {name: size for name, size in files.items() if name not in sent}
+                if tailed is not None:
+                    tailed.extend(sent)
+        # History files are still growing, so only ever append to them
+        # until the final sync, when they may also have been reduced
+        histfiles = {}
+        if outdir == 'outputs':
+            histfiles = {name: size for name, size in files.items()
+                         if fnmatch.fnmatch(os.path.basename(name), 'ssm_history_*')}
+        others = {name: size for name, size in files.items() if name not in histfiles}
+        if mode == 'tail' and final:
+            # Tails were sent unchecked, so compare every block once at the end
+            args = histargs = rsync + ['--checksum']
+        else:
+            args = histargs = rsync if final else rsync + ['--append-verify']
+        moved += striped_rsync(args, others, f'{outdir}/', copy_dest / outdir, streams, cwd=job_dir, tag=tag,
+                               phase='sync_outputs')
+        moved += striped_rsync(histargs, histfiles, f'{outdir}/', copy_dest / outdir,
+                               streams, cwd=job_dir, tag=tag, phase='sync_history')
+        return moved
 
     def _lock(self, unlock=False):
+        """One sync process per host; processes on other hosts share the jobs through leases"""
         me = os.getpid()
-        pidfile = REGISTER_STATEDIR / 'sync.pid'
+        pidfile = REGISTER_STATEDIR / f'sync.{socket.gethostname()}.pid'
         if pidfile.is_file():
             with open(pidfile) as fp:
                 pid = int(next(fp))
@@ -329,7 +2495,7 @@ class SyncHelper:
             elif psutil.pid_exists(pid):
                 # The lockfile PID matches a running process, let's see what it is
                 p = psutil.Process(pid)
-                mep = putil.Process(me)
+                mep = psutil.Process(me)
                 if p.name() == mep.name():
                     raise RuntimeError(f'A sync process is already running (pid {pid})')
                 else:
@@ -337,71 +2503,661 @@ class SyncHelper:
         with open(pidfile, 'w') as fp:
             fp.write(f'{me}\n')
 
+    def _start_leases(self):
+        self.leases = SyncLeases(REGISTER_STATEDIR / 'leases',
+                                 float(self.config.get('sync_lease_ttl', DEFAULT_SYNC_LEASE_TTL)))
+        self.leases.start()
+
+    def _stop_leases(self):
+        self.leases.close()
+        self.leases = None
+
+    def _claimed(self, jobs):
+        """The jobs in this process's share that it holds the lease on
+
+        Leases on jobs that are now in another live process's share are
+        given up, for that process to take.
+        """
+        workers = self.leases.workers()
+        for jobid in self.leases.held - {job[1] for job in jobs}:
+            # Unregistered since it was claimed
+            self.leases.release(jobid)
+        mine = []
+        for job in jobs:
+            jobid = job[1]
+            if SyncLeases.preferred(jobid, workers) != self.leases.owner:
+                self.leases.release(jobid)
+            elif self.leases.claim(jobid):
+                mine.append(job)
+        if len(workers) > 1:
+            logger.info(f'{len(mine)} of {len(jobs)} jobs claimed, shared with {len(workers) - 1} other sync processes')
+        return mine
+
+    def _find_jobs(self, cleanup=True):
+        """Read the registered jobs and work out where each one syncs to
+
+        Returns a list of (job file, job ID, job directory, copy destination)
+        tuples. Job files that are no longer valid are removed, unless
+        cleanup is false.
+        """
+        jobs = []
+        for jf in REGISTER_STATEDIR.glob('*.job'):
+            jobid = jf.stem
+            with open(jf) as fp:
+                jobdir = Path(next(fp).rstrip('\n'))
+                # Then any key=value options
+                options = dict(line.rstrip('\n').split('=', 1) for line in fp if '=' in line)
+            if not jobdir.is_dir():
+                logger.warning(f'Found nonexistent job directory {str(jobdir)} from {jobid}')
+                if cleanup:
+                    jf.unlink()
+                continue
+            config = job_config(jobdir, self.config)
+            run_root = Path(config['run_root']) if 'run_root' in config else jobdir
+            save_root = RemotePath.from_string(config['save_root']) if 'save_root' in config else None
+            if save_root is None or not save_root.is_remote:
+                logger.info(f'Job directory {str(jobdir)} from {jobid} is not remote, ignoring')
+                if cleanup:
+                    jf.unlink()
+                continue
+            run_tail = jobdir.relative_to(run_root)
+            self.job_options[jobid] = options
+            self.job_configs[jobid] = config
+            jobs.append((jf, jobid, jobdir, save_root / run_tail))
+        return jobs
+
+    def _make_remote_dirs(self, jobs):
+        """Create the destination directories, with one ssh command per host
+
+        Hosts where this fails are added to failed_hosts.
+        """
+        by_host = {}
+        for job in jobs:
+            copy_dest = job[3]
+            by_host.setdefault(copy_dest.host, []).append(os.fspath(copy_dest.path))
+        for host, paths in by_host.items():
+            try:
+                call_process_with_logging(self.ssh.ssh(host, 'mkdir', '-p',
+                                                             *[shlex.quote(p) for p in paths]))
+            except subprocess.CalledProcessError as e:
+                logger.error(f'Could not create directories on {host}: {e}')
+                self.failed_hosts.add(host)
+
+    def _reduce_job(self, jf, jobid, jobdir):
+        """Reduce a finished job's outputs before its final sync, if it's set to and hasn't been"""
+        config = self.job_configs.get(jobid, self.config)
+        if config.get('reduce', 'no') != 'sync' or 'reduced' in self.job_options.get(jobid, {}):
+            return
+        outdir = job_outdir(jobdir)
+        if outdir is None:
+            return
+        reduce_outputs(jobdir / outdir, config, tag=jobid)
+        # Not again if the sync has to be retried
+        with open(jf, 'a') as fp:
+            fp.write('reduced=1\n')
+        self.job_options.setdefault(jobid, {})['reduced'] = '1'
+
+    def _sync_job(self, jf, jobid, jobdir, copy_dest):
+        """Sync one registered job. Returns the number of bytes moved"""
+        if copy_dest.host in self.failed_hosts:
+            raise RuntimeError(f'{copy_dest.host} is unreachable')
+        state = self.job_states.get(jobid)
+        final = state not in SLURM_ACTIVE_STATES and state != 'UNKNOWN'
+        if final:
+            logger.debug(f'({jobid} is {state or "gone"}, final sync)')
+            self._reduce_job(jf, jobid, jobdir)
+        # Only send files that changed since the last successful sync
+        snapshot = self._scan_job(jobdir)
+        synced = self.state.files(jobid) if self.state is not None else {}
+        previous = self.job_options.get(jobid, {}).get('previous')
+        carried = len(synced) == 0 and previous is not None and self.state is not None
+        if carried:
+            # A new segment of a chained run, which shares its files
+            synced = self.state.files(previous)
+        changed = {name: sig[0] for name, sig in snapshot.items() if synced.get(name) != sig}
+        tailed = []
+        if len(changed):
+            logger.info(f'Copying {len(changed)} changed files of {jobid} in {str(jobdir)} to {str(copy_dest)}')
+            offsets = {name: synced[name][0] for name in changed if name in synced}
+            moved = self._do_sync(jobdir, copy_dest, final=final, tag=jobid, files=changed,
+                                  offsets=offsets, tailed=tailed)
+        else:
+            logger.info(f'{jobid}: nothing changed since the last sync')
+            moved = 0
+        if self.state is not None:
+            # Tails aren't verified, so leave those files looking changed for the final sync
+            for name in tailed:
+                snapshot[name] = (snapshot[name][0], UNVERIFIED_MTIME)
+            self.state.record(jobid, jobdir, copy_dest, snapshot, moved)
+            if carried:
+                self.state.forget_files(previous)
+            if final:
+                # A segment of a chained run keeps its file list for the next
+                self.state.finish(jobid, keep_files='chain_steps' in self.job_configs.get(jobid, self.config))
+                if state == 'COMPLETED':
+                    self._record_run(jobid, jobdir)
+                elif self.job is not None:
+                    # The job is still running, so sacct doesn't have its
+                    # totals yet; a later login node pass records it
+                    with open(REGISTER_STATEDIR / f'{jobid}.record', 'w') as fp:
+                        fp.write(f'{jobdir}\n')
+        if final:
+            jf.unlink()
+        return moved
+
+    def _record_run(self, jobid, jobdir):
+        """Record a completed job's resource use from sacct, for autosize"""
+        config = self.job_configs.get(jobid, self.config)
+        if 'chain_steps' in config:
+            # Segments don't cover the period in the run control file
+            return
+        try:
+            acct = job_accounting(jobid)
+            if acct is None:
+                return
+            model = 'wqm' if (jobdir / 'wqm_con.npt').is_file() else 'hydro'
+            casename = config.get('casename')
+            self.state.record_run(jobid, model, casename, run_period_days(jobdir, casename), **acct)
+        except Exception as e:
+            logger.warning(f'Could not record the resource use of {jobid}: {e}')
+
+    def _record_finished_runs(self):
+        """Record the runs of jobs that did their final sync themselves, once they complete"""
+        markers = {rf.stem: rf for rf in REGISTER_STATEDIR.glob('*.record')}
+        if len(markers) == 0:
+            return
+        states = query_job_states(list(markers))
+        keep = float(self.config.get('sync_state_keep_days', DEFAULT_SYNC_STATE_KEEP_DAYS)) * 86400
+        for jobid, rf in markers.items():
+            state = states.get(jobid)
+            try:
+                if state in SLURM_ACTIVE_STATES or state == 'UNKNOWN':
+                    continue
+                if state is None and time.time() - rf.stat().st_mtime < keep:
+                    # Not in sacct yet
+                    continue
+                if state == 'COMPLETED':
+                    with open(rf) as fp:
+                        jobdir = Path(next(fp).rstrip('\n'))
+                    self.job_configs[jobid] = job_config(jobdir, self.config)
+                    self._record_run(jobid, jobdir)
+                rf.unlink(missing_ok=True)
+            except OSError as e:
+                logger.warning(f'Could not record the resource use of {jobid}: {e}')
+
+    def _timed_sync_job(self, *job):
+        """Wrapper around _sync_job that isolates failures and records timing
+
+        Returns a (success, bytes moved, elapsed seconds) tuple.
+        """
+        jobid = job[1]
+        start = time.monotonic()
+        try:
+            with metrics.phase('sync_job', job=jobid) as m:
+                moved = m['bytes'] = self._sync_job(*job)
+            ok = True
+        except Exception as e:
+            logger.error(f'Sync of {jobid} failed: {e}')
+            if self.state is not None:
+                self.state.record_failure(jobid, e)
+            moved = 0
+            ok = False
+        elapsed = time.monotonic() - start
+        logger.info(f'{jobid}: {"synced" if ok else "failed"} in {elapsed:.1f} s, {format_bytes(moved)} moved')
+        return ok, moved, elapsed
+
+    def _scan_outputs(self, jobid):
+        """Size and mtime of every file in a job's output directory, by relative path"""
+        return scan_files(self.tracked[jobid][2] / self.outdirs[jobid])
+
+    def _watch_outputs(self, jobid):
+        """Add inotify watches for every directory under a job's output directory"""
+        if self.inotify is None:
+            return
+        root = self.tracked[jobid][2] / self.outdirs[jobid]
+        for dirpath, _, _ in os.walk(root):
+            try:
+                self.inotify.add(dirpath, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO | Inotify.IN_CREATE)
+            except OSError as e:
+                logger.warning(f'Cannot watch {dirpath}, relying on polling: {e}')
+            self.watched[dirpath] = jobid
+
+    def _daemon_poll(self):
+        """Pick up new and finished jobs, and poll the output files of the rest
+
+        Writes made on other nodes of a cluster filesystem don't generate
+        inotify events, so this runs every sync_poll_interval even when
+        inotify is in use.
+        """
+        jobs = self._claimed(self._find_jobs())
+        self.job_states = query_job_states([job[1] for job in jobs])
+        self.failed_hosts = set()
+        self._record_finished_runs()
+        registered = {job[1] for job in jobs}
+        for jobid in [j for j in self.tracked if j not in registered]:
+            # Unregistered by someone else, or now another process's
+            self._untrack(jobid)
+        new = []
+        for job in jobs:
+            jobid = job[1]
+            state = self.job_states.get(jobid)
+            if state in SLURM_PENDING_STATES or self._node_synced(jobid):
+                continue
+            if state not in SLURM_ACTIVE_STATES and state != 'UNKNOWN':
+                # Finished: the usual final sync, which unregisters the job
+                ok, _, _ = self._timed_sync_job(*job)
+                self.sync_count += ok
+                self._untrack(jobid)
+            elif jobid not in self.tracked:
+                new.append(job)
+        self._make_remote_dirs(new)
+        for job in new:
+            jobid = job[1]
+            self.tracked[jobid] = job
+            self.outdirs[jobid] = job_outdir(job[2])
+            self.dirty[jobid] = {}
+            if self.outdirs[jobid] is not None:
+                self._watch_outputs(jobid)
+                self.snapshots[jobid] = self._scan_outputs(jobid)
+            # Catch up with everything written before we started watching
+            ok, _, _ = self._timed_sync_job(*job)
+            self.sync_count += ok
+            if not ok:
+                # Try again from scratch next time
+                self._untrack(jobid)
+        now = time.monotonic()
+        for jobid in self.tracked:
+            if self.outdirs[jobid] is None:
+                # Not there when the job was found, maybe it is now
+                self.outdirs[jobid] = job_outdir(self.tracked[jobid][2])
+                if self.outdirs[jobid] is None:
+                    continue
+                self._watch_outputs(jobid)
+            snapshot = self._scan_outputs(jobid)
+            old = self.snapshots.get(jobid, {})
+            for name, sig in snapshot.items():
+                if old.get(name) != sig:
+                    self.dirty[jobid].setdefault(name, now)
+            self.snapshots[jobid] = snapshot
+
+    def _untrack(self, jobid):
+        """Stop watching a job"""
+        for d in [d for d, j in self.watched.items() if j == jobid]:
+            if self.inotify is not None:
+                self.inotify.remove(d)
+            del self.watched[d]
+        for state in (self.tracked, self.outdirs, self.snapshots, self.dirty):
+            state.pop(jobid, None)
+
+    def _daemon_events(self, events):
+        """Mark files from inotify events as changed. Returns whether the job list needs a rescan"""
+        rescan = False
+        now = time.monotonic()
+        for dirpath, name, mask in events:
+            if dirpath == os.fspath(REGISTER_STATEDIR):
+                # A newly registered job
+                rescan = rescan or name.endswith('.job')
+                continue
+            jobid = self.watched.get(dirpath)
+            if jobid not in self.tracked:
+                continue
+            path = os.path.join(dirpath, name)
+            if mask & Inotify.IN_ISDIR:
+                if mask & Inotify.IN_CREATE:
+                    self._watch_outputs(jobid)
+                continue
+            if mask & (Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO):
+                root = self.tracked[jobid][2] / self.outdirs[jobid]
+                self.dirty[jobid][os.path.relpath(path, root)] = now
+        return rescan
+
+    def _daemon_flush(self, pool):
+        """Sync the changed files of every job that has been quiet for sync_debounce seconds"""
+        now = time.monotonic()
+        ready = []
+        for jobid, changed in self.dirty.items():
+            if len(changed) and now - max(changed.values()) >= self.debounce:
+                ready.append(jobid)
+        if len(ready) == 0:
+            return
+
+        def sync_changed(jobid):
+            jf, _, jobdir, copy_dest = self.tracked[jobid]
+            outdir = self.outdirs[jobid]
+            names = list(self.dirty[jobid])
+            self.dirty[jobid] = {}
+            files = {}
+            sent = {}
+            for name in names:
+                try:
+                    st = os.lstat(jobdir / outdir / name)
+                except FileNotFoundError:
+                    continue
+                files[name] = st.st_size
+                sent[os.path.join(outdir, name)] = (st.st_size, st.st_mtime_ns)
+                # So the next poll doesn't send it again
+                self.snapshots.setdefault(jobid, {})[name] = (st.st_size, st.st_mtime_ns)
+            synced = self.state.files(jobid)
+            offsets = {name: synced[os.path.join(outdir, name)][0] for name in files
+                       if os.path.join(outdir, name) in synced}
+            tailed = []
+            try:
+                moved = self._sync_outputs(jobdir, copy_dest, outdir, files, tag=jobid,
+                                           offsets=offsets, tailed=tailed)
+            except Exception as e:
+                logger.error(f'Sync of {jobid} failed: {e}')
+                # Retry them next time
+                for name in files:
+                    self.dirty[jobid].setdefault(name, now)
+                return
+            for name in tailed:
+                path = os.path.join(outdir, name)
+                sent[path] = (sent[path][0], UNVERIFIED_MTIME)
+            self.state.record(jobid, jobdir, copy_dest, sent, moved, replace=False)
+            logger.info(f'{jobid}: {len(files)} changed files synced, {format_bytes(moved)} moved')
+
+        list(pool.map(sync_changed, ready))
+
+    def _next_flush(self):
+        """When the next job will have been quiet long enough to sync, or None"""
+        times = [max(changed.values()) + self.debounce for changed in self.dirty.values() if len(changed)]
+        return min(times) if len(times) else None
+
+    def run_daemon(self, iterations=None):
+        """Keep syncing changed output files as they are written
+
+        Stops after iterations passes through the loop (for testing), or
+        when the process is terminated.
+        """
+        self.sync_count = 0
+        self.tracked = {}
+        self.outdirs = {}
+        self.snapshots = {}
+        self.dirty = {}
+        self.watched = {}
+        interval = float(self.config.get('sync_poll_interval', DEFAULT_SYNC_POLL_INTERVAL))
+        self.debounce = float(self.config.get('sync_debounce', DEFAULT_SYNC_DEBOUNCE))
+        self.inotify = None
+        if self.config.get('sync_watch', 'inotify') == 'inotify':
+            try:
+                self.inotify = Inotify()
+                self.inotify.add(REGISTER_STATEDIR, Inotify.IN_CLOSE_WRITE | Inotify.IN_MOVED_TO)
+            except (OSError, AttributeError) as e:
+                logger.warning(f'inotify unavailable, polling only: {e}')
+                self.inotify = None
+        if threading.current_thread() is threading.main_thread():
+            # Let the finally clauses run when systemd stops us
+            signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        self._lock()
+        self.state = SyncState(REGISTER_STATEDIR / 'sync.db')
+        self._start_leases()
+        try:
+            logger.info(f'Watching jobs for changes ({"inotify and " if self.inotify else ""}'
+                        f'polling every {interval:g} s)')
+            with SshMultiplexer(config_bool(self.config.get('ssh_multiplex', True))) as self.ssh, \
+                    ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+                next_poll = time.monotonic()
+                while iterations is None or iterations > 0:
+                    if iterations is not None:
+                        iterations -= 1
+                    if time.monotonic() >= next_poll:
+                        self._daemon_poll()
+                        metrics.flush()
+                        next_poll = time.monotonic() + interval
+                    wake = min(t for t in (next_poll, self._next_flush()) if t is not None)
+                    timeout = max(0, wake - time.monotonic())
+                    if self.inotify is not None:
+                        if self._daemon_events(self.inotify.read(timeout)):
+                            next_poll = time.monotonic()
+                    else:
+                        time.sleep(timeout)
+                    self._daemon_flush(pool)
+        finally:
+            if self.inotify is not None:
+                self.inotify.close()
+            self._stop_leases()
+            self.state.close()
+            self.state = None
+            self._lock(unlock=True)
+
+    def _node_synced(self, jobid):
+        """Whether a job is being synced from its own compute node right now"""
+        return (config_bool(self.job_options.get(jobid, {}).get('job_sync', False))
+                and self.job_states.get(jobid) in SLURM_ACTIVE_STATES)
+
+    def run_job(self):
+        """Sync one job from inside its batch allocation
+
+        Syncs once, or every loop seconds until terminated. With final, this
+        is the job's final sync and unregisters it.
+        """
+        jobs = [job for job in self._find_jobs(cleanup=False) if job[1] == self.job]
+        if len(jobs) == 0:
+            logger.warning(f'Job {self.job} is not registered for sync')
+            return
+        # One textfile per job would pile up in the collector's directory,
+        # so jobs only log JSON metrics
+        metrics.formats.discard('prometheus')
+        stop = threading.Event()
+        if threading.current_thread() is threading.main_thread():
+            # Finish the transfer in progress before exiting
+            signal.signal(signal.SIGTERM, lambda *_: stop.set())
+        self.state = SyncState(REGISTER_STATEDIR / 'sync.db')
+        # Not RUNNING means final
+        self.job_states = {} if self.final else {self.job: 'RUNNING'}
+        try:
+            with SshMultiplexer(config_bool(self.config.get('ssh_multiplex', True))) as self.ssh:
+                self._make_remote_dirs(jobs)
+                while True:
+                    self.failed_hosts = set()
+                    ok, _, _ = self._timed_sync_job(*jobs[0])
+                    self.sync_count += ok
+                    if self.loop is None or stop.wait(self.loop):
+                        break
+        finally:
+            self.state.close()
+            self.state = None
+
     def run(self):
+        if self.job is not None:
+            return self.run_job()
+        if self.daemon:
+            return self.run_daemon()
         self.sync_count = 0
         self._lock()
+        self.state = SyncState(REGISTER_STATEDIR / 'sync.db')
+        self._start_leases()
         try:
             logger.info('Syncing jobs...')
-            for jf in REGISTER_STATEDIR.glob('*.job'):
-                jobid = jf.stem
-                with open(jf) as fp:
-                    jobdir = Path(next(fp).rstrip('\n'))
-                if not jobdir.is_dir():
-                    logger.warning(f'Found nonexistent job directory {str(jobdir)} from {jobid}')
-                    jf.unlink()
-                    continue
-                config = ConfigParser()
-                config.read_dict({'DEFAULT': self.config})
-                config.read(str(jobdir / 'ssm_hyak.ini'))
-                config = config['wqm' if (jobdir / 'wqm_con.npt').is_file() else 'hydro']
-                run_root = Path(config['run_root']) if 'run_root' in config else jobdir
-                save_root = RemotePath.from_string(config['save_root']) if 'save_root' in config else None
-                if save_root is None or not save_root.is_remote:
-                    logger.info(f'Job directory {str(jobdir)} from {jobid} is not remote, ignoring')
-                    jf.unlink()
-                    continue
-                run_tail = jobdir.relative_to(run_root)
-                copy_dest = save_root / run_tail
-                logger.info(f'Copying {jobid} in {str(jobdir)} to {str(copy_dest)}')
-                self._call_process_with_logging(['ssh', copy_dest.host, 'mkdir', '-p', copy_dest.path])
-                if self._job_running(jobid):
-                    self._do_sync(jobdir, copy_dest)
-                else:
-                    logger.debug('(Job is completed, final sync)')
-                    self._do_sync(jobdir, copy_dest, final=True)
-                    jf.unlink()
-            logger.info(f'Check complete, {self.sync_count} jobs synced')
+            start = time.monotonic()
+            jobs = self._claimed(self._find_jobs())
+            # One scheduler query for the whole pass
+            self.job_states = query_job_states([job[1] for job in jobs])
+            pending = [job[1] for job in jobs if self.job_states.get(job[1]) in SLURM_PENDING_STATES]
+            if len(pending):
+                logger.info(f'Skipping pending jobs: {" ".join(pending)}')
+                jobs = [job for job in jobs if job[1] not in pending]
+            node_synced = [job[1] for job in jobs if self._node_synced(job[1])]
+            if len(node_synced):
+                logger.info(f'Skipping jobs synced from their compute nodes: {" ".join(node_synced)}')
+                jobs = [job for job in jobs if job[1] not in node_synced]
+            self.failed_hosts = set()
+            with SshMultiplexer(config_bool(self.config.get('ssh_multiplex', True))) as self.ssh, \
+                    ThreadPoolExecutor(max_workers=max(1, self.workers)) as pool:
+                self._make_remote_dirs(jobs)
+                results = list(pool.map(lambda job: self._timed_sync_job(*job), jobs))
+            self.sync_count = sum(1 for ok, _, _ in results if ok)
+            failed = [job[1] for job, (ok, _, _) in zip(jobs, results) if not ok]
+            moved = sum(m for _, m, _ in results)
+            logger.info(f'Check complete, {self.sync_count} jobs synced, '
+                        f'{len(failed)} failed, {format_bytes(moved)} moved '
+                        f'in {time.monotonic() - start:.1f} s')
+            if len(failed):
+                logger.warning(f'Failed jobs: {" ".join(failed)}')
+            self._record_finished_runs()
+            self.state.prune(float(self.config.get('sync_state_keep_days', DEFAULT_SYNC_STATE_KEEP_DAYS)) * 86400)
         except Exception as e:
             raise e
         finally:
+            self._stop_leases()
+            self.state.close()
+            self.state = None
             self._lock(unlock=True)
 
+class ReduceHelper:
+    """Class to reduce the NetCDF outputs of finished runs"""
+    def __init__(self, _, **config):
+        self.config = config
+        self.dirs = []
+
+    def run(self):
+        saved = 0
+        for d in self.dirs or ['.']:
+            job_dir = Path(d).resolve()
+            outdir = job_outdir(job_dir)
+            if outdir is None:
+                raise ValueError(f'No output directory in {str(job_dir)}')
+            saved += reduce_outputs(job_dir / outdir, job_config(job_dir, self.config))
+        return saved
+
+class StatusHelper:
+    """Class to report how far behind their remote copies registered jobs are"""
+    def __init__(self, _, **config):
+        self.config = config
+
+    def run(self):
+        sync = SyncHelper('DEFAULT', **self.config)
+        jobs = sync._find_jobs(cleanup=False)
+        states = query_job_states([job[1] for job in jobs])
+        db = REGISTER_STATEDIR / 'sync.db'
+        state = SyncState(db) if db.is_file() else None
+        records = {r['jobid']: r for r in state.jobs()} if state is not None else {}
+        now = time.time()
+        print(f'{"JOBID":<14} {"STATE":<11} {"LAST SYNC":<16} {"SENT":>10} {"UNSYNCED":>18}  LAG')
+        for _, jobid, jobdir, _ in sorted(jobs, key=lambda j: j[1]):
+            rec = records.pop(jobid, {})
+            synced = state.files(jobid) if state is not None else {}
+            changed = {name: sig for name, sig in sync._scan_job(jobdir).items() if synced.get(name) != sig}
+            unsynced = f'{len(changed)} / {format_bytes(sum(sig[0] for sig in changed.values()))}'
+            # How long the oldest unsynced change has been waiting
+            lag = now - min(sig[1] for sig in changed.values()) / 1e9 if len(changed) else 0
+            last = (datetime.datetime.fromtimestamp(rec['last_sync']).strftime('%Y-%m-%d %H:%M')
+                    if rec.get('last_sync') else 'never')
+            print(f'{jobid:<14} {states.get(jobid, "?"):<11} {last:<16} {format_bytes(rec.get("bytes_moved") or 0):>10} '
+                  f'{unsynced:>18}  {lag / 60:.0f} min')
+            if rec.get('error'):
+                print(f'    last attempt failed: {rec["error"]}')
+        done = [r for r in records.values() if r['done']]
+        if len(done):
+            print('Finished:')
+            for rec in done:
+                last = datetime.datetime.fromtimestamp(rec['last_sync']).strftime('%Y-%m-%d %H:%M')
+                print(f'{rec["jobid"]:<14} {"done":<11} {last:<16} {format_bytes(rec["bytes_moved"]):>10}')
+        if state is not None:
+            state.close()
+
 def main():
     parser = ArgumentParser('SSM job management for Hyak')
     parser.add_argument("-v", "--verbose", action="store_true",
             help="Increase output")
-    subparsers = parser.add_subparsers()
+    subparsers = parser.add_subparsers(dest='command')
     parser_hydro = subparsers.add_parser('hydro', description='Start hydro job')
     parser_hydro.set_defaults(cls=HyakSetupHelper, group='hydro')
     parser_hydro.add_argument('-t', '--testing', action='store_true',
                               help='Test mode, stage but do not submit the job')
+    parser_hydro.add_argument('-r', '--reuse', action='store_true',
+                              help='Update the previous instance instead of staging a new one')
     parser_wqm = subparsers.add_parser('wqm', description='Start WQM job')
     parser_wqm.add_argument('-t', '--testing', action='store_true',
                             help='Test mode, stage but do not submit the job')
+    parser_wqm.add_argument('-r', '--reuse', action='store_true',
+                            help='Update the previous instance instead of staging a new one')
+    parser_wqm.add_argument('-a', '--async-fetch', action='store_true',
+                            help='Fetch hydro results while the job waits in the queue')
+    parser_wqm.add_argument('-q', '--quick', type=int, metavar='N',
+                            help='Only fetch the first N hydro files (for smoke tests)')
     parser_wqm.set_defaults(cls=HyakSetupHelper, group='wqm')
+    parser_fetch = subparsers.add_parser('fetch', description='Fetch the hydro results for a WQM job')
+    parser_fetch.add_argument('--release', metavar='JOBID',
+                              help='Release this held job when done (cancel it on failure)')
+    parser_fetch.add_argument('-q', '--quick', type=int, metavar='N',
+                              help='Only fetch the first N hydro files')
+    parser_fetch.set_defaults(cls=HyakSetupHelper, group='wqm', method='fetch')
+    parser_chain = subparsers.add_parser('chain', description='Submit the next segment of a chained hydro run')
+    parser_chain.add_argument('chain_instance', metavar='INSTANCE', help='The staged instance directory')
+    parser_chain.add_argument('--after', metavar='JOBID',
+                              help='Only start the segment if this job succeeds')
+    parser_chain.set_defaults(cls=HyakSetupHelper, group='hydro', method='chain')
+    parser_sweep = subparsers.add_parser('sweep', description='Start many WQM jobs as one job array')
+    parser_sweep.add_argument('sweep_dirs', nargs='+', metavar='DIR',
+                              help='Instance directories (or glob patterns)')
+    parser_sweep.add_argument('-t', '--testing', action='store_true',
+                              help='Test mode, stage but do not submit the job')
+    parser_sweep.add_argument('-c', '--check', action='store_true',
+                              help='Only check that the instances are ready to stage')
+    parser_sweep.set_defaults(cls=SweepHelper, group='wqm')
     parser_sync = subparsers.add_parser('sync', description='Perform remote sync')
     parser_sync.set_defaults(cls=SyncHelper, group='DEFAULT')
+    parser_sync.add_argument('-d', '--daemon', action='store_true',
+                             help='Keep running, syncing output files soon after they are written')
+    parser_sync.add_argument('--job', metavar='JOBID',
+                             help='Only sync this job (used from inside job scripts)')
+    parser_sync.add_argument('--loop', type=float, metavar='SECONDS',
+                             help='With --job, keep syncing at this interval until terminated')
+    parser_sync.add_argument('--final', action='store_true',
+                             help="With --job, do the job's final sync and unregister it")
+    parser_reduce = subparsers.add_parser('reduce', description='Compress and thin the NetCDF outputs of runs')
+    parser_reduce.add_argument('reduce_dirs', nargs='*', metavar='DIR',
+                               help='Run directories (default the current directory)')
+    parser_reduce.set_defaults(cls=ReduceHelper, group='DEFAULT')
+    parser_status = subparsers.add_parser('status', description='Show how far behind the sync of each job is')
+    parser_status.set_defaults(cls=StatusHelper, group='DEFAULT')
+    parser_cache = subparsers.add_parser('cache', description='Manage the local hydro result cache')
+    parser_cache.set_defaults(cls=CacheHelper, group='DEFAULT')
+    parser_cache.add_argument('cache_action', choices=['list', 'prune', 'evict'],
+                              nargs='?', default='list', help='What to do (default list)')
+    parser_cache.add_argument('-q', '--quota',
+                              help='Size to evict down to, e.g. 500G (default hydro_cache_quota)')
 
     args = parser.parse_args()
     logging.basicConfig(level=logging.DEBUG if args.verbose else logging.INFO)
 
     config = ConfigParser()
-    files = [f"{os.environ['HOME']}/.config/ssm_hyak/ssm_hyak.ini",'ssm_hyak.ini']
-    config.read(files)
+    config.read(CONFIG_FILES)
     helper = args.cls(args.group, **config[args.group])
     if 'testing' in args and args.testing:
         helper.test = True
-    helper.run()
+    if 'reuse' in args and args.reuse:
+        helper.reuse = True
+    if 'quick' in args:
+        helper.quick = args.quick
+    if 'async_fetch' in args:
+        helper.async_fetch = args.async_fetch
+    if 'method' in args:
+        helper.method = args.method
+    if 'release' in args:
+        helper.release = args.release
+    if 'chain_instance' in args:
+        helper.instance = args.chain_instance
+        helper.after = args.after
+    if 'daemon' in args:
+        helper.daemon = args.daemon
+        helper.job = args.job
+        helper.loop = args.loop
+        helper.final = args.final
+    if 'sweep_dirs' in args:
+        helper.dirs = args.sweep_dirs
+        helper.check = args.check
+    if 'reduce_dirs' in args:
+        helper.dirs = args.reduce_dirs
+    if 'cache_action' in args:
+        helper.action = args.cache_action
+        helper.quota = args.quota
+    metrics.configure(config[args.group], args.command)
+    try:
+        helper.run()
+    finally:
+        metrics.flush()
 
 if __name__ == '__main__':
     main()
@@ -3,12 +3,19 @@
 case "$1" in
     install)
         mkdir -p $HOME/.config/systemd/user
-        cp systemd/ssm_sync_jobs.* $HOME/.config/systemd/user/
+        cp systemd/ssm_sync_*.* $HOME/.config/systemd/user/
         systemctl --user daemon-reload
         systemctl --user enable --now ssm_sync_jobs.timer
         ;;
+    install-daemon)
+        mkdir -p $HOME/.config/systemd/user
+        cp systemd/ssm_sync_*.* $HOME/.config/systemd/user/
+        systemctl --user daemon-reload
+        systemctl --user disable --now ssm_sync_jobs.timer 2>/dev/null
+        systemctl --user enable --now ssm_sync_daemon.service
+        ;;
     uninstall)
-        systemctl --user disable --now ssm_sync_jobs.timer
+        systemctl --user disable --now ssm_sync_jobs.timer ssm_sync_daemon.service
         ;;
 esac
 
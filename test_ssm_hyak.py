@@ -3,6 +3,14 @@
 import unittest
 import os
 import tempfile
+import shutil
+import io
+import contextlib
+import json
+import subprocess
+import socket
+import time
+from unittest import mock
 from pathlib import Path
 
 import ssm_hyak
@@ -22,14 +30,94 @@ class RemotePathTest(unittest.TestCase):
         self.assertEqual(p1.host, 'host1')
         self.assertEqual(p2.host, 'host2')
 
+class HydroCacheTest(unittest.TestCase):
+    def _fetched(self, root, name, content, mtime):
+        """Make a directory of fake hydro results"""
+        d = root / name / 'netcdf'
+        os.makedirs(d)
+        for fname in ('ssm_0001.nc', 'ssm_0002.nc'):
+            with open(d / fname, 'w') as f:
+                f.write(content + fname)
+            os.utime(d / fname, (mtime, mtime))
+        return d
+
+    def test_dedupe_and_evict(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            cache = ssm_hyak.HydroCache(root)
+            a = self._fetched(root, 'a', 'x' * 1000, 1000000)
+            b = self._fetched(root, 'b', 'x' * 1000, 1000000)
+            c = self._fetched(root, 'c', 'y' * 1000, 1000000)
+            with cache.locked():
+                cache.record('host:/a', 'host:a', a)
+                cache.record('host:/b', 'host:b', b)
+                cache.record('host:/c', 'host:c', c)
+                cache.entries['host:/a']['last_used'] = 0
+                cache.entries['host:/b']['last_used'] = 10
+                cache.entries['host:/c']['last_used'] = 20
+            # Identical files are shared, different ones are not
+            self.assertEqual((a / 'ssm_0001.nc').stat().st_ino, (b / 'ssm_0001.nc').stat().st_ino)
+            self.assertNotEqual((a / 'ssm_0001.nc').stat().st_ino, (c / 'ssm_0001.nc').stat().st_ino)
+
+            # The index survives a reload
+            cache = ssm_hyak.HydroCache(root)
+            with cache.locked():
+                self.assertEqual(b, cache.lookup('host:/b'))
+                self.assertEqual(2022 * 2, cache.total_bytes())
+                # Evicting a shared entry frees nothing, so both go
+                evicted = cache.evict(2100, protect_hours=0)
+            self.assertEqual(['host:/a', 'host:/b'], evicted)
+            self.assertFalse(a.exists())
+            self.assertTrue((c / 'ssm_0001.nc').is_file())
+
+    def test_prune(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            cache = ssm_hyak.HydroCache(root)
+            a = self._fetched(root, 'a', 'a', 1000000)
+            with cache.locked():
+                cache.record('host:/a', 'host:a', a)
+            os.unlink(a / 'ssm_0002.nc')
+            with cache.locked():
+                self.assertEqual([], cache.prune())
+                self.assertEqual(['ssm_0001.nc'], list(cache.entries['host:/a']['files']))
+            shutil.rmtree(a)
+            with cache.locked():
+                self.assertEqual(['host:/a'], cache.prune())
+
+    def test_cache_list(self):
+        with tempfile.TemporaryDirectory() as d:
+            root = Path(d)
+            h = ssm_hyak.CacheHelper('DEFAULT', scrub_dir=os.fspath(root / os.environ['USER']))
+            a = self._fetched(h.cache.root, 'a', 'a', 1000000)
+            with h.cache.locked():
+                h.cache.record('host:/a', 'host:a', a)
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                h.run()
+            self.assertIn('host:a -> ', out.getvalue())
+
 class SsmHyakTest(unittest.TestCase):
     def setUp(self):
         self.wd = os.getcwd()
         self.path = os.environ['PATH']
 
+        self.statedir = ssm_hyak.REGISTER_STATEDIR
+
     def tearDown(self):
         os.chdir(self.wd)
         os.environ['PATH'] = self.path
+        ssm_hyak.REGISTER_STATEDIR = self.statedir
+
+    def _fake_bin(self, tempdir, name, script):
+        """Put a shell script called name at the front of the PATH"""
+        pathent = tempdir / 'bin'
+        os.makedirs(pathent, exist_ok=True)
+        with open(pathent / name, 'w') as f:
+            f.write('#!/bin/sh\n' + script)
+        os.chmod(pathent / name, 0o755)
+        if not os.environ['PATH'].startswith(os.fspath(pathent)):
+            os.environ['PATH'] = os.fspath(pathent) + ':' + os.environ['PATH']
 
     def test_get_run_param(self):
         # Single string parameter
@@ -45,6 +133,86 @@ class SsmHyakTest(unittest.TestCase):
         self.assertEqual(['habitability','regurgitates'],
                          ssm_hyak.get_run_param('testdata/types.dat',['STR1','STR2']))
 
+    def test_control_files(self):
+        rc = ssm_hyak.RunControl.read('testdata/types.dat')
+        self.assertIs(True, rc.value('BOOL_T'))
+        self.assertIs(False, rc.value('BOOL_F'))
+        self.assertEqual(-27, rc.value('ISCAL2'))
+        self.assertEqual(36.0, rc.value('FSCAL4'))
+        self.assertEqual('habitability', rc.value('STR1'))
+        self.assertEqual([47, -70, 12, 196, 180, 167, -151, -117, 15, 33], rc.value('IVEC'))
+        self.assertEqual(8, len(rc.value('FVEC')))
+        self.assertEqual(375.8217536, rc.value('FVEC')[-1])
+        self.assertIsNone(rc.value('MISSING'))
+        with tempfile.TemporaryDirectory() as d:
+            con = Path(d) / 'wqm_con.npt'
+            with open(con, 'w') as f:
+                f.write('TIME CON     TMSTRT     TMEND\n')
+                f.write('                3.0        5.\n')
+                f.write('MAP FILE\n')
+                f.write('inputs/map.dat\n')
+                f.write('extra/grid.dat\n')
+                f.write('\n')
+            wc = ssm_hyak.WqmControl.read(con)
+            self.assertEqual(5.0, wc.get('TMEND'))
+            self.assertEqual(['extra/grid.dat'], wc.extra_files())
+            # Parsed once until the file changes
+            self.assertIs(wc, ssm_hyak.WqmControl.read(con))
+            with open(con, 'a') as f:
+                f.write('OTHER FILE\nmore.dat\n')
+            os.utime(con, ns=(0, 0))
+            self.assertEqual(['extra/grid.dat', 'more.dat'], ssm_hyak.WqmControl.read(con).extra_files())
+
+    def test_balance_files(self):
+        files = {'a': 100, 'b': 60, 'c': 50, 'd': 30, 'e': 20}
+        chunks = ssm_hyak.balance_files(files, 2)
+        self.assertEqual(2, len(chunks))
+        self.assertEqual(sorted(files), sorted(chunks[0] + chunks[1]))
+        self.assertEqual([130, 130], sorted(sum(files[n] for n in c) for c in chunks))
+        # Never more streams than files
+        self.assertEqual(1, len(ssm_hyak.balance_files({'a': 1}, 4)))
+
+    def test_striped_rsync(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n'
+                                        'for a; do case "$a" in --files-from=*) cat "${a#*=}" >> ' f'{tp}/sent;; esac; done\n'
+                                        'echo "Total bytes sent: 10"\n')
+            files = {f'f{i}.nc': i * 100 for i in range(1, 9)}
+            moved = ssm_hyak.striped_rsync(['rsync', '-a'] + ssm_hyak.rsync_compress_args({}),
+                                           files, 'src/', 'host:/dest', streams=3)
+            self.assertEqual(30, moved)
+            with open(log) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(3, len(calls))
+            self.assertIn('--skip-compress=nc/', calls[0])
+            with open(tp / 'sent') as f:
+                self.assertEqual(sorted(files), sorted(f.read().split()))
+            self.assertEqual([], ssm_hyak.rsync_compress_args({'rsync_compress': 'no'}))
+
+    def test_stage_tree(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            src = tp / 'inputs'
+            os.makedirs(src / 'sub')
+            for name in ('a.dat', 'sub/b.dat'):
+                with open(src / name, 'w') as f:
+                    f.write(name)
+            for mode in ssm_hyak.STAGE_MODES:
+                dst = tp / mode
+                ssm_hyak.stage_tree(src, dst, mode, workers=2)
+                for name in ('a.dat', 'sub/b.dat'):
+                    with open(dst / name) as f:
+                        self.assertEqual(name, f.read())
+            self.assertEqual((src / 'a.dat').stat().st_ino, (tp / 'hardlink' / 'a.dat').stat().st_ino)
+            self.assertNotEqual((src / 'a.dat').stat().st_ino, (tp / 'copy' / 'a.dat').stat().st_ino)
+            self.assertTrue((tp / 'symlink-readonly' / 'sub' / 'b.dat').is_symlink())
+            # Reflinks fall back to copies where they aren't supported
+            self.assertFalse((tp / 'reflink' / 'a.dat').is_symlink())
+            with self.assertRaises(ValueError):
+                ssm_hyak.stage_file(src / 'a.dat', tp / 'x', 'bogus')
+
     def test_stage_remote(self):
         # Set up the test fixture
         with tempfile.TemporaryDirectory() as d:
@@ -96,6 +264,7 @@ class SsmHyakTest(unittest.TestCase):
 
         scrub = tempdir / 'scrub'
         os.mkdir(scrub)
+        ssm_hyak.REGISTER_STATEDIR = tempdir / 'state'
 
         return {
                 'run_root': run_root,
@@ -151,6 +320,54 @@ class SsmHyakTest(unittest.TestCase):
             hyd_result_dest = h._get_hyd_result_dest(hyd_result_src)
             self.assertEqual(output_path_exp / 'netcdf', hyd_result_dest)
 
+    def test_setup_hydro_chain(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._hydro_fixture(tp)
+            instance = paths['run_root'] / 'instance'
+            with open(instance / 'case_run.dat', 'a') as f:
+                f.write('RESTART = cold_start  ! or hot_start\n')
+                f.write('IEND = 100\n')
+            calls = tp / 'sbatch.log'
+            self._fake_bin(tp, 'sbatch', f'echo "$@" >> {calls}\necho 1001\n')
+            config = dict(run_root=os.fspath(paths['run_root']), save_root='remote:/foo/bar',
+                          scrub_dir=os.fspath(paths['scrub']), scrub_dir_out=os.fspath(paths['scrub']),
+                          chain_steps='40', chain_sbatch_args='--partition=ckpt')
+            p = ssm_hyak.HyakSetupHelper('hydro', 'case', 'runme', **config).run()
+            self.assertEqual(40, ssm_hyak.get_run_param(p / 'case_run.dat', 'IEND', dtype=int))
+            self.assertEqual(100, ssm_hyak.get_run_param(instance / 'case_run.dat', 'IEND', dtype=int))
+            with open(p / 'run_fvcom.sh') as f:
+                script = f.read()
+            self.assertIn('SSM_PREVIOUS_JOB', script)
+            self.assertLess(script.index('chain "$PWD" --after "$SLURM_JOB_ID"'), script.index('mv re_*'))
+
+            def chain():
+                h = ssm_hyak.HyakSetupHelper('chain', 'case', 'runme', **config)
+                h.instance = p
+                h.after = '1001'
+                return h.run()
+
+            with open(p / 're_0000040', 'w') as f:
+                f.write('restart 40\n')
+            self.assertEqual('1001', chain())
+            with open(p / 'case_run.dat') as f:
+                run = f.read()
+            self.assertIn('IEND = 80\n', run)
+            self.assertIn('RESTART = hot_start  ! or hot_start\n', run)
+            with open(p / 'input' / 'case_restart') as f:
+                self.assertEqual('restart 40\n', f.read())
+            with open(calls) as f:
+                last = f.readlines()[-1]
+            for arg in ('--partition=ckpt', '--dependency=afterok:1001', 'SSM_PREVIOUS_JOB=1001'):
+                self.assertIn(arg, last)
+
+            # A segment that got nowhere ends the chain, as does reaching the end
+            with self.assertRaises(RuntimeError):
+                chain()
+            with open(p / 're_0000100', 'w') as f:
+                f.write('restart 100\n')
+            self.assertIsNone(chain())
+
     def test_setup_hydro_test(self):
         """Test for test-mode hydro setup"""
         with tempfile.TemporaryDirectory() as d:
@@ -173,7 +390,882 @@ class SsmHyakTest(unittest.TestCase):
             self.assertEqual(tp / 'scrub', p.parent.parent)
             self.assertTrue((p / 'output').is_symlink())
 
-    # TODO test case for setup_wqm
+    def _sync_fixture(self, tempdir, jobs):
+        """Register fake jobs for syncing. jobs maps job ID -> save_root"""
+        statedir = tempdir / 'state'
+        os.mkdir(statedir)
+        ssm_hyak.REGISTER_STATEDIR = statedir
+        run_root = tempdir / 'run_root'
+        for jobid, save_root in jobs.items():
+            jobdir = run_root / f'instance{jobid}'
+            os.makedirs(jobdir / 'outputs')
+            with open(jobdir / 'outputs' / 'ssm_station.out', 'w') as f:
+                f.write('output\n')
+            with open(jobdir / 'ssm_hyak.ini', 'w') as f:
+                f.write(f'[DEFAULT]\nrun_root = {run_root}\nsave_root = {save_root}\n[wqm]\n')
+            with open(jobdir / 'wqm_con.npt', 'w') as f:
+                f.write('\n')
+            with open(statedir / f'{jobid}.job', 'w') as f:
+                f.write(f'{jobdir}\n')
+        return statedir
+
+    def test_sync_isolates_failures(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'100': 'good:/save', '101': 'bad:/save',
+                                               '102': 'good:/save'})
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'case "$*" in *bad*) exit 255;; esac\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\necho "Total bytes sent: 1,000"\n')
+            self._fake_bin(tp, 'squeue', 'echo "Invalid job id specified" >&2\nexit 1\n')
+
+            h = ssm_hyak.SyncHelper('DEFAULT', sync_workers='2')
+            h.run()
+
+            self.assertEqual(2, h.sync_count)
+            # Finished jobs are unregistered, the failed one is kept
+            self.assertEqual(['101.job'], sorted(p.name for p in statedir.glob('*.job')))
+            with open(log) as f:
+                dests = [l.split()[-1] for l in f]
+            self.assertIn('good:/save/instance100', dests)
+            self.assertIn('good:/save/instance102/outputs', dests)
+            self.assertNotIn('bad:/save/instance101', dests)
+
+    def test_sync_leases(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            a = ssm_hyak.SyncLeases(tp / 'leases', ttl=60, owner='login01:1')
+            b = ssm_hyak.SyncLeases(tp / 'leases', ttl=60, owner='login02:1')
+            a.heartbeat()
+            b.heartbeat()
+            self.assertEqual({'login01:1', 'login02:1'}, a.workers())
+            jobs = [str(i) for i in range(200, 220)]
+            shares = {w: {j for j in jobs if a.preferred(j, a.workers()) == w} for w in a.workers()}
+            self.assertEqual(set(jobs), shares['login01:1'] | shares['login02:1'])
+            self.assertFalse(shares['login01:1'] & shares['login02:1'])
+
+            self.assertTrue(a.claim('200'))
+            self.assertFalse(b.claim('200'))
+            self.assertEqual('login01:1', b.owner_of('200'))
+            # A lease that isn't renewed goes stale and can be taken over
+            old = time.time() - 120
+            os.utime(tp / 'leases' / '200.lease', (old, old))
+            self.assertTrue(b.claim('200'))
+            self.assertEqual(['200'], a.heartbeat())
+            a.release('200')
+            self.assertEqual('login02:1', a.owner_of('200'))
+            b.close()
+            self.assertIsNone(a.owner_of('200'))
+            self.assertEqual({'login01:1'}, a.workers())
+
+    def test_sync_shares_jobs(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            jobs = [str(i) for i in range(300, 310)]
+            statedir = self._sync_fixture(tp, {j: 'host:/save' for j in jobs})
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n')
+            self._fake_bin(tp, 'squeue', 'for a; do case "$a" in --jobs=*) echo "${a#*=}" | tr , "\\n" | '
+                                         'while read j; do echo "$j $j RUNNING"; done;; esac; done\n')
+            # A sync process on another login node, holding one of this one's jobs
+            other = ssm_hyak.SyncLeases(statedir / 'leases', owner='login02:1')
+            other.heartbeat()
+            me = f'{socket.gethostname()}:{os.getpid()}'
+            mine = [j for j in jobs if other.preferred(j, {me, other.owner}) == me]
+            if mine:
+                other.claim(mine[0])
+
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no')
+            h.run()
+            self.assertEqual(max(len(mine) - 1, 0), h.sync_count)
+            # Leases are given up at the end, except the other process's
+            self.assertEqual({f'{j}.lease' for j in mine[:1]},
+                             {p.name for p in (statedir / 'leases').glob('*.lease')})
+            self.assertFalse(list(statedir.glob('sync.*.pid')))
+
+    def test_sync_job_states(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'200': 'host:/save', '201': 'host:/save',
+                                               '202': 'host:/save', '203': 'host:/save'})
+            log = tp / 'rsync.log'
+            calls = tp / 'squeue.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n')
+            self._fake_bin(tp, 'squeue', f'echo "$@" >> {calls}\necho "200 200 RUNNING"\necho "201 201 PENDING"\n')
+            self._fake_bin(tp, 'sacct', 'echo "202|202|TIMEOUT"\necho "203|203|CANCELLED by 1234"\n')
+
+            h = ssm_hyak.SyncHelper('DEFAULT')
+            h.run()
+
+            # A single squeue call for every job, with array tasks listed separately
+            with open(calls) as f:
+                lines = f.readlines()
+            self.assertEqual(1, len(lines))
+            self.assertIn('--array', lines[0].split())
+            self.assertEqual({'200': 'RUNNING', '201': 'PENDING', '202': 'TIMEOUT',
+                              '203': 'CANCELLED'}, h.job_states)
+            self.assertEqual(3, h.sync_count)
+            # Running and pending jobs stay registered
+            self.assertEqual(['200.job', '201.job'], sorted(p.name for p in statedir.glob('*.job')))
+            with open(log) as f:
+                synced = f.read()
+            self.assertNotIn('instance201', synced)
+            # Only the running job uses --append-verify
+            for line in synced.splitlines():
+                if '--append-verify' in line:
+                    self.assertIn('instance200', line)
+
+    def test_sync_skips_unchanged(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            self._sync_fixture(tp, {'500': 'host:/save'})
+            outputs = tp / 'run_root' / 'instance500' / 'outputs'
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n'
+                                        'for a; do case "$a" in --files-from=*) cat "${a#*=}" >> ' + f'{log};; esac; done\n'
+                                        'echo "Total bytes sent: 1,000"\n')
+            self._fake_bin(tp, 'squeue', 'echo "500 500 RUNNING"\n')
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no')
+            h.run()
+            # Inputs then outputs, each logged with its file list
+            self.assertEqual(5, self._rsync_count(log))
+
+            # Nothing changed: no rsync at all
+            os.unlink(log)
+            h.run()
+            self.assertFalse(log.exists())
+
+            # Only the changed file is sent
+            with open(outputs / 'ssm_history_00001.out', 'w') as f:
+                f.write('more output\n')
+            h.run()
+            with open(log) as f:
+                lines = f.read().splitlines()
+            self.assertEqual(2, len(lines))
+            self.assertIn('--append-verify', lines[0])
+            self.assertEqual('ssm_history_00001.out', lines[1])
+
+            with open(outputs / 'ssm_station.out', 'a') as f:
+                f.write('unsynced\n')
+            out = io.StringIO()
+            with contextlib.redirect_stdout(out):
+                ssm_hyak.StatusHelper('DEFAULT').run()
+            row = [l for l in out.getvalue().splitlines() if l.startswith('500 ')][0]
+            self.assertIn('RUNNING', row)
+            self.assertIn('2.9 KiB', row)
+            self.assertIn('1 / 16 B', row)
+
+    def test_sync_chain_segments(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'510': 'host:/save'})
+            jobdir = tp / 'run_root' / 'instance510'
+            with open(jobdir / 'ssm_hyak.ini', 'a') as f:
+                f.write('chain_steps = 100\n')
+            with open(jobdir / 'outputs' / 'ssm_history_00001.out', 'w') as f:
+                f.write('segment 1\n')
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', 'for a; do case "$a" in --files-from=*) cat "${a#*=}" >> ' + f'{log};; esac; done\n')
+            self._fake_bin(tp, 'squeue', 'exit 0\n')
+            self._fake_bin(tp, 'sacct', 'echo "510|510|COMPLETED"\n')
+            # The first segment's final sync
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            self.assertIn('ssm_history_00001.out', log.read_text().split())
+
+            # The next segment adds a file
+            os.unlink(log)
+            with open(jobdir / 'outputs' / 'ssm_history_00002.out', 'w') as f:
+                f.write('segment 2\n')
+            with open(statedir / '511.job', 'w') as f:
+                f.write(f'{jobdir}\nprevious=510\n')
+            self._fake_bin(tp, 'squeue', 'echo "511 511 RUNNING"\n')
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            self.assertEqual(['ssm_history_00002.out'], log.read_text().split())
+            state = ssm_hyak.SyncState(statedir / 'sync.db')
+            # Once carried on from, the first segment's list isn't needed
+            self.assertEqual({}, state.files('510'))
+            state.close()
+
+    def test_sync_append_tail(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            self._sync_fixture(tp, {'800': f'host:{tp / "save"}'})
+            outputs = tp / 'run_root' / 'instance800' / 'outputs'
+            remote = tp / 'save' / 'instance800' / 'outputs'
+            hist = outputs / 'ssm_history_00001.out'
+            with open(hist, 'wb') as f:
+                f.write(b'h' * 10 + b'a' * 90)
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'while [ $# -gt 0 ]; do case "$1" in -o) shift 2;; -*) shift;; *) break;; esac; done\n'
+                                      'shift\neval "$@"\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n'
+                                        'for a; do case "$a" in --files-from=*) list="${a#*=}";; esac; src="$dst"; dst="$a"; done\n'
+                                        'dst="${dst#*:}"\n'
+                                        'while read f; do mkdir -p "$dst/$(dirname "$f")"; cp -p "$src$f" "$dst/$f"; done < "$list"\n')
+            self._fake_bin(tp, 'squeue', 'echo "800 800 RUNNING"\n')
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no', sync_append='tail', sync_append_head='10')
+            h.run()
+            self.assertEqual(hist.read_bytes(), (remote / hist.name).read_bytes())
+
+            # A short remote copy is sent again in full
+            os.truncate(remote / hist.name, 20)
+            with open(hist, 'ab') as f:
+                f.write(b'c' * 50)
+            h.run()
+            self.assertIn('--append-verify', log.read_text())
+            self.assertEqual(hist.read_bytes(), (remote / hist.name).read_bytes())
+
+            # Only the new bytes and the header go, without rsync
+            os.unlink(log)
+            with open(hist, 'r+b') as f:
+                f.write(b'H' * 10)
+                f.seek(0, os.SEEK_END)
+                f.write(b'b' * 50)
+            h.run()
+            self.assertFalse(log.exists())
+            self.assertEqual(hist.read_bytes(), (remote / hist.name).read_bytes())
+
+            # The final sync checks the whole file
+            self._fake_bin(tp, 'squeue', 'exit 0\n')
+            self._fake_bin(tp, 'sacct', 'echo "800|800|COMPLETED"\n')
+            h.run()
+            lines = log.read_text().splitlines()
+            self.assertEqual(1, len(lines))
+            self.assertIn('--checksum', lines[0])
+            self.assertNotIn('--append-verify', lines[0])
+
+    def _fake_netcdf(self, tempdir):
+        """nccopy and ncks that write the first half of the file, and an ncdump that
+        rejects files containing "bad". Returns the log of their arguments."""
+        log = tempdir / 'nc.log'
+        copy = f'echo "$0 $@" >> {log}\n' + 'for a; do src="$dst"; dst="$a"; done\n' \
+               'head -c $(($(wc -c < "$src") / 2)) "$src" > "$dst"\n'
+        self._fake_bin(tempdir, 'nccopy', copy)
+        self._fake_bin(tempdir, 'ncks', copy)
+        self._fake_bin(tempdir, 'ncdump', 'for a; do f="$a"; done\n'
+                                          'grep -q bad "$f" && exit 1\n'
+                                          'echo "dimensions:"\necho "\ttime = UNLIMITED ; // (3 currently)"\n')
+        return log
+
+    def test_reduce_outputs(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            log = self._fake_netcdf(tp)
+            outputs = tp / 'outputs'
+            os.mkdir(outputs)
+            for name, content in (('ssm_00001.nc', 'x' * 1000), ('ssm_restart_0001.nc', 'x' * 1000),
+                                  ('ssm_00002.nc', 'bad' * 100), ('ssm_station.out', 'x' * 1000)):
+                with open(outputs / name, 'w') as f:
+                    f.write(content)
+            self.assertEqual(500, ssm_hyak.reduce_outputs(outputs, {}))
+            self.assertEqual(500, (outputs / 'ssm_00001.nc').stat().st_size)
+            # Restarts, other files and failures are left alone
+            for name in ('ssm_restart_0001.nc', 'ssm_00002.nc', 'ssm_station.out'):
+                self.assertEqual(1000 if name != 'ssm_00002.nc' else 300, (outputs / name).stat().st_size)
+            self.assertEqual(['ssm_00001.nc', 'ssm_00002.nc', 'ssm_restart_0001.nc', 'ssm_station.out'],
+                             sorted(os.listdir(outputs)))
+            self.assertIn('nccopy -k nc4 -d 4 -s', log.read_text())
+
+            # Thinning uses ncks, and a wrong record count keeps the original
+            os.unlink(log)
+            config = {'reduce_variables': 'DOXG, temp', 'reduce_time_stride': '2', 'reduce_workers': '1'}
+            self.assertEqual(0, ssm_hyak.reduce_outputs(outputs, config))
+            self.assertIn('ncks -O -4 -L 4 -v DOXG,temp -d time,,,2', log.read_text())
+            self.assertEqual(500, (outputs / 'ssm_00001.nc').stat().st_size)
+
+    def test_sync_reduce(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            self._sync_fixture(tp, {'900': 'host:/save'})
+            self._fake_netcdf(tp)
+            outputs = tp / 'run_root' / 'instance900' / 'outputs'
+            for name in ('ssm_00001.nc', 'ssm_history_00001.nc'):
+                with open(outputs / name, 'w') as f:
+                    f.write('x' * 1000)
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n'
+                                        'for a; do case "$a" in --files-from=*) cat "${a#*=}" >> ' + f'{log};; esac; done\n')
+            self._fake_bin(tp, 'squeue', 'echo "900 900 RUNNING"\n')
+            # As reduce = job would leave it part way through
+            with open(outputs / '.ssm_00002.nc.reduced', 'w') as f:
+                f.write('partial')
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no', reduce='sync')
+            h.run()
+            self.assertEqual(1000, (outputs / 'ssm_00001.nc').stat().st_size)
+            self.assertIn('ssm_00001.nc', log.read_text().split())
+            self.assertNotIn('.ssm_00002.nc.reduced', log.read_text().split())
+            os.unlink(outputs / '.ssm_00002.nc.reduced')
+            # Only before the final sync
+            os.unlink(log)
+            self._fake_bin(tp, 'squeue', 'exit 0\n')
+            self._fake_bin(tp, 'sacct', 'echo "900|900|COMPLETED"\n')
+            h.run()
+            self.assertEqual(500, (outputs / 'ssm_00001.nc').stat().st_size)
+            self.assertEqual(500, (outputs / 'ssm_history_00001.nc').stat().st_size)
+            # The reduced history file is smaller than the remote copy, which
+            # --append would leave alone
+            lines = log.read_text().splitlines()
+            histargs = lines[lines.index('ssm_history_00001.nc') - 1]
+            self.assertNotIn('--append', histargs)
+
+    def test_sync_records_runs(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'950': 'host:/save'})
+            with open(tp / 'run_root' / 'instance950' / 'wqm_con.npt', 'w') as f:
+                f.write('TIME CON     TMSTRT     TMEND\n')
+                f.write('                1.0        3.\n')
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', 'exit 0\n')
+            self._fake_bin(tp, 'squeue', 'exit 0\n')
+            self._fake_bin(tp, 'sacct', 'case "$*" in *ElapsedRaw*)\n'
+                                        'echo "950|7200|1|40|"\necho "950.batch|7200|1|1|500M"\n'
+                                        'echo "950.0|7200|1|40|1048576K";;\n'
+                                        '*) echo "950|950|COMPLETED";; esac\n')
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            state = ssm_hyak.SyncState(statedir / 'sync.db')
+            self.assertEqual([{'jobid': '950', 'days': 2.0, 'nodes': 1, 'cpus': 40, 'elapsed': 7200.0,
+                               'max_rss': 1024 ** 3}], state.runs('wqm', None))
+            state.close()
+
+    def test_sync_records_node_synced_runs(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'960': 'host:/save'})
+            with open(statedir / '960.job', 'a') as f:
+                f.write('job_sync=1\n')
+            with open(tp / 'run_root' / 'instance960' / 'wqm_con.npt', 'w') as f:
+                f.write('TIME CON     TMSTRT     TMEND\n')
+                f.write('                0.0        1.\n')
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', 'exit 0\n')
+            self._fake_bin(tp, 'squeue', 'echo "960 960 RUNNING"\n')
+            self._fake_bin(tp, 'sacct', 'echo "960|3600|1|40|2G"\n')
+
+            # The job's own final sync, while it is still running
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no')
+            h.job = '960'
+            h.final = True
+            h.run()
+            self.assertFalse((statedir / '960.job').exists())
+            self.assertTrue((statedir / '960.record').exists())
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            self.assertTrue((statedir / '960.record').exists())
+
+            # Recorded once sacct has it as completed
+            self._fake_bin(tp, 'squeue', 'exit 0\n')
+            self._fake_bin(tp, 'sacct', 'case "$*" in *ElapsedRaw*) echo "960|3600|1|40|2G";;\n'
+                                        '*) echo "960|960|COMPLETED";; esac\n')
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            self.assertFalse((statedir / '960.record').exists())
+            state = ssm_hyak.SyncState(statedir / 'sync.db')
+            self.assertEqual([{'jobid': '960', 'days': 1.0, 'nodes': 1, 'cpus': 40, 'elapsed': 3600.0,
+                               'max_rss': 2 * 1024 ** 3}], state.runs('wqm', None))
+            state.close()
+
+    def test_sync_from_job(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            statedir = self._sync_fixture(tp, {'600': 'host:/save'})
+            with open(statedir / '600.job', 'a') as f:
+                f.write('job_sync=1\n')
+            log = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n')
+            self._fake_bin(tp, 'squeue', 'echo "600 600 RUNNING"\n')
+
+            # The login node leaves it to the job while it runs
+            ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+            self.assertFalse(log.exists())
+
+            h = ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no')
+            h.job = '600'
+            h.run()
+            self.assertEqual(2, self._rsync_count(log))
+            self.assertTrue((statedir / '600.job').exists())
+            h.final = True
+            h.run()
+            self.assertFalse((statedir / '600.job').exists())
+
+    def test_metrics(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            self._sync_fixture(tp, {'700': 'host:/save'})
+            self._fake_bin(tp, 'ssh', 'exit 0\n')
+            self._fake_bin(tp, 'rsync', 'echo "Number of regular files transferred: 2"\n'
+                                        'echo "Total bytes sent: 1,000"\n')
+            self._fake_bin(tp, 'squeue', 'echo "700 700 RUNNING"\n')
+            ssm_hyak.metrics.configure({'metrics': 'json, prometheus', 'metrics_dir': d}, 'sync')
+            try:
+                ssm_hyak.SyncHelper('DEFAULT', ssh_multiplex='no').run()
+                ssm_hyak.metrics.flush()
+            finally:
+                ssm_hyak.metrics.configure({}, None)
+
+            with open(tp / 'metrics.jsonl') as f:
+                entries = [json.loads(l) for l in f]
+            phases = {e['phase']: e for e in entries}
+            self.assertEqual(1, phases['squeue']['jobs'])
+            self.assertEqual(2, phases['sync_inputs']['files'])
+            self.assertEqual(1000, phases['sync_outputs']['bytes'])
+            self.assertEqual(2000, phases['sync_job']['bytes'])
+            self.assertTrue(all(e['ok'] and e['command'] == 'sync' for e in entries))
+            with open(tp / 'ssm_hyak_sync.prom') as f:
+                prom = f.read()
+            self.assertIn('ssm_phase_bytes{command="sync",phase="sync_job"} 2000\n', prom)
+            self.assertIn('ssm_phase_runs{command="sync",phase="squeue"} 1\n', prom)
+
+    def test_sync_daemon(self):
+        for watch in ('inotify', 'poll'):
+            with self.subTest(watch=watch), tempfile.TemporaryDirectory() as d:
+                tp = Path(d)
+                statedir = self._sync_fixture(tp, {'400': 'host:/save'})
+                outputs = tp / 'run_root' / 'instance400' / 'outputs'
+                log = tp / 'rsync.log'
+                self._fake_bin(tp, 'ssh', 'exit 0\n')
+                # The model writes a file while the first sync runs
+                self._fake_bin(tp, 'rsync', f'echo "$@" >> {log}\n'
+                                            'for a; do case "$a" in --files-from=*) cat "${a#*=}" >> ' + f'{log}\n'
+                                            f'[ -e {outputs}/new.out ] || echo new > {outputs}/new.out;; esac; done\n')
+                # Running for two polls, then gone
+                self._fake_bin(tp, 'squeue', f'echo x >> {tp}/polls\n'
+                                             f'[ $(wc -l < {tp}/polls) -le 2 ] && echo "400 400 RUNNING"\nexit 0\n')
+                self._fake_bin(tp, 'sacct', 'echo "400|400|COMPLETED"\n')
+
+                h = ssm_hyak.SyncHelper('DEFAULT', sync_watch=watch, sync_poll_interval='0',
+                                        sync_debounce='0', ssh_multiplex='no')
+                h.run_daemon(iterations=3)
+
+                with open(log) as f:
+                    lines = f.read().splitlines()
+                # Sent once when it changed; the final sync skips unchanged files
+                self.assertEqual(1, lines.count('new.out'))
+                self.assertEqual(1, lines.count('ssm_station.out'))
+                self.assertEqual([], list(statedir.glob('*.job')))
+                self.assertEqual({}, h.tracked)
+
+    def test_sync_ssh_multiplex(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            self._sync_fixture(tp, {'300': 'host1:/save', '301': 'host1:/save',
+                                    '302': 'host2:/save'})
+            sshlog = tp / 'ssh.log'
+            rsynclog = tp / 'rsync.log'
+            self._fake_bin(tp, 'ssh', f'echo "$@" >> {sshlog}\n')
+            self._fake_bin(tp, 'rsync', f'echo "$@" >> {rsynclog}\n')
+            self._fake_bin(tp, 'squeue', 'echo "300 RUNNING"\necho "301 RUNNING"\necho "302 RUNNING"\n')
+
+            h = ssm_hyak.SyncHelper('DEFAULT')
+            h.run()
+
+            with open(sshlog) as f:
+                sshcalls = f.read().splitlines()
+            # One master per host, opened once and closed once
+            self.assertEqual(2, len([c for c in sshcalls if 'ControlMaster=yes' in c]))
+            self.assertEqual(2, len([c for c in sshcalls if '-O exit' in c]))
+            # The directories for one host are created with a single command
+            mkdirs = [c for c in sshcalls if 'mkdir' in c]
+            self.assertEqual(2, len(mkdirs))
+            host1 = [c for c in mkdirs if 'host1' in c][0]
+            self.assertIn('/save/instance300', host1)
+            self.assertIn('/save/instance301', host1)
+            # Every rsync goes through the control socket
+            with open(rsynclog) as f:
+                for line in f:
+                    self.assertIn('ControlPath=', line)
+
+    def _fake_remote(self, tempdir):
+        """Fake ssh and rsync that treat every remote host as the local machine"""
+        log = tempdir / 'rsync.log'
+        self._fake_bin(tempdir, 'ssh', 'while [ $# -gt 0 ]; do case "$1" in -o) shift 2;; -*) shift;; *) break;; esac; done\n'
+                                       'shift\n[ $# -gt 0 ] && eval "$@"\nexit 0\n')
+        self._fake_bin(tempdir, 'rsync', f'echo "$@" >> {log}\n'
+                                         'for a; do case "$a" in --files-from=*) list="${a#*=}";; esac; src="$dst"; dst="$a"; done\n'
+                                         'src="${src#*:}"\n'
+                                         'if [ -n "$list" ]; then while read f; do cp -p "$src$f" "$dst"/; done < "$list"\n'
+                                         'else cp -p "$src"*.nc "$dst"/; fi\n')
+        return log
+
+    def _rsync_count(self, log):
+        if not log.exists():
+            return 0
+        with open(log) as f:
+            return len(f.readlines())
+
+    def test_fetch_hydro_skip_current(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            log = self._fake_remote(tp)
+            remote = tp / 'remote' / 'netcdf'
+            os.makedirs(remote)
+            for i in range(3):
+                with open(remote / f'ssm_{i:04d}.nc', 'w') as f:
+                    f.write(f'hydro {i}\n')
+            os.symlink(tp / 'remote', tp / 'alias')
+            scrub = tp / 'scrub'
+            os.mkdir(scrub)
+            h = ssm_hyak.HyakSetupHelper('wqm', 'case', 'runme', save_root='remote:/save',
+                                         scrub_dir=os.fspath(scrub), transfer_streams='1')
+            h.home = tp
+            with open(tp / 'wqm_linkage.in', 'w') as wl:
+                wl.write("&hydro_netcdf\n/\n")
+
+            dest, current = h._fetch_hydro(ssm_hyak.RemotePath.from_string(f'remote:{remote}'))
+            self.assertFalse(current)
+            self.assertEqual(1, self._rsync_count(log))
+            self.assertTrue((dest / 'ssm_0002.nc').is_file())
+
+            # Nothing changed, and the same directory by another name: no rsync
+            dest2, current = h._fetch_hydro(ssm_hyak.RemotePath.from_string(f'remote:{tp}/alias/netcdf/'))
+            self.assertTrue(current)
+            self.assertEqual(dest, dest2)
+            self.assertEqual(1, self._rsync_count(log))
+
+            # A remote file changes
+            os.utime(remote / 'ssm_0001.nc', (0, 0))
+            h._fetch_hydro(ssm_hyak.RemotePath.from_string(f'remote:{remote}'))
+            self.assertEqual(2, self._rsync_count(log))
+
+            # A local file disappears
+            os.unlink(dest / 'ssm_0000.nc')
+            h._fetch_hydro(ssm_hyak.RemotePath.from_string(f'remote:{remote}'))
+            self.assertEqual(3, self._rsync_count(log))
+
+    def _wqm_fixture(self, tempdir):
+        run_root = tempdir / 'run_root'
+        instance = run_root / 'instance'
+        os.makedirs(instance / 'inputs')
+        os.chdir(instance)
+        with open(instance / 'inputs' / 'input_file.txt', 'w') as inpf:
+            inpf.write('test input file\n')
+        with open(instance / 'wqm_con.npt', 'w') as wc:
+            wc.write('Test control file\n')
+            wc.write('MAP FILE\n')
+            wc.write('inputs/input_file.txt\n')
+            wc.write('\n')
+        remote = tempdir / 'remote' / 'netcdf'
+        os.makedirs(remote)
+        for i in range(1, 4):
+            with open(remote / f'ssm_{i:05d}.nc', 'w') as f:
+                f.write(f'hydro {i}\n')
+        with open(instance / 'wqm_linkage.in', 'w') as wl:
+            wl.write(f"&hydro_netcdf\n    hydro_dir = 'remote:{remote}/'\n/\n")
+        with open(instance / 'run_icm.stub', 'w') as stubf:
+            stubf.write('SBATCH --job-name=test\n')
+            stubf.write('SBATCH --account=acct\n')
+            stubf.write('SBATCH --partition=part\n')
+        scrub = tempdir / 'scrub'
+        os.mkdir(scrub)
+        statedir = tempdir / 'state'
+        os.mkdir(statedir)
+        ssm_hyak.REGISTER_STATEDIR = statedir
+        sbatchlog = tempdir / 'sbatch.log'
+        self._fake_bin(tempdir, 'sbatch', f'echo "$@" >> {sbatchlog}\n'
+                                          f'n=$(cat {tempdir}/jobid 2>/dev/null || echo 1000)\n'
+                                          f'n=$((n+1)); echo $n > {tempdir}/jobid; echo "$n;cluster"\n')
+        return {
+                'run_root': run_root,
+                'scrub': scrub,
+                'remote': remote,
+                'sbatchlog': sbatchlog
+        }
+
+    def test_setup_wqm_time_window(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            log = self._fake_remote(tp)
+            for i in range(4, 11):
+                with open(paths['remote'] / f'ssm_{i:05d}.nc', 'w') as f:
+                    f.write(f'hydro {i}\n')
+            # One day per file, run from day 3 to 5
+            with open('wqm_linkage.in', 'w') as wl:
+                wl.write(f"&hydro_netcdf\n    hydro_dir = 'remote:{paths['remote']}/'\n"
+                         "    hydro_nrec = 24\n    hydro_dlt = 3600\n    hydro_filenumstart = 1\n/\n")
+            with open('wqm_con.npt', 'a') as wc:
+                wc.write('TIME CON     TMSTRT     TMEND    YRSTRT\n')
+                wc.write('                3.0        5.      2014\n')
+            p = self._wqm_helper(paths).run()
+            hydro_dir = Path(ssm_hyak.f90nml.read(p / 'wqm_linkage.in')['hydro_netcdf']['hydro_dir'])
+            self.assertEqual([f'ssm_{i:05d}.nc' for i in range(3, 8)],
+                             sorted(f.name for f in hydro_dir.iterdir()))
+
+            self.assertEqual(1, self._rsync_count(log))
+
+            # A run that is already covered doesn't fetch again
+            self._wqm_helper(paths).run()
+            self.assertEqual(1, self._rsync_count(log))
+
+            # Quick mode only adds the first two files
+            h = self._wqm_helper(paths)
+            h.quick = 2
+            h.run()
+            self.assertEqual(2, self._rsync_count(log))
+            self.assertEqual([f'ssm_{i:05d}.nc' for i in range(1, 8)],
+                             sorted(f.name for f in hydro_dir.iterdir()))
+
+    def test_setup_wqm_reuse(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            self._fake_remote(tp)
+            self._fake_bin(tp, 'squeue', 'echo "Invalid job id specified" >&2\nexit 1\n')
+            with open('inputs/other.dat', 'w') as f:
+                f.write('other\n')
+            p1 = self._wqm_helper(paths).run()
+            ino = (p1 / 'inputs' / 'input_file.txt').stat().st_ino
+
+            # Change one input, delete another and add a third
+            with open('inputs/other.dat', 'w') as f:
+                f.write('changed\n')
+            os.utime('inputs/other.dat', (0, 0))
+            os.unlink('inputs/input_file.txt')
+            with open('inputs/new.dat', 'w') as f:
+                f.write('new\n')
+            h = self._wqm_helper(paths)
+            h.reuse = True
+            p2 = h.run()
+            self.assertEqual(p1, p2)
+            self.assertFalse((p2 / 'inputs' / 'input_file.txt').exists())
+            self.assertTrue((p2 / 'inputs' / 'new.dat').is_file())
+            with open(p2 / 'inputs' / 'other.dat') as f:
+                self.assertEqual('changed\n', f.read())
+
+            # An unchanged file is left alone
+            with open('inputs/input_file.txt', 'w') as f:
+                f.write('back\n')
+            h = self._wqm_helper(paths)
+            h.reuse = True
+            h.run()
+            ino = (p2 / 'inputs' / 'other.dat').stat().st_ino
+            h = self._wqm_helper(paths)
+            h.reuse = True
+            h.run()
+            self.assertEqual(ino, (p2 / 'inputs' / 'other.dat').stat().st_ino)
+
+            # Not while the last job is still queued
+            self._fake_bin(tp, 'squeue', 'echo "1004 PENDING"\n')
+            h = self._wqm_helper(paths)
+            h.reuse = True
+            self.assertNotEqual(p2, h.run())
+
+    def _wqm_helper(self, paths, **config):
+        return ssm_hyak.HyakSetupHelper('wqm', 'case', 'runme',
+                                        run_root=os.fspath(paths['run_root']),
+                                        save_root='remote:/foo/bar',
+                                        scrub_dir=os.fspath(paths['scrub']),
+                                        scrub_dir_out=os.fspath(paths['scrub']),
+                                        transfer_streams='1', **config)
+
+    def test_setup_wqm(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            log = self._fake_remote(tp)
+            p = self._wqm_helper(paths).run()
+
+            self.assertEqual(1, self._rsync_count(log))
+            self.assertTrue((p / 'inputs' / 'input_file.txt').is_file())
+            self.assertTrue((p / 'wqm_con.npt').is_file())
+            self.assertTrue((p / 'outputs').is_symlink())
+            hydro_dir = ssm_hyak.f90nml.read(p / 'wqm_linkage.in')['hydro_netcdf']['hydro_dir']
+            self.assertTrue(hydro_dir.startswith(os.fspath(paths['scrub'])))
+            self.assertTrue((Path(hydro_dir) / 'ssm_00003.nc').is_file())
+            with open(paths['sbatchlog']) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(1, len(calls))
+            self.assertNotIn('--dependency', calls[0])
+
+    def test_setup_wqm_job_sync(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            self._fake_remote(tp)
+            p = self._wqm_helper(paths, job_sync='yes', job_sync_interval='600').run()
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertIn('job_sync=1', script)
+            self.assertIn('sync --job "$SLURM_JOB_ID"', script)
+            self.assertIn('--loop 600) &\n', script)
+            # The flush is set up before the model starts
+            self.assertLess(script.index('ssm_sync --final'), script.index('mpirun'))
+
+            # Run the sync part of the script with a fake python, checking the
+            # loop is stopped before the final sync starts
+            log = tp / 'python.log'
+            self._fake_bin(tp, 'fake-python', 'case "$*" in\n'
+                                         f'*--loop*) echo $$ > {tp}/loop.pid\n'
+                                         f'    trap \'echo stopped >> {log}; exit 0\' TERM\n'
+                                         '    while :; do sleep 0.1; done;;\n'
+                                         f'*--final*) if kill -0 $(cat {tp}/loop.pid) 2>/dev/null; '
+                                         f'then echo "final while looping" >> {log}; else echo final >> {log}; fi;;\n'
+                                         'esac\n')
+            with mock.patch.object(ssm_hyak.sys, 'executable', os.fspath(tp / 'bin' / 'fake-python')):
+                p = self._wqm_helper(paths, job_sync='yes').run()
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            job_sync = script[script.index('ssm_sync()'):script.index('time mpirun')]
+            subprocess.run(['bash', '-c', job_sync + 'sleep 0.5\n'], cwd=p, check=True,
+                           env=dict(os.environ, SLURM_JOB_ID='1234'))
+            self.assertEqual(['stopped', 'final'], log.read_text().splitlines())
+
+            p = self._wqm_helper(paths, reduce='job').run()
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertLess(script.index('mpirun'), script.index('ssm_hyak.py reduce'))
+
+    def test_setup_wqm_hydro_local(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            self._fake_remote(tp)
+            p = self._wqm_helper(paths, hydro_local='yes', hydro_local_dir=os.fspath(tp / 'node')).run()
+            local = tp / 'node' / f'ssm-hydro-{p.name}'
+            hydro_dir = ssm_hyak.f90nml.read(p / 'wqm_linkage.in')['hydro_netcdf']['hydro_dir']
+            self.assertEqual(os.fspath(local) + '/', hydro_dir)
+            shared = Path(ssm_hyak.f90nml.read(p / 'wqm_linkage.shared.in')['hydro_netcdf']['hydro_dir'])
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertLess(script.index('SSM_HYDRO_PID=$!'), script.index('mpirun'))
+            self.assertLess(script.index('mpirun'), script.index('rm -rf "$SSM_HYDRO"'))
+
+            # Run the stage-in part of the script
+            stage_in = script[script.index('export SSM_HYDRO='):script.index('time mpirun')]
+            subprocess.run(['bash', '-c', stage_in + 'wait\n'], cwd=p, check=True)
+            self.assertEqual(['ssm_00001.nc', 'ssm_00002.nc', 'ssm_00003.nc'], sorted(os.listdir(local)))
+            for name in os.listdir(local):
+                self.assertFalse((local / name).is_symlink())
+                self.assertEqual((shared / name).read_text(), (local / name).read_text())
+
+            # With more than one node, the other nodes can't see the local copies
+            shutil.rmtree(local)
+            subprocess.run(['bash', '-c', stage_in + 'wait\n'], cwd=p, check=True,
+                           env=dict(os.environ, SLURM_JOB_NUM_NODES='2'))
+            self.assertFalse(local.exists())
+            self.assertEqual((p / 'wqm_linkage.shared.in').read_text(), (p / 'wqm_linkage.in').read_text())
+
+    def test_setup_wqm_autosize(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            self._fake_remote(tp)
+            with open(tp / 'run_root' / 'instance' / 'run_icm.stub', 'a') as f:
+                f.write('SBATCH --ntasks-per-node=20\n')
+                f.write('SBATCH --mem=10G !pin\n')
+            state = ssm_hyak.SyncState(ssm_hyak.REGISTER_STATEDIR / 'sync.db')
+            # 0.25 simulated days per core-hour on one node, 0.225 on two
+            for jobid, nodes, elapsed in (('1', 1, 3600), ('2', 1, 3600), ('3', 2, 2000)):
+                state.record_run(jobid, 'wqm', 'case', 10, elapsed, nodes, 40 * nodes, 1024 ** 3)
+            state.close()
+
+            p = self._wqm_helper(paths, autosize='suggest').run()
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertIn('#SBATCH --ntasks-per-node=20\n', script)
+            self.assertNotIn('--nodes', script)
+
+            p = self._wqm_helper(paths, autosize='apply').run()
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertIn('##SBATCH --ntasks-per-node=20\n', script)
+            self.assertIn('#SBATCH --nodes=1\n#SBATCH --ntasks-per-node=40\n', script)
+            # Pinned in the stub
+            self.assertIn('#SBATCH --mem=10G\n', script)
+            self.assertEqual(1, script.count('--mem'))
+
+            s = ssm_hyak.suggest_resources(ssm_hyak.SyncState(ssm_hyak.REGISTER_STATEDIR / 'sync.db').runs('wqm', 'case'))
+            self.assertEqual({'nodes': 1, 'tasks_per_node': 40, 'mem': int(40 * 1.2 * 1024 ** 3)}, s)
+
+    def test_setup_wqm_async_fetch(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            log = self._fake_remote(tp)
+            h = self._wqm_helper(paths, fetch_time='0:30:00')
+            h.async_fetch = True
+            p = h.run()
+
+            # Nothing fetched yet, the fetch job does that
+            self.assertEqual(0, self._rsync_count(log))
+            with open(p / 'fetch_hydro.sh') as f:
+                script = f.read()
+            self.assertIn('#SBATCH --account=acct\n', script)
+            self.assertIn('#SBATCH --time=0:30:00\n', script)
+            self.assertNotIn('--job-name=test', script)
+            self.assertTrue(script.rstrip().endswith(' fetch'))
+            with open(paths['sbatchlog']) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(2, len(calls))
+            self.assertTrue(calls[0].endswith('fetch_hydro.sh'))
+            self.assertIn('--dependency=afterok:1001', calls[1])
+            self.assertIn('--kill-on-invalid-dep=yes', calls[1])
+
+            # Run the fetch like the job would; the next submission doesn't need one
+            h = self._wqm_helper(paths)
+            h.method = 'fetch'
+            h.run()
+            self.assertEqual(1, self._rsync_count(log))
+            h = self._wqm_helper(paths)
+            h.async_fetch = True
+            h.run()
+            with open(paths['sbatchlog']) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(3, len(calls))
+            self.assertNotIn('--dependency', calls[2])
+
+    def test_sweep(self):
+        with tempfile.TemporaryDirectory() as d:
+            tp = Path(d)
+            paths = self._wqm_fixture(tp)
+            log = self._fake_remote(tp)
+            other = paths['run_root'] / 'other'
+            shutil.copytree(paths['run_root'] / 'instance', other)
+            with open(other / 'ssm_hyak.ini', 'w') as f:
+                f.write('[DEFAULT]\ncasename = othercase\n')
+            h = ssm_hyak.SweepHelper('wqm', casename='case', mpi_bin='runme',
+                                     run_root=os.fspath(paths['run_root']),
+                                     save_root='remote:/foo/bar',
+                                     scrub_dir=os.fspath(paths['scrub']),
+                                     scrub_dir_out=os.fspath(paths['scrub']),
+                                     transfer_streams='1', sweep_max_running='1')
+            h.dirs = [os.fspath(paths['run_root'] / '*')]
+            h.check = True
+            self.assertIsNone(h.run())
+            self.assertFalse(paths['sbatchlog'].exists())
+            os.unlink(other / 'inputs' / 'input_file.txt')
+            with self.assertRaises(ValueError):
+                h.run()
+            shutil.copy(paths['run_root'] / 'instance' / 'inputs' / 'input_file.txt', other / 'inputs')
+
+            h.check = False
+            p = h.run()
+
+            # One fetch and one submission for both instances
+            self.assertEqual(1, self._rsync_count(log))
+            with open(paths['sbatchlog']) as f:
+                calls = f.read().splitlines()
+            self.assertEqual(1, len(calls))
+            self.assertIn('slurm-%A_%a.out', calls[0])
+            with open(p / 'run_icm.sh') as f:
+                script = f.read()
+            self.assertIn('#SBATCH --account=acct\n', script)
+            self.assertIn('#SBATCH --array=0-1%1\n', script)
+            self.assertIn('runme case\n', script)
+            self.assertIn('runme othercase\n', script)
+
+            records = {}
+            for rec in (ssm_hyak.REGISTER_STATEDIR / 'instances').iterdir():
+                inst, jobid, home = rec.read_text().splitlines()
+                records[Path(home).name] = (Path(inst), jobid)
+                self.assertIn(f'cd {inst}\n', script)
+                self.assertTrue((Path(inst) / 'inputs' / 'input_file.txt').is_file())
+            self.assertEqual('1001_0', records['instance'][1])
+            self.assertEqual('1001_1', records['other'][1])
 
 if __name__ == '__main__':
     unittest.main()